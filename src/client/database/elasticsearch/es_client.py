@@ -2,7 +2,8 @@ import asyncio
 import os
 import sys
 
-from elasticsearch import Elasticsearch,exceptions
+from elasticsearch import Elasticsearch, AsyncElasticsearch, exceptions
+from elasticsearch.helpers import async_bulk, BulkIndexError
 # 获取当前脚本的绝对路径
 current_script_path = os.path.abspath(__file__)
 
@@ -11,7 +12,8 @@ root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(curre
 root_dir = os.path.dirname(root_dir)
 sys.path.append(root_dir)
 from src.utils.log_handler import debug_logger
-from src.configs.configs import ES_USER, ES_PASSWORD, ES_URL, ES_INDEX_NAME
+from src.configs.configs import ES_USER, ES_PASSWORD, ES_URL, ES_INDEX_NAME, ES_BULK_BATCH_SIZE, ES_BULK_CONCURRENCY, \
+    ES_BULK_MAX_RETRIES, ES_BULK_REFRESH_INTERVAL
 from langchain_elasticsearch import ElasticsearchStore
 
 
@@ -37,6 +39,13 @@ class ESClient:
             )
 
             debug_logger.info(f"Init ElasticSearchStore with index_name: {ES_INDEX_NAME}")
+            # 入库使用的异步客户端，在事件循环中第一次写入时创建
+            self._async_client = None
+            self._bulk_semaphore = None
+            self._index_checked = False
+            # 本进程中放宽refresh_interval的入库任务数，为0时恢复为索引默认值
+            self._bulk_mode = 0
+            self._bulk_lock = None
         except exceptions.ConnectionError as e:
             debug_logger.error(f"ES connection error: {e}")
             raise
@@ -47,6 +56,92 @@ class ESClient:
             debug_logger.error(f"Unexpected error initializing ES client: {e}")
             raise
 
+    def _get_async_client(self):
+        if self._async_client is None:
+            self._async_client = AsyncElasticsearch(
+                hosts=[ES_URL],
+                basic_auth=(ES_USER, ES_PASSWORD),
+                verify_certs=False,
+                ssl_show_warn=False,
+                retry_on_timeout=True,
+                max_retries=3,
+                request_timeout=60
+            )
+            self._bulk_semaphore = asyncio.Semaphore(ES_BULK_CONCURRENCY)
+            self._bulk_lock = asyncio.Lock()
+        return self._async_client
+
+    async def _bulk(self, actions):
+        # 429由async_bulk按退避重试；其余失败的条目中，5xx（分片不可用等）单独重试，4xx（mapping错误等）直接失败
+        client = self._get_async_client()
+        async with self._bulk_semaphore:
+            for attempt in range(ES_BULK_MAX_RETRIES + 1):
+                _, errors = await async_bulk(client, actions, chunk_size=ES_BULK_BATCH_SIZE,
+                                             max_retries=ES_BULK_MAX_RETRIES, initial_backoff=1,
+                                             raise_on_error=False, refresh=False)
+                if not errors:
+                    return
+                failed = {item['_id']: item for error in errors for item in error.values()}
+                fatal = [item for item in failed.values() if item.get('status', 500) < 500]
+                if fatal or attempt == ES_BULK_MAX_RETRIES:
+                    raise BulkIndexError(f"{len(failed)} documents failed to index, first error: "
+                                         f"{next(iter(failed.values())).get('error')}", errors)
+                debug_logger.warning(f"ES bulk retry {attempt + 1}: {len(failed)} documents failed")
+                actions = [action for action in actions if action['_id'] in failed]
+                await asyncio.sleep(2 ** attempt)
+
+    async def abulk_add(self, docs, ids):
+        """
+        用helpers.async_bulk写入文档，格式与es_store.add_documents相同（text + metadata），写入时不refresh，
+        按ES_BULK_BATCH_SIZE分成多个bulk请求并发发送（整个客户端最多ES_BULK_CONCURRENCY个）
+        """
+        if not self._index_checked:
+            # 索引不存在时按es_store的检索策略创建，保证mapping与原来的写入方式一致
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.es_store._create_index_if_not_exists, self.es_store.index_name)
+            self._index_checked = True
+        actions = [{"_op_type": "index", "_index": self.es_store.index_name, "_id": _id,
+                    self.es_store.query_field: doc.page_content, "metadata": doc.metadata}
+                   for doc, _id in zip(docs, ids)]
+        await asyncio.gather(*[self._bulk(actions[i:i + ES_BULK_BATCH_SIZE])
+                               for i in range(0, len(actions), ES_BULK_BATCH_SIZE)])
+        return len(actions)
+
+    async def arefresh(self):
+        await self._get_async_client().indices.refresh(index=self.es_store.index_name)
+
+    async def aenter_bulk_mode(self):
+        # 第一个入库任务开始时放宽refresh_interval，减少写入期间的segment合并
+        client = self._get_async_client()
+        async with self._bulk_lock:
+            self._bulk_mode += 1
+            if self._bulk_mode > 1:
+                return
+            try:
+                await client.indices.put_settings(index=self.es_store.index_name,
+                                                  settings={'index': {'refresh_interval': ES_BULK_REFRESH_INTERVAL}})
+            except exceptions.NotFoundError:
+                pass
+            except Exception as e:
+                debug_logger.error(f"Relax ES refresh_interval failed with error: {e}")
+
+    async def aexit_bulk_mode(self):
+        # 最后一个入库任务结束时恢复为索引默认值（null）并refresh一次
+        # 不恢复进入时读到的值：入库服务有多个worker进程，读到的可能是其它进程刚放宽的值，写回后索引会一直停在放宽状态
+        client = self._get_async_client()
+        async with self._bulk_lock:
+            self._bulk_mode -= 1
+            if self._bulk_mode > 0:
+                return
+            try:
+                await client.indices.put_settings(index=self.es_store.index_name,
+                                                  settings={'index': {'refresh_interval': None}})
+                await client.indices.refresh(index=self.es_store.index_name)
+            except exceptions.NotFoundError:
+                pass
+            except Exception as e:
+                debug_logger.error(f"Restore ES refresh_interval failed with error: {e}")
+
     def delete(self, docs_ids):
         try:
             res = self.es_store.delete(docs_ids, timeout=60)
@@ -54,13 +149,41 @@ class ESClient:
         except Exception as e:
             debug_logger.error(f"Delete ES document failed with error: {e}")
 
-    def delete_files(self, file_ids, file_chunks):
-        docs_ids = []
-        for file_id, file_chunk in zip(file_ids, file_chunks):
-            # doc_id 是file_id + '_' + i，其中i是range(file_chunk)
-            docs_ids.extend([file_id + '_' + str(i) for i in range(file_chunk)])
-        if docs_ids:
-            self.delete(docs_ids)
+    def delete_by_file_ids(self, file_ids):
+        """
+        按metadata.file_id删除文件的所有chunk，不需要知道文件写入了多少个chunk（如写入中途进程退出、删除文件）
+        返回删除的文档数，失败时抛出异常由调用方重试
+        """
+        try:
+            res = self.es_store.client.options(request_timeout=300).delete_by_query(
+                index=self.es_store.index_name,
+                query={"terms": {"metadata.file_id.keyword": list(file_ids)}},
+                refresh=True, conflicts='proceed', slices='auto')
+        except exceptions.NotFoundError:
+            # 索引还没有创建（没有写入过任何文档）
+            return 0
+        debug_logger.info(f"Delete ES documents of {len(file_ids)} files: {file_ids[:3]}, deleted: {res.get('deleted')}")
+        return res.get('deleted', 0)
+
+    def delete_by_file_id_except(self, file_id, keep_ids):
+        """
+        删除一个文件中除keep_ids以外的所有chunk（中断的入库写入的、编号不在父块索引中的chunk）
+        """
+        query = {"bool": {"filter": [{"term": {"metadata.file_id.keyword": file_id}}]}}
+        if keep_ids:
+            query["bool"]["must_not"] = [{"ids": {"values": list(keep_ids)}}]
+        try:
+            res = self.es_store.client.options(request_timeout=300).delete_by_query(
+                index=self.es_store.index_name, query=query, refresh=True, conflicts='proceed')
+        except exceptions.NotFoundError:
+            return 0
+        debug_logger.info(f"Delete stale ES documents of {file_id}, kept: {len(keep_ids)}, deleted: {res.get('deleted')}")
+        return res.get('deleted', 0)
+
+    def delete_files(self, file_ids, file_chunks=None):
+        # 文件增量更新后es编号不再是连续的range(chunks_number)，按file_id删除，file_chunks只为兼容旧的调用方式保留
+        if file_ids:
+            self.delete_by_file_ids(list(file_ids))
 
 # async def main():
 #     es_client = ESClient()
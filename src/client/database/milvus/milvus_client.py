@@ -120,6 +120,59 @@ class MilvusClient:
             print(f'[{cur_func_name()}] [store_doc] Failed to store document: {traceback.format_exc()}')
             raise MilvusFailed(f"Failed to store document: {str(e)}")
 
+    def store_docs(self, docs: List[Document], embeddings: List[List[float]], batch_size: int = 1000):
+        """
+        批量存储文档块：按分区（kb_id）分组，每组按batch_size条一次insert，代替逐条调用store_doc
+        """
+        if not self.sess:
+            raise MilvusFailed("Milvus collection is not loaded. Call load_collection_() first.")
+        if len(docs) != len(embeddings):
+            raise MilvusFailed(f"docs and embeddings length mismatch: {len(docs)} != {len(embeddings)}")
+        partitions = {}
+        for doc, embedding in zip(docs, embeddings):
+            metadata = doc.metadata
+            row = (metadata.get('user_id'), metadata.get('kb_id'), metadata.get('file_id'),
+                   json.dumps(metadata.get('headers', {})), metadata.get('doc_id'), doc.page_content, embedding)
+            if not all(row[:3]) or not all(row[4:6]) or embedding is None or len(embedding) == 0:
+                raise MilvusFailed("Missing required fields in document metadata or embedding.")
+            partitions.setdefault(row[1], []).append(row)
+        try:
+            existing_partitions = {p.name for p in self.sess.partitions}
+            for kb_id, rows in partitions.items():
+                if kb_id not in existing_partitions:
+                    self.sess.create_partition(kb_id)
+                    debug_logger.info(f"Created new partition: {kb_id}")
+                for i in range(0, len(rows), batch_size):
+                    # 按列组织插入数据（不需要提供主键值）
+                    self.sess.insert([list(column) for column in zip(*rows[i:i + batch_size])], partition_name=kb_id)
+            debug_logger.info(f"{len(docs)} documents stored in collection {self.sess.name}")
+        except Exception as e:
+            debug_logger.error(f'[{cur_func_name()}] [store_docs] Failed to store documents: {traceback.format_exc()}')
+            raise MilvusFailed(f"Failed to store documents: {str(e)}")
+
+    def delete_expr(self, expr: str, user_id: str = None, partition_name: str = None):
+        """
+        按表达式删除文档块，如 'file_id == "xxx"'、'doc_id in ["a", "b"]'
+        指定user_id时直接在该用户的集合上删除，不切换当前集合（self.sess），可以与写入并发执行
+        指定partition_name（kb_id）时只在该分区中删除
+        """
+        if user_id is not None:
+            if not utility.has_collection(user_id):
+                return
+            collection = Collection(user_id)
+            if partition_name is not None and not collection.has_partition(partition_name):
+                return
+        elif self.sess:
+            collection = self.sess
+        else:
+            raise MilvusFailed("Milvus collection is not loaded. Call load_collection_() first.")
+        try:
+            res = collection.delete(expr, partition_name=partition_name)
+            debug_logger.info(f"delete from {collection.name} where {expr[:200]}, delete count: {res.delete_count}")
+        except Exception as e:
+            debug_logger.error(f'[{cur_func_name()}] [delete_expr] Failed to delete: {traceback.format_exc()}')
+            raise MilvusFailed(f"Failed to delete documents: {str(e)}")
+
     @get_time
     def search_docs(self, query: str = None, filter_expr: str = None, doc_limit: int = 10, kb_ids: List[str] = None, search_all_partitions: bool = False) -> List[Document]:
         """
@@ -133,8 +186,25 @@ class MilvusClient:
         Returns:
             List[dict]: 检索到的文档列表，每个文档是一个字典，包含字段值和向量。
         """
+        query_embedding = embed_user_input(query)
+        return self.search_docs_by_embedding(query_embedding, filter_expr, doc_limit, kb_ids, search_all_partitions)
+
+    def search_docs_by_embedding(self, query_embedding: List[float], filter_expr: str = None, doc_limit: int = 10,
+                                 kb_ids: List[str] = None, search_all_partitions: bool = False) -> List[Document]:
+        """
+        使用已经计算好的查询向量检索文档，参数含义同 search_docs。
+        """
+        return self.search_docs_by_embeddings([query_embedding], filter_expr, doc_limit, kb_ids,
+                                              search_all_partitions)[0]
+
+    @get_time
+    def search_docs_by_embeddings(self, query_embeddings: List[List[float]], filter_expr: str = None,
+                                  doc_limit: int = 10, kb_ids: List[str] = None,
+                                  search_all_partitions: bool = False) -> List[List[Document]]:
+        """
+        多个查询向量在一次milvus search请求中检索（data=[v1, v2, ...]），按查询向量的顺序返回各自的文档列表
+        """
         try:
-            query_embedding = embed_user_input(query)
             if not self.sess:
                 raise MilvusFailed("Milvus collection is not loaded. Call load_collection_() first.")
 
@@ -174,7 +244,7 @@ class MilvusClient:
 
             # 构造检索参数
             search_params.update({
-                "data": [query_embedding] if query_embedding else None,
+                "data": query_embeddings,
                 "anns_field": "embedding", # 指定集合中存储向量的字段名称。Milvus 会在该字段上进行向量相似性检索。
                 "param": {"metric_type": "L2", "params": {"nprobe": 128}}, # 检索的精度和性能
                 "limit": doc_limit, # 指定返回的最相似文档的数量上限
@@ -185,9 +255,10 @@ class MilvusClient:
 
             # 执行检索
             results = self.sess.search(**search_params)
-            # 处理检索结果
-            retrieved_docs = []
+            # 处理检索结果，每个查询向量对应一组hits
+            retrieved_docs_list = []
             for hits in results:
+                retrieved_docs = []
                 for hit in hits:
                     doc = Document(hit.entity.get("content"))
                     doc.metadata["user_id"] = hit.entity.get("user_id")
@@ -195,11 +266,13 @@ class MilvusClient:
                     doc.metadata["file_id"] = hit.entity.get("file_id")
                     doc.metadata["headers"] = json.loads(hit.entity.get("headers")),
                     doc.metadata["doc_id"] = hit.entity.get("doc_id")
-                    # doc.metadata["embedding"] = hit.entity.get("embedding")
+                    # 保留chunk向量，回答结束后挑选相关图片时直接复用，不再重新计算
+                    doc.metadata["embedding"] = hit.entity.get("embedding")
                     doc.metadata["distance"] =  hit.distance
                     retrieved_docs.append(doc)
+                retrieved_docs_list.append(retrieved_docs)
 
-            return retrieved_docs
+            return retrieved_docs_list
 
         except Exception as e:
             print(f'[{cur_func_name()}] [search_docs] Failed to search documents: {traceback.format_exc()}')
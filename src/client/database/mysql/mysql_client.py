@@ -98,6 +98,8 @@ class MysqlClient:
         except MySQLError as err:
             if err.errno == 1061:
                 debug_logger.info(f"Index already exists (this is okay): {query}")
+            elif err.errno == 1060:
+                debug_logger.info(f"Column already exists (this is okay): {query}")
             else:
                 debug_logger.error("执行数据库操作失败：{}，SQL：{}".format(err, query))
             if commit:
@@ -113,6 +115,35 @@ class MysqlClient:
                     self.free_cnx, self.used_cnx))
 
         return result
+
+    def execute_transaction_(self, statements):
+        """
+        在同一个事务中依次执行 statements（[(query, params)]，params可以是返回参数的函数，参数为前面语句的rowcount列表），
+        全部成功后提交并返回各语句的rowcount，任一失败时回滚并抛出异常
+        """
+        conn = self.cnxpool.get_connection()
+        self.used_cnx += 1
+        self.free_cnx -= 1
+        cursor = None
+        query = None
+        try:
+            cursor = conn.cursor(buffered=True)
+            rowcounts = []
+            for query, params in statements:
+                cursor.execute(query, params(rowcounts) if callable(params) else params)
+                rowcounts.append(cursor.rowcount)
+            conn.commit()
+            return rowcounts
+        except MySQLError as err:
+            debug_logger.error("执行数据库事务失败：{}，SQL：{}".format(err, query))
+            conn.rollback()
+            raise
+        finally:
+            if cursor is not None:
+                cursor.close()
+            conn.close()
+            self.used_cnx -= 1
+            self.free_cnx += 1
     # 数据库建表语句
     def create_tables_(self):
         query = """
@@ -133,7 +164,9 @@ class MysqlClient:
                 kb_name VARCHAR(255),
                 deleted BOOL DEFAULT 0,
                 latest_qa_time TIMESTAMP,
-                latest_insert_time TIMESTAMP
+                latest_insert_time TIMESTAMP,
+                content_version INT DEFAULT 0,
+                faq_version INT DEFAULT 0
             );
 
         """
@@ -156,7 +189,13 @@ class MysqlClient:
                 file_url VARCHAR(2048) DEFAULT '',
                 upload_infos TEXT,
                 chunk_size INT DEFAULT -1,
-                timestamp VARCHAR(255) DEFAULT '197001010000'
+                timestamp VARCHAR(255) DEFAULT '197001010000',
+                lease_owner VARCHAR(255) DEFAULT NULL,
+                lease_expires DATETIME DEFAULT NULL,
+                attempts INT DEFAULT 0,
+                needs_rebuild BOOL DEFAULT 0,
+                content_hash CHAR(64) DEFAULT NULL,
+                delete_task_id VARCHAR(255) DEFAULT NULL
             );
 
         """
@@ -188,6 +227,43 @@ class MysqlClient:
             ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
         """
 
+        self.execute_query_(query, (), commit=True)
+
+        # 文件已入库父块的内容哈希，文件更新时据此只写入变化的父块
+        query = """
+            CREATE TABLE IF NOT EXISTS FileChunks (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                file_id VARCHAR(255) NOT NULL,
+                chunk_hash CHAR(64) NOT NULL,
+                doc_id VARCHAR(255) NOT NULL,
+                es_start INT NOT NULL,
+                es_count INT NOT NULL,
+                INDEX idx_file_id (file_id)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """
+        self.execute_query_(query, (), commit=True)
+
+        # 文件/知识库删除任务：接口只做软删除，milvus/es/Documents中的数据由入库服务在后台分批清理
+        # status: pending 等待执行，running 执行中（持有租约），done 完成，failed 重试多次后失败
+        query = """
+            CREATE TABLE IF NOT EXISTS DeleteTasks (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                task_id VARCHAR(255) UNIQUE,
+                user_id VARCHAR(255) NOT NULL,
+                kb_id VARCHAR(255) NOT NULL,
+                delete_kb BOOL DEFAULT 0,
+                status VARCHAR(32) DEFAULT 'pending',
+                total INT DEFAULT 0,
+                done INT DEFAULT 0,
+                msg VARCHAR(255) DEFAULT '',
+                lease_owner VARCHAR(255) DEFAULT NULL,
+                lease_expires DATETIME DEFAULT NULL,
+                attempts INT DEFAULT 0,
+                creation_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                update_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+                INDEX idx_status_lease_expires (status, lease_expires)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """
         self.execute_query_(query, (), commit=True)
         # 创建一个QaLogs表，用于记录用户的操作日志
         """
@@ -214,6 +290,7 @@ class MysqlClient:
                 result TEXT NOT NULL,
                 retrieval_documents MEDIUMTEXT NOT NULL,
                 source_documents MEDIUMTEXT NOT NULL,
+                condense_skipped BOOL DEFAULT 0,
                 timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
         """
@@ -246,6 +323,25 @@ class MysqlClient:
             "CREATE INDEX idx_user_id_status ON File (user_id, status)",
             "CREATE INDEX index_query ON QaLogs (query)",
             "CREATE INDEX index_timestamp ON QaLogs (timestamp)",
+            "ALTER TABLE KnowledgeBase ADD COLUMN content_version INT DEFAULT 0",
+            # 多轮问答是否跳过了问题压缩，time_record会被截断，单独存一列
+            "ALTER TABLE QaLogs ADD COLUMN condense_skipped BOOL DEFAULT 0",
+            # FAQ入库完成、删除后递增，FAQ索引据此重新加载
+            "ALTER TABLE KnowledgeBase ADD COLUMN faq_version INT DEFAULT 0",
+            # 文件入库任务队列：领取任务的租约
+            "ALTER TABLE File ADD COLUMN lease_owner VARCHAR(255) DEFAULT NULL",
+            "ALTER TABLE File ADD COLUMN lease_expires DATETIME DEFAULT NULL",
+            "ALTER TABLE File ADD COLUMN attempts INT DEFAULT 0",
+            # 文件曾被两个worker同时写入，下次入库前需要按file_id清空
+            "ALTER TABLE File ADD COLUMN needs_rebuild BOOL DEFAULT 0",
+            "CREATE INDEX idx_status_deleted_timestamp ON File (status, deleted, timestamp)",
+            "CREATE INDEX idx_status_lease_expires ON File (status, lease_expires)",
+            # 文件内容哈希，上传时按内容去重
+            "ALTER TABLE File ADD COLUMN content_hash CHAR(64) DEFAULT NULL",
+            "CREATE INDEX idx_kb_id_content_hash ON File (kb_id, content_hash)",
+            # 文件所属的删除任务，数据清理完成后置空
+            "ALTER TABLE File ADD COLUMN delete_task_id VARCHAR(255) DEFAULT NULL",
+            "CREATE INDEX idx_delete_task_id ON File (delete_task_id)",
         ]
 
         for query in index_queries:
@@ -382,15 +478,174 @@ class MysqlClient:
             kb_ids_str)
         return self.execute_query_(query, (), fetch=True)
     
+    # 按内容哈希查找知识库中已有的文件（失败的文件除外）
+    def check_file_exist_by_hash(self, user_id, kb_id, content_hashes):
+        if not content_hashes:
+            return []
+        placeholders = ','.join(['%s'] * len(content_hashes))
+        query = """
+            SELECT file_id, file_name, content_hash, status FROM File
+            WHERE deleted = 0 AND status != 'red'
+            AND content_hash IN ({})
+            AND kb_id = %s
+            AND kb_id IN (SELECT kb_id FROM KnowledgeBase WHERE user_id = %s)
+        """.format(placeholders)
+        return self.execute_query_(query, list(content_hashes) + [kb_id, user_id], fetch=True)
+
+    # 按存放位置和内容哈希查找文件（批量导入原地引用文件，file_location即源文件路径）
+    def get_file_by_location(self, user_id, kb_id, file_location, content_hash):
+        query = ("SELECT file_id, status FROM File WHERE deleted = 0 AND user_id = %s AND kb_id = %s "
+                 "AND file_location = %s AND content_hash = %s ORDER BY id DESC LIMIT 1")
+        result = self.execute_query_(query, (user_id, kb_id, file_location, content_hash), fetch=True)
+        return result[0] if result else None
+
+    # 查找可以增量更新的同名文件：已入库完成且有父块哈希索引
+    def get_indexed_files_by_name(self, user_id, kb_id, file_names):
+        if not file_names:
+            return []
+        placeholders = ','.join(['%s'] * len(file_names))
+        query = """
+            SELECT file_id, file_name, file_location FROM File
+            WHERE deleted = 0 AND status = 'green'
+            AND file_name IN ({})
+            AND kb_id = %s
+            AND kb_id IN (SELECT kb_id FROM KnowledgeBase WHERE user_id = %s)
+            AND EXISTS (SELECT 1 FROM FileChunks WHERE FileChunks.file_id = File.file_id)
+        """.format(placeholders)
+        return self.execute_query_(query, list(file_names) + [kb_id, user_id], fetch=True)
+
     # [文件] 向指定知识库下面增加文件
     def add_file(self, file_id, user_id, kb_id, file_name, file_size, file_location, chunk_size, timestamp, file_url='',
-                 status="gray"):
+                 status="gray", content_hash=None):
         query = ("INSERT INTO File (file_id, user_id, kb_id, file_name, status, file_size, file_location, chunk_size, "
-                 "timestamp, file_url) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
+                 "timestamp, file_url, content_hash) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
         self.execute_query_(query,
-                            (file_id, user_id, kb_id, file_name, status, file_size, file_location, chunk_size, timestamp, file_url),
+                            (file_id, user_id, kb_id, file_name, status, file_size, file_location, chunk_size, timestamp,
+                             file_url, content_hash),
+                            commit=True)
+
+    # [文件] 上传已有文件的新版本：沿用file_id，重新进入入库队列，入库时按父块哈希增量更新
+    def requeue_file_version(self, file_id, file_size, file_location, chunk_size, timestamp, content_hash,
+                             status='gray'):
+        query = ("UPDATE File SET status = %s, msg = 'success', attempts = 0, file_size = %s, file_location = %s, "
+                 "chunk_size = %s, timestamp = %s, content_hash = %s WHERE file_id = %s")
+        self.execute_query_(query, (status, file_size, file_location, chunk_size, timestamp, content_hash, file_id),
                             commit=True)
+
+    # [文件] 不经过入库队列直接处理的文件（如批量导入）领取租约，与入库队列一样标识文件正在入库
+    # 文件正在被其它进程入库（yellow且租约未过期）时领取失败，返回False；gray的文件在这里领取后入库队列不会再领取
+    def acquire_file_lease(self, file_id, owner, lease_timeout):
+        query = ("UPDATE File SET status = 'yellow', lease_owner = %s, "
+                 "lease_expires = DATE_ADD(NOW(), INTERVAL %s SECOND) WHERE file_id = %s "
+                 "AND (status != 'yellow' OR lease_expires IS NULL OR lease_expires <= NOW() OR lease_owner = %s)")
+        return bool(self.execute_query_(query, (owner, lease_timeout, file_id, owner), commit=True, check=True))
+
+    # [文件] 处理期间定期续租，租约已被回收时返回False
+    def renew_file_lease(self, file_id, owner, lease_timeout):
+        query = ("UPDATE File SET lease_expires = DATE_ADD(NOW(), INTERVAL %s SECOND) "
+                 "WHERE file_id = %s AND status = 'yellow' AND lease_owner = %s")
+        return bool(self.execute_query_(query, (lease_timeout, file_id, owner), commit=True, check=True))
+
+    # [文件] 不经过入库队列直接处理的文件（如批量导入），写入处理结果并释放租约
+    def update_file_result(self, file_id, status, content_length, chunks_number, msg):
+        query = ("UPDATE File SET status = %s, content_length = %s, chunks_number = %s, msg = %s, "
+                 "lease_owner = NULL, lease_expires = NULL WHERE file_id = %s")
+        self.execute_query_(query, (status, content_length, chunks_number, msg, file_id), commit=True)
+
+    def get_chunk_index(self, file_id):
+        query = "SELECT chunk_hash, doc_id, es_start, es_count FROM FileChunks WHERE file_id = %s ORDER BY id"
+        return self.execute_query_(query, (file_id,), fetch=True) or []
+
+    def replace_chunk_index(self, file_id, rows, batch_size=1000):
+        self.execute_query_("DELETE FROM FileChunks WHERE file_id = %s", (file_id,), commit=True)
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i:i + batch_size]
+            placeholders = ','.join(['(%s, %s, %s, %s, %s)'] * len(batch))
+            query = "INSERT INTO FileChunks (file_id, chunk_hash, doc_id, es_start, es_count) VALUES {}".format(
+                placeholders)
+            params = [value for row in batch for value in (file_id, *row)]
+            self.execute_query_(query, params, commit=True)
+
+    def delete_parent_chunks(self, doc_ids, batch_size=1000):
+        for i in range(0, len(doc_ids), batch_size):
+            batch = doc_ids[i:i + batch_size]
+            placeholders = ','.join(['%s'] * len(batch))
+            query = "DELETE FROM Documents WHERE doc_id IN ({})".format(placeholders)
+            self.execute_query_(query, batch, commit=True)
         
+    def delete_parent_chunks_except(self, file_id, keep_doc_ids):
+        # 删除文件中不在keep_doc_ids里的父块（doc_id以file_id + '_'为前缀）
+        query = "DELETE FROM Documents WHERE doc_id LIKE %s"
+        params = [file_id.replace('_', '\\_') + '\\_%']
+        if keep_doc_ids:
+            query += " AND doc_id NOT IN ({})".format(','.join(['%s'] * len(keep_doc_ids)))
+            params += list(keep_doc_ids)
+        self.execute_query_(query, params, commit=True)
+
+    def clear_file_rebuild(self, file_id):
+        self.execute_query_("UPDATE File SET needs_rebuild = 0 WHERE file_id = %s", (file_id,), commit=True)
+
+    # [删除] 软删除文件（file_ids为None时删除整个知识库）并创建后台清理任务，返回 (task_id, 文件数)
+    def create_delete_task(self, user_id, kb_id, file_ids=None):
+        task_id = 'DT' + uuid.uuid4().hex
+        statements = []
+        if file_ids is None:
+            statements.append(("UPDATE KnowledgeBase SET deleted = 1 WHERE kb_id = %s AND user_id = %s",
+                               (kb_id, user_id)))
+            statements.append(("UPDATE File SET deleted = 1, delete_task_id = %s "
+                               "WHERE kb_id = %s AND user_id = %s AND deleted = 0", (task_id, kb_id, user_id)))
+        else:
+            placeholders = ','.join(['%s'] * len(file_ids))
+            statements.append((("UPDATE File SET deleted = 1, delete_task_id = %s "
+                                "WHERE kb_id = %s AND user_id = %s AND deleted = 0 AND file_id IN ({})"
+                                ).format(placeholders), (task_id, kb_id, user_id, *file_ids)))
+        # 软删除与任务写入在同一事务中，不会出现没有任务处理的delete_task_id
+        statements.append(("INSERT INTO DeleteTasks (task_id, user_id, kb_id, delete_kb, total) "
+                           "VALUES (%s, %s, %s, %s, %s)",
+                           lambda rowcounts: (task_id, user_id, kb_id, file_ids is None, rowcounts[-1])))
+        # 删除的文件中有FAQ时，FAQ索引需要重新加载
+        statements.append(("UPDATE KnowledgeBase SET faq_version = faq_version + 1 WHERE kb_id = %s AND EXISTS "
+                           "(SELECT 1 FROM File WHERE delete_task_id = %s AND file_location = 'FAQ')",
+                           (kb_id, task_id)))
+        rowcounts = self.execute_transaction_(statements)
+        return task_id, rowcounts[-3]
+
+    def get_delete_task(self, user_id, task_id):
+        query = ("SELECT task_id, kb_id, delete_kb, status, total, done, msg, creation_time, update_time "
+                 "FROM DeleteTasks WHERE task_id = %s AND user_id = %s")
+        result = self.execute_query_(query, (task_id, user_id), fetch=True, user_dict=True)
+        return result[0] if result else None
+
+    def get_delete_task_files(self, task_id, limit):
+        # yellow的文件正在入库（入库队列和批量导入都持有租约），等入库结束或租约过期后再清理，否则入库会在清理之后继续写入
+        query = ("SELECT file_id, user_id, kb_id FROM File WHERE delete_task_id = %s AND deleted = 1 "
+                 "AND (status != 'yellow' OR lease_expires <= NOW()) LIMIT %s")
+        return self.execute_query_(query, (task_id, limit), fetch=True) or []
+
+    def count_delete_task_files(self, task_id):
+        query = "SELECT COUNT(*) FROM File WHERE delete_task_id = %s"
+        result = self.execute_query_(query, (task_id,), fetch=True)
+        return result[0][0] if result else 0
+
+    def purge_files(self, file_ids):
+        """
+        删除一批已软删除文件在mysql中的数据：父块（Documents，doc_id以file_id + '_'为前缀）、父块索引、FAQ和图片，
+        最后把文件移出删除任务。任一语句失败时抛出异常，整批重试（所有语句都可以重复执行）
+        """
+        placeholders = ','.join(['%s'] * len(file_ids))
+        # doc_id有唯一索引，前缀匹配走索引范围扫描
+        prefixes = [file_id.replace('_', '\\_') + '\\_%' for file_id in file_ids]
+        queries = [
+            ("DELETE FROM Documents WHERE " + ' OR '.join(['doc_id LIKE %s'] * len(file_ids)), prefixes),
+            ("DELETE FROM FileChunks WHERE file_id IN ({})".format(placeholders), file_ids),
+            ("DELETE FROM Faqs WHERE faq_id IN ({})".format(placeholders), file_ids),
+            ("DELETE FROM FileImages WHERE file_id IN ({})".format(placeholders), file_ids),
+            ("UPDATE File SET delete_task_id = NULL WHERE file_id IN ({})".format(placeholders), file_ids),
+        ]
+        for query, params in queries:
+            if self.execute_query_(query, list(params), commit=True, check=True) is None:
+                raise MySQLError(msg=f"purge files failed: {query[:100]}")
+
     # [文件] 添加 chunks number 字段
     def modify_file_chunks_number(self, file_id, user_id, kb_id, chunks_number):
         query = ("UPDATE File SET chunks_number = %s WHERE file_id = %s AND user_id = %s AND kb_id = %s")
@@ -412,6 +667,16 @@ class MysqlClient:
             json_data = json.dumps(doc_data, ensure_ascii=False)
             self.execute_query_(query, (id, json_data), commit=True)
     
+    def get_parent_images(self, doc_ids):
+        # 子块不保存图片，从父块的metadata中只取出图片列表，返回 {doc_id: images}
+        if not doc_ids:
+            return {}
+        placeholders = ','.join(['%s'] * len(doc_ids))
+        query = ("SELECT doc_id, JSON_EXTRACT(json_data, '$.metadata.images') FROM Documents "
+                 "WHERE doc_id IN ({})").format(placeholders)
+        result = self.execute_query_(query, list(doc_ids), fetch=True)
+        return {doc_id: json.loads(images) for doc_id, images in result or [] if images}
+
     def is_deleted_file(self, file_id):
         query = "SELECT deleted FROM File WHERE file_id = %s"
         result = self.execute_query_(query, (file_id,), fetch=True)
@@ -438,6 +703,25 @@ class MysqlClient:
     def update_knowlegde_base_latest_insert_time(self, kb_id, timestamp):
         query = "UPDATE KnowledgeBase SET latest_insert_time = %s WHERE kb_id = %s"
         self.execute_query_(query, (timestamp, kb_id), commit=True)
+
+    # 知识库内容发生变化（文件入库完成、删除）后递增版本号，检索缓存据此失效
+    def bump_kb_content_version(self, kb_id):
+        query = "UPDATE KnowledgeBase SET content_version = content_version + 1 WHERE kb_id = %s"
+        self.execute_query_(query, (kb_id,), commit=True)
+
+    def bump_kb_faq_version(self, kb_id):
+        query = "UPDATE KnowledgeBase SET faq_version = faq_version + 1 WHERE kb_id = %s"
+        self.execute_query_(query, (kb_id,), commit=True)
+
+    # 返回 {kb_id: (content_version, faq_version)}，问答时每个请求只查询一次，供各个缓存共用
+    def get_kb_versions(self, kb_ids):
+        if not kb_ids:
+            return {}
+        placeholders = ','.join(['%s'] * len(kb_ids))
+        query = ("SELECT kb_id, content_version, faq_version FROM KnowledgeBase "
+                 "WHERE kb_id IN ({})").format(placeholders)
+        result = self.execute_query_(query, list(kb_ids), fetch=True)
+        return {kb_id: (content_version, faq_version) for kb_id, content_version, faq_version in result or []}
         
     
     def get_faq(self, faq_id) -> tuple:
@@ -450,10 +734,43 @@ class MysqlClient:
         else:
             debug_logger.error(f"get_faq: faq_id: {faq_id} not found")
             return None
+    def get_faqs_by_kb_ids(self, kb_ids):
+        # 加载知识库下已入库完成且未删除的全部FAQ，用于构建进程内的FAQ索引
+        if not kb_ids:
+            return []
+        placeholders = ','.join(['%s'] * len(kb_ids))
+        query = ("SELECT q.faq_id, q.kb_id, q.question, q.answer, q.nos_keys, f.file_name FROM Faqs q "
+                 "JOIN File f ON q.faq_id = f.file_id WHERE q.kb_id IN ({}) AND f.deleted = 0 "
+                 "AND f.status = 'green'").format(placeholders)
+        result = self.execute_query_(query, list(kb_ids), fetch=True)
+        return result or []
+
+    def add_qalog(self, user_id, kb_ids, query, model, product_source, time_record, history, condense_question,
+                  prompt, result, retrieval_documents, source_documents, condense_skipped=False):
+        # 记录问答日志，按列宽截断定长字段；time_record等结构化字段以紧凑的json保存
+        qa_id = uuid.uuid4().hex
+        insert_query = ("INSERT INTO QaLogs (qa_id, user_id, kb_ids, query, model, product_source, time_record, "
+                        "history, condense_question, prompt, result, retrieval_documents, source_documents, "
+                        "condense_skipped) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
+        params = (qa_id, user_id, json.dumps(kb_ids, ensure_ascii=False)[:2048], query[:512], str(model)[:64],
+                  str(product_source)[:64], json.dumps(time_record, separators=(',', ':'))[:512],
+                  json.dumps(history, ensure_ascii=False), (condense_question or '')[:1024], prompt or '',
+                  result or '', json.dumps(retrieval_documents, ensure_ascii=False),
+                  json.dumps(source_documents, ensure_ascii=False), bool(condense_skipped))
+        self.execute_query_(insert_query, params, commit=True)
+        return qa_id
+
+    def get_multi_turn_qalogs(self, limit: int = 1000):
+        # 取最近的多轮问答日志（带历史对话），用于评估多轮问题的压缩策略
+        query = ("SELECT qa_id, kb_ids, query, history, condense_question, condense_skipped FROM QaLogs "
+                 "WHERE history != '[]' ORDER BY id DESC LIMIT %s")
+        result = self.execute_query_(query, (limit,), fetch=True)
+        return result or []
+
     def get_files_name_by_id(self, file_id):
         query = "SELECT file_name FROM File WHERE file_id = %s"
         result = self.execute_query_(query, (file_id,), fetch=True)
         if result:
             return result[0][0]
         else:
-            return ""
\ No newline at end of file
+            return ""
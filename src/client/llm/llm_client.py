@@ -25,6 +25,8 @@ from src.configs.configs import DEFAULT_PARENT_CHUNK_SIZE, \
 class OpenAILLM:
     offcut_token: int = 50
     stop_words: Optional[List[str]] = None
+    # 单次请求超时（秒），None表示使用openai客户端默认值
+    timeout: Optional[float] = None
 
     def __init__(self, model, max_token, api_base, api_key, api_context_length, top_p, temperature):
         base_url = api_base
@@ -109,7 +111,8 @@ class OpenAILLM:
                     max_tokens=self.max_token,
                     temperature=self.temperature,
                     top_p=self.top_p,
-                    stop=self.stop_words
+                    stop=self.stop_words,
+                    timeout=self.timeout
                 )
                 for event in response:
                     if not isinstance(event, dict):
@@ -129,7 +132,8 @@ class OpenAILLM:
                     max_tokens=self.max_token,
                     temperature=self.temperature,
                     top_p=self.top_p,
-                    stop=self.stop_words
+                    stop=self.stop_words,
+                    timeout=self.timeout
                 )
 
                 event_text = response.choices[0].message.content if response.choices else ""
@@ -0,0 +1,4 @@
+from .answer_cache import AnswerCache, AnswerCacheEntry
+from .retrieval_cache import RetrievalCache
+from .faq_index import FaqIndex
+from .condense_cache import CondenseCache
@@ -0,0 +1,125 @@
+import os
+import sys
+import time
+import hashlib
+import json
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+from src.configs.configs import ANSWER_CACHE_MAX_SIZE, ANSWER_CACHE_TTL, ANSWER_CACHE_SIMILARITY_THRESHOLD
+from src.client.embedding.embedding_client import SBIEmbeddings
+from src.utils.log_handler import debug_logger
+from src.utils.general_utils import normalize_question
+from src.core.cache.retrieval_cache import copy_documents
+
+
+class AnswerCacheEntry:
+    """
+    缓存的一条问答结果
+    """
+    __slots__ = ('bucket', 'question', 'embedding', 'kb_version', 'created', 'answer', 'prompt',
+                 'source_documents', 'retrieval_documents', 'show_images')
+
+    def __init__(self, bucket, question, embedding, kb_version, answer, prompt,
+                 source_documents, retrieval_documents, show_images):
+        self.bucket = bucket
+        self.question = question
+        self.embedding = embedding
+        self.kb_version = kb_version
+        self.created = time.time()
+        self.answer = answer
+        self.prompt = prompt
+        self.source_documents = source_documents
+        self.retrieval_documents = retrieval_documents
+        self.show_images = show_images
+
+
+class AnswerCache:
+    """
+    知识库问答结果缓存（进程内，LRU + TTL）
+
+    - 精确匹配：按 (kb_ids, 归一化后的独立问题, 模型, prompt配置) 查找
+    - 语义匹配：同一 (kb_ids, 模型, prompt配置) 下，问题向量余弦相似度超过阈值即命中
+    - 失效：记录查找时这些 kb_ids 的内容版本(KnowledgeBase.content_version)，
+      文件入库完成或删除后版本递增，条目作废。版本由调用方每个请求查询一次后传入
+    """
+
+    def __init__(self, embeddings: SBIEmbeddings,
+                 max_size: int = ANSWER_CACHE_MAX_SIZE, ttl: float = ANSWER_CACHE_TTL,
+                 similarity_threshold: float = ANSWER_CACHE_SIMILARITY_THRESHOLD):
+        self.embeddings = embeddings
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        # (bucket, question) -> AnswerCacheEntry，按最近使用排序
+        self._entries: "OrderedDict[Tuple[str, str], AnswerCacheEntry]" = OrderedDict()
+
+    @staticmethod
+    def make_bucket(kb_ids: List[str], model: str, prompt_config: dict) -> str:
+        raw = json.dumps({'kb_ids': sorted(kb_ids), 'model': model, 'prompt_config': prompt_config},
+                         ensure_ascii=False, sort_keys=True)
+        return hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+    def _is_expired(self, entry: AnswerCacheEntry, kb_version) -> bool:
+        return time.time() - entry.created > self.ttl or entry.kb_version != kb_version
+
+    async def lookup(self, kb_ids: List[str], question: str, model: str, prompt_config: dict, kb_version
+                     ) -> Tuple[Optional[AnswerCacheEntry], Optional[List[float]]]:
+        """
+        查找缓存，返回 (命中的条目或None, 问题向量)。
+        kb_version: 这些kb_ids当前的内容版本；未命中时问题向量直接传给 store 复用
+        """
+        bucket = self.make_bucket(kb_ids, model, prompt_config)
+        norm_question = normalize_question(question)
+
+        # 清理该分桶下过期或知识库已变化的条目
+        stale_keys = [key for key, entry in self._entries.items()
+                      if key[0] == bucket and self._is_expired(entry, kb_version)]
+        for key in stale_keys:
+            del self._entries[key]
+
+        key = (bucket, norm_question)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            debug_logger.info(f"answer cache exact hit: {norm_question}")
+            return self._entries[key], None
+
+        candidates = [entry for entry in self._entries.values() if entry.bucket == bucket]
+        embedding = await self.embeddings.aembed_query(norm_question)
+        if not candidates:
+            return None, embedding
+
+        # 向量已做L2归一化，点积即余弦相似度
+        matrix = np.asarray([entry.embedding for entry in candidates], dtype=np.float32)
+        scores = matrix @ np.asarray(embedding, dtype=np.float32)
+        best = int(np.argmax(scores))
+        if scores[best] >= self.similarity_threshold:
+            entry = candidates[best]
+            self._entries.move_to_end((bucket, entry.question))
+            debug_logger.info(f"answer cache semantic hit: {norm_question} -> {entry.question}, "
+                              f"similarity: {scores[best]:.4f}")
+            return entry, embedding
+        return None, embedding
+
+    def store(self, kb_ids: List[str], question: str, model: str, prompt_config: dict,
+              embedding: Optional[List[float]], kb_version, answer: str, prompt: str,
+              source_documents, retrieval_documents, show_images=None):
+        if embedding is None or not answer:
+            return
+        bucket = self.make_bucket(kb_ids, model, prompt_config)
+        norm_question = normalize_question(question)
+        self._entries[(bucket, norm_question)] = AnswerCacheEntry(
+            bucket, norm_question, embedding, kb_version, answer, prompt,
+            copy_documents(source_documents, drop_embedding=True),
+            copy_documents(retrieval_documents, drop_embedding=True), show_images or [])
+        self._entries.move_to_end((bucket, norm_question))
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        debug_logger.info(f"answer cache store: {norm_question}, size: {len(self._entries)}")
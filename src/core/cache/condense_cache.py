@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+import hashlib
+import json
+from collections import OrderedDict
+from typing import List, Optional
+
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+from src.configs.configs import CONDENSE_CACHE_MAX_SIZE, CONDENSE_CACHE_TTL
+from src.utils.log_handler import debug_logger
+
+
+class CondenseCache:
+    """
+    压缩后独立问题的缓存（进程内，LRU + TTL）
+
+    问题压缩的输出只取决于对话历史、新问题和模型，重试、重新生成同一轮时直接复用，不再调用LLM。
+    - 无会话id：键为 (用户, hash(完整对话历史, 问题, 模型))
+    - 有会话id：键为 (用户, 会话id, 轮次, hash(上一轮对话, 问题, 模型))，客户端不必逐字节回传相同的历史
+
+    有会话id时还会记录每一轮压缩后的独立问题（会话状态）。下一轮压缩时，上一轮的独立问题已经包含了
+    更早对话中的指代对象，只需把它和上一轮的回答交给LLM，不必再带上完整的对话历史
+    """
+
+    def __init__(self, max_size: int = CONDENSE_CACHE_MAX_SIZE, ttl: float = CONDENSE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (created, value)，value为压缩后的问题，或会话状态 (原问题, 压缩后的问题)
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def make_key(chat_history: List[List[str]], question: str, model: str, user_id: str,
+                 conversation_id: Optional[str] = None) -> str:
+        if conversation_id:
+            last_turn = chat_history[-1] if chat_history else None
+            raw = json.dumps([last_turn, question, model], ensure_ascii=False)
+            return f"{user_id}|{conversation_id}|{len(chat_history)}|{hashlib.md5(raw.encode('utf-8')).hexdigest()}"
+        raw = json.dumps([chat_history, question, model], ensure_ascii=False)
+        return f"{user_id}|{hashlib.md5(raw.encode('utf-8')).hexdigest()}"
+
+    @staticmethod
+    def make_turn_key(user_id: str, conversation_id: str, turn: int) -> str:
+        return f"turn|{user_id}|{conversation_id}|{turn}"
+
+    def _get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        created, value = entry
+        if time.time() - created > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _put(self, key: str, value):
+        self._entries[key] = (time.time(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        condense_question = self._get(key)
+        if condense_question is not None:
+            debug_logger.info(f"condense cache hit: {key} -> {condense_question}")
+        return condense_question
+
+    def put(self, key: str, condense_question: str):
+        if not condense_question:
+            return
+        self._put(key, condense_question)
+
+    def remember_turn(self, user_id: str, conversation_id: str, turn: int, question: str, condense_question: str):
+        """
+        记录会话第turn轮（从0开始）的原问题和压缩后的独立问题
+        """
+        if not conversation_id or not condense_question:
+            return
+        self._put(self.make_turn_key(user_id, conversation_id, turn), (question, condense_question))
+
+    def previous_turn(self, user_id: str, conversation_id: str, chat_history: List[List[str]]) -> Optional[str]:
+        """
+        返回上一轮压缩后的独立问题；客户端回传的上一轮问题与记录的不一致（如编辑了历史）时返回None
+        """
+        if not conversation_id or not chat_history:
+            return None
+        state = self._get(self.make_turn_key(user_id, conversation_id, len(chat_history) - 1))
+        if state is None or state[0] != chat_history[-1][0]:
+            return None
+        return state[1]
@@ -0,0 +1,129 @@
+import os
+import sys
+import asyncio
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+from src.configs.configs import FAQ_INDEX_SIMILARITY_THRESHOLD
+from src.client.embedding.embedding_client import SBIEmbeddings
+from src.client.database.mysql.mysql_client import MysqlClient
+from src.utils.log_handler import debug_logger
+from src.utils.general_utils import normalize_question
+from langchain.schema import Document
+
+
+class KbFaqs:
+    """
+    单个知识库的FAQ索引：归一化问题 -> 下标的哈希表，加上问题向量矩阵
+    """
+    __slots__ = ('kb_id', 'version', 'faqs', 'exact', 'matrix')
+
+    def __init__(self, kb_id, version, faqs, exact, matrix):
+        self.kb_id = kb_id
+        self.version = version
+        # [(faq_id, question, answer, nos_keys, file_name)]
+        self.faqs = faqs
+        self.exact = exact
+        self.matrix = matrix
+
+
+class FaqIndex:
+    """
+    进程内FAQ索引，在向量检索之前直接匹配FAQ问题
+
+    - 精确匹配：归一化后的问题哈希查找
+    - 语义匹配：问题向量与FAQ问题向量的余弦相似度超过阈值即命中
+    - 刷新：KnowledgeBase.faq_version变化时（FAQ入库完成、删除）查询前重新加载，普通文件的增删不会触发；
+      已经计算过的FAQ问题向量按faq_id复用，只对新增的问题调用embedding服务
+    - FAQ版本由调用方每个请求查询一次后传入，加载FAQ的mysql查询在线程池中执行，不阻塞事件循环
+    """
+
+    def __init__(self, embeddings: SBIEmbeddings, mysql_client: MysqlClient,
+                 similarity_threshold: float = FAQ_INDEX_SIMILARITY_THRESHOLD):
+        self.embeddings = embeddings
+        self.mysql_client = mysql_client
+        self.similarity_threshold = similarity_threshold
+        self._kbs: Dict[str, KbFaqs] = {}
+        # faq_id -> 问题向量
+        self._embeddings: Dict[str, List[float]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def refresh(self, kb_id: str, version):
+        """
+        从Faqs表重新加载一个知识库的FAQ，version为该知识库当前的faq_version
+        """
+        async with self._locks.setdefault(kb_id, asyncio.Lock()):
+            rows = await asyncio.get_running_loop().run_in_executor(
+                None, self.mysql_client.get_faqs_by_kb_ids, [kb_id])
+            faqs = [(faq_id, question, answer, nos_keys, file_name)
+                    for faq_id, _, question, answer, nos_keys, file_name in rows]
+            missing = [faq for faq in faqs if faq[0] not in self._embeddings]
+            if missing:
+                vectors = await self.embeddings.aembed_documents(
+                    [normalize_question(faq[1]) for faq in missing])
+                for faq, vector in zip(missing, vectors):
+                    self._embeddings[faq[0]] = vector
+            # 旧版本中已被删除的FAQ不再保留向量
+            old = self._kbs.get(kb_id)
+            if old is not None:
+                current_ids = {faq[0] for faq in faqs}
+                for faq in old.faqs:
+                    if faq[0] not in current_ids:
+                        self._embeddings.pop(faq[0], None)
+
+            exact = {}
+            for i, faq in enumerate(faqs):
+                exact.setdefault(normalize_question(faq[1]), i)
+            matrix = np.asarray([self._embeddings[faq[0]] for faq in faqs], dtype=np.float32) if faqs else None
+            self._kbs[kb_id] = KbFaqs(kb_id, version, faqs, exact, matrix)
+            debug_logger.info(f"faq index refreshed, kb_id: {kb_id}, version: {version}, faqs num: {len(faqs)}, "
+                              f"new embeddings: {len(missing)}")
+
+    async def _ensure_loaded(self, kb_ids: List[str], versions: Dict[str, int]) -> List[KbFaqs]:
+        for kb_id in kb_ids:
+            kb_faqs = self._kbs.get(kb_id)
+            if kb_faqs is None or kb_faqs.version != versions.get(kb_id):
+                await self.refresh(kb_id, versions.get(kb_id))
+        return [self._kbs[kb_id] for kb_id in kb_ids if kb_id in self._kbs]
+
+    async def match(self, kb_ids: List[str], question: str, versions: Dict[str, int]) -> Optional[Document]:
+        """
+        匹配FAQ，命中时返回FAQ对应的Document（metadata中带faq_dict和score），否则返回None
+        versions: {kb_id: faq_version}
+        """
+        kb_faqs_list = [kb_faqs for kb_faqs in await self._ensure_loaded(kb_ids, versions) if kb_faqs.faqs]
+        if not kb_faqs_list:
+            return None
+        norm_question = normalize_question(question)
+        for kb_faqs in kb_faqs_list:
+            if norm_question in kb_faqs.exact:
+                debug_logger.info(f"faq index exact hit: {norm_question}")
+                return self._to_document(kb_faqs, kb_faqs.exact[norm_question], 1.0)
+
+        # 向量已做L2归一化，点积即余弦相似度
+        embedding = np.asarray(await self.embeddings.aembed_query(norm_question), dtype=np.float32)
+        best_kb, best_index, best_score = None, -1, -1.0
+        for kb_faqs in kb_faqs_list:
+            scores = kb_faqs.matrix @ embedding
+            index = int(np.argmax(scores))
+            if scores[index] > best_score:
+                best_kb, best_index, best_score = kb_faqs, index, float(scores[index])
+        if best_score >= self.similarity_threshold:
+            debug_logger.info(f"faq index semantic hit: {norm_question} -> {best_kb.faqs[best_index][1]}, "
+                              f"similarity: {best_score:.4f}")
+            return self._to_document(best_kb, best_index, best_score)
+        return None
+
+    @staticmethod
+    def _to_document(kb_faqs: KbFaqs, index: int, score: float) -> Document:
+        faq_id, question, answer, nos_keys, file_name = kb_faqs.faqs[index]
+        metadata = {'file_id': faq_id, 'file_name': file_name, 'kb_id': kb_faqs.kb_id, 'score': round(score, 4),
+                    'nos_keys': nos_keys or '', 'retrieval_source': 'faq_index',
+                    'faq_dict': {'question': question, 'answer': answer, 'nos_keys': nos_keys}}
+        return Document(page_content=question, metadata=metadata)
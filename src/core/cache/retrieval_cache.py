@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+from src.configs.configs import RETRIEVAL_CACHE_MAX_SIZE, RETRIEVAL_CACHE_TTL
+from src.utils.log_handler import debug_logger
+from langchain.schema import Document
+
+
+def copy_documents(docs: List[Document], drop_embedding: bool = False) -> List[Document]:
+    # 后续流程会修改page_content和metadata（如替换图片引用），缓存里保存和取出的都是副本
+    # drop_embedding: 去掉milvus返回的chunk向量（768个float，约25KB/文档），写入缓存时使用
+    if drop_embedding:
+        return [Document(page_content=doc.page_content,
+                         metadata={k: v for k, v in doc.metadata.items() if k != 'embedding'}) for doc in docs]
+    return [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in docs]
+
+
+def kb_content_version(kb_versions: Dict[str, tuple], kb_ids: List[str]) -> tuple:
+    # 从 MysqlClient.get_kb_versions 的结果中取出这些kb_ids的内容版本，作为检索缓存和问答缓存条目的版本
+    return tuple((kb_id, kb_versions[kb_id][0] if kb_id in kb_versions else None) for kb_id in sorted(kb_ids))
+
+
+class RetrievalCache:
+    """
+    检索+rerank结果缓存（进程内，LRU + TTL）
+
+    相同的检索问题、rerank问题和kb_ids，在知识库内容不变时检索+rerank的结果是确定的，
+    重试和重新生成时可以直接复用，跳过milvus、es和rerank服务。
+    知识库内容版本(KnowledgeBase.content_version)由入库服务在每个文件处理完成后递增，
+    由调用方每个请求查询一次后传入。
+    """
+
+    def __init__(self, max_size: int = RETRIEVAL_CACHE_MAX_SIZE, ttl: float = RETRIEVAL_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (created, kb_version, documents)
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def make_key(kb_ids: List[str], retrieval_query: str, rerank_query: str, top_k: int,
+                 hybrid_search: bool, rerank: bool) -> str:
+        query_hash = hashlib.md5(json.dumps([retrieval_query, rerank_query], ensure_ascii=False).encode('utf-8')).hexdigest()
+        return f"{','.join(sorted(kb_ids))}|{query_hash}|{top_k}|{int(bool(hybrid_search))}|{int(bool(rerank))}"
+
+    def get(self, key: str, kb_version) -> Optional[List[Document]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        created, entry_version, docs = entry
+        if time.time() - created > self.ttl or entry_version != kb_version:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        debug_logger.info(f"retrieval cache hit: {key}, docs num: {len(docs)}")
+        return copy_documents(docs)
+
+    def put(self, key: str, kb_version, docs: List[Document]):
+        # 不缓存chunk向量，命中后挑选相关图片时缺少向量的文档会与回答一起重新计算
+        self._entries[key] = (time.time(), kb_version, copy_documents(docs, drop_embedding=True))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
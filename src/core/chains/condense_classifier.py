@@ -0,0 +1,136 @@
+import os
+import re
+import sys
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+from src.configs.configs import CONDENSE_CLASSIFIER_MODEL_PATH
+from src.utils.log_handler import debug_logger
+
+# 指代、省略的中文标记：代词、指示词、承接上文的词
+ZH_REFERENCE_PATTERN = re.compile(
+    r'它|他|她|这|那|上面|上述|前面|刚才|刚刚|之前|以上|其中|(?<!应)该|此|同样|还有|另外|继续|详细|展开|再')
+# 英文代词、指示词（按单词匹配）
+EN_REFERENCE_PATTERN = re.compile(
+    r'\b(it|its|they|them|their|this|that|these|those|he|she|him|her|above|previous|former|latter|same|'
+    r'also|else|more|again|there|one|ones)\b', re.IGNORECASE)
+# 以连接词开头的追问，如"那后天呢"、"and what about Arc"
+ELLIPSIS_PREFIX_PATTERN = re.compile(
+    r'^(那|还有|然后|所以|但是|and\b|but\b|so\b|then\b|or\b|what about\b|how about\b|why\b)', re.IGNORECASE)
+CJK_PATTERN = re.compile(r'[\u4e00-\u9fff]')
+# 短于该长度的问题信息不足，默认需要压缩（中文按字数，英文按单词数）
+ZH_MIN_CHARS = 8
+EN_MIN_WORDS = 5
+# 每处理多少次输出一次跳过率
+LOG_INTERVAL = 100
+
+
+class CondenseClassifier:
+    """
+    判断多轮对话中的新问题是否需要结合对话历史压缩成独立问题
+
+    - 规则：含代词、指示词、承接词，以连接词开头或以"呢"结尾，或问题过短时需要压缩；
+      其余较长、具体的问题本身就是独立问题，跳过压缩的LLM调用
+    - 可选：配置了CONDENSE_CLASSIFIER_MODEL_PATH时，规则未命中的问题交给小分类模型复核，
+      输入为 (上一轮问题, 新问题)，标签 LABEL_1/NEED 表示需要压缩
+    - 误判为需要压缩只多一次LLM调用，因此规则偏保守
+    异步接口aneeds_condense中模型的加载和推理在单独的线程中执行，不阻塞事件循环
+    """
+
+    def __init__(self, model_path: Optional[str] = CONDENSE_CLASSIFIER_MODEL_PATH):
+        self.model_path = model_path
+        self._model = None
+        self._model_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='condense_classifier')
+        self.total = 0
+        self.skipped = 0
+        self.model_calls = 0
+
+    @staticmethod
+    def rule_check(question: str) -> Tuple[Optional[bool], str]:
+        """
+        规则判断，返回 (是否需要压缩, 原因)，规则无法确定时返回 (None, 'standalone')
+        """
+        question = question.strip()
+        if ELLIPSIS_PREFIX_PATTERN.search(question) or question.rstrip('?？。.!！ ').endswith('呢'):
+            return True, 'ellipsis'
+        if CJK_PATTERN.search(question):
+            if ZH_REFERENCE_PATTERN.search(question):
+                return True, 'reference'
+            if len(question) < ZH_MIN_CHARS:
+                return True, 'short'
+        else:
+            if EN_REFERENCE_PATTERN.search(question):
+                return True, 'reference'
+            if len(question.split()) < EN_MIN_WORDS:
+                return True, 'short'
+        return None, 'standalone'
+
+    def _get_model(self):
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    from transformers import pipeline
+                    self._model = pipeline('text-classification', model=self.model_path, device=-1)
+                    debug_logger.info(f"condense classifier model loaded: {self.model_path}")
+        return self._model
+
+    def model_check(self, question: str, chat_history: List[List[str]]) -> bool:
+        self.model_calls += 1
+        result = self._get_model()({'text': chat_history[-1][0], 'text_pair': question})
+        if isinstance(result, list):
+            result = result[0]
+        return result['label'].upper() in ('LABEL_1', 'NEED')
+
+    def _record(self, need: bool):
+        self.total += 1
+        if not need:
+            self.skipped += 1
+        if self.total % LOG_INTERVAL == 0:
+            debug_logger.info(f"condense skipped: {self.skipped}/{self.total} "
+                              f"({self.skipped / self.total:.1%}), model calls: {self.model_calls}")
+
+    def needs_condense(self, question: str, chat_history: List[List[str]]) -> Tuple[bool, str]:
+        """
+        返回 (是否需要压缩, 原因)，并更新跳过次数的统计
+        """
+        if not chat_history:
+            return False, 'no_history'
+        need, reason = self.rule_check(question)
+        if need is None:
+            need = False
+            if self.model_path:
+                try:
+                    need = self.model_check(question, chat_history)
+                    reason = 'model'
+                except Exception as e:
+                    # 模型不可用时按规则结果处理
+                    debug_logger.error(f"condense classifier model error: {e}")
+        self._record(need)
+        return need, reason
+
+    async def aneeds_condense(self, question: str, chat_history: List[List[str]]) -> Tuple[bool, str]:
+        """
+        needs_condense的异步版本：规则在事件循环上判断，需要模型复核时在线程池中加载和推理
+        """
+        if not chat_history:
+            return False, 'no_history'
+        need, reason = self.rule_check(question)
+        if need is None:
+            need = False
+            if self.model_path:
+                try:
+                    need = await asyncio.get_running_loop().run_in_executor(
+                        self.executor, self.model_check, question, chat_history)
+                    reason = 'model'
+                except Exception as e:
+                    debug_logger.error(f"condense classifier model error: {e}")
+        self._record(need)
+        return need, reason
@@ -0,0 +1,141 @@
+import os
+import sys
+import asyncio
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+from src.configs.configs import HISTORY_SUMMARY_ENABLED, HISTORY_SUMMARY_MAX_SIZE
+from src.utils.log_handler import debug_logger
+from langchain.schema.messages import AIMessage, HumanMessage, SystemMessage
+
+# 每条消息在prompt中的格式开销（角色名、换行等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PROMPT = """请把下面的对话历史压缩成一段简短的摘要（不超过200字），保留对话中提到的实体、名词、数字和用户关心的问题，不要添加对话中没有的信息。
+{previous_summary}
+对话历史：
+{history}
+
+摘要："""
+
+
+class HistoryWindow:
+    """
+    问题压缩前的对话历史窗口
+
+    - 每轮对话只计算一次token数，从最新一轮往前一次遍历，保留预算内最长的后缀
+    - 可选：被丢弃的前缀在后台用LLM生成摘要，同一对话的下一轮直接复用摘要。
+      摘要按前缀内容的哈希保存，前缀变长时在已有摘要的基础上增量生成
+    """
+
+    def __init__(self, summary_enabled: bool = HISTORY_SUMMARY_ENABLED, max_size: int = HISTORY_SUMMARY_MAX_SIZE):
+        self.summary_enabled = summary_enabled
+        self.max_size = max_size
+        # 前缀哈希 -> 摘要
+        self._summaries = OrderedDict()
+        # 正在生成的摘要任务，保留引用避免被回收
+        self._tasks = {}
+
+    @staticmethod
+    def prefix_hashes(chat_history: List[List[str]]) -> List[str]:
+        # 第i个元素是前i+1轮对话的哈希
+        hashes = []
+        md5 = hashlib.md5()
+        for turn in chat_history:
+            md5.update(json.dumps(turn, ensure_ascii=False).encode('utf-8'))
+            hashes.append(md5.copy().hexdigest())
+        return hashes
+
+    @staticmethod
+    def count_turn_tokens(chat_history: List[List[str]], count_tokens: Callable[[str], int]) -> List[int]:
+        return [count_tokens(turn[0]) + count_tokens(turn[1]) + 2 * MESSAGE_OVERHEAD_TOKENS for turn in chat_history]
+
+    @staticmethod
+    def select(chat_history: List[List[str]], turn_tokens: List[int],
+               budget: int) -> Tuple[List[List[str]], List[List[str]]]:
+        """
+        返回 (保留的最近若干轮, 被丢弃的更早的轮次)，保留部分的token数不超过budget
+        """
+        used = 0
+        start = len(chat_history)
+        for i in range(len(chat_history) - 1, -1, -1):
+            if used + turn_tokens[i] > budget:
+                break
+            used += turn_tokens[i]
+            start = i
+        return chat_history[start:], chat_history[:start]
+
+    def get_summary(self, dropped: List[List[str]]) -> Tuple[Optional[str], int]:
+        """
+        查找覆盖被丢弃前缀最长的已有摘要，返回 (摘要, 摘要覆盖的轮数)
+        """
+        if not dropped or not self._summaries:
+            return None, 0
+        hashes = self.prefix_hashes(dropped)
+        for n in range(len(hashes), 0, -1):
+            summary = self._summaries.get(hashes[n - 1])
+            if summary is not None:
+                self._summaries.move_to_end(hashes[n - 1])
+                return summary, n
+        return None, 0
+
+    def schedule_summary(self, dropped: List[List[str]], previous_summary: Optional[str], covered: int, chat_model):
+        """
+        后台生成被丢弃前缀的摘要，供同一对话的后续轮次使用
+        """
+        if not self.summary_enabled or not dropped or covered >= len(dropped):
+            return
+        key = self.prefix_hashes(dropped)[-1]
+        if key in self._summaries or key in self._tasks:
+            return
+        task = asyncio.create_task(self._summarize(key, dropped[covered:], previous_summary, chat_model))
+        self._tasks[key] = task
+        task.add_done_callback(lambda _: self._tasks.pop(key, None))
+
+    async def _summarize(self, key: str, turns: List[List[str]], previous_summary: Optional[str], chat_model):
+        try:
+            history = '\n'.join(f"用户：{question}\n助手：{answer}" for question, answer in turns)
+            prompt = SUMMARY_PROMPT.format(
+                previous_summary=f"更早对话的摘要：{previous_summary}" if previous_summary else "",
+                history=history)
+            response = await chat_model.ainvoke([HumanMessage(content=prompt)])
+            self._summaries[key] = response.content.strip()
+            while len(self._summaries) > self.max_size:
+                self._summaries.popitem(last=False)
+            debug_logger.info(f"history summary generated, turns: {len(turns)}, summary: {self._summaries[key]}")
+        except Exception as e:
+            debug_logger.error(f"history summary error: {e}")
+
+    def build_messages(self, chat_history: List[List[str]], count_tokens: Callable[[str], int], budget: int,
+                       chat_model=None) -> Tuple[list, int]:
+        """
+        构造问题压缩使用的对话历史消息，返回 (消息列表, 保留的轮数)
+        有可复用的摘要时放在最前面（SystemMessage），摘要占用的token从预算中扣除
+        """
+        # 每轮对话只计算一次token数
+        turn_tokens = self.count_turn_tokens(chat_history, count_tokens)
+        kept, dropped = self.select(chat_history, turn_tokens, budget)
+        messages = []
+        if dropped and self.summary_enabled:
+            summary, covered = self.get_summary(dropped)
+            if summary is not None:
+                summary_content = f"更早对话的摘要：{summary}"
+                summary_tokens = count_tokens(summary_content) + MESSAGE_OVERHEAD_TOKENS
+                if summary_tokens < budget:
+                    # 重新选择窗口只会丢弃更多轮次，摘要覆盖的前covered轮仍然有效
+                    kept, dropped = self.select(chat_history, turn_tokens, budget - summary_tokens)
+                    messages.append(SystemMessage(content=summary_content))
+                else:
+                    summary, covered = None, 0
+            if chat_model is not None:
+                self.schedule_summary(dropped, summary, covered, chat_model)
+        for question, answer in kept:
+            messages += [HumanMessage(content=question), AIMessage(content=answer)]
+        return messages, len(kept)
@@ -0,0 +1,41 @@
+import os
+import sys
+from typing import Optional
+
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+from langchain.docstore.document import Document
+
+# 子块写入milvus/es时保留的元数据字段，其余字段（title_lst/has_table/images/file_name/nos_key/page_id）只保存在父块中
+INDEX_METADATA_KEYS = ('user_id', 'kb_id', 'file_id', 'headers', 'faq_dict')
+
+
+class Chunk:
+    """
+    切分后的子块，代替从Document deepcopy出来再删除字段的副本
+    - page_content: 直接引用切分得到的字符串
+    - metadata: 索引元数据，即 INDEX_METADATA_KEYS 和父块编号doc_id，值与父块共享引用
+    - display_metadata: 展示元数据，即父块完整的metadata，不复制
+    与Document一样有page_content/metadata属性，向量化和写milvus时可以直接使用，写es时用to_document()转换
+    """
+    __slots__ = ('page_content', 'metadata', 'display_metadata')
+
+    def __init__(self, page_content: str, metadata: dict, display_metadata: Optional[dict] = None):
+        self.page_content = page_content
+        self.metadata = metadata
+        self.display_metadata = display_metadata if display_metadata is not None else metadata
+
+    @classmethod
+    def from_parent(cls, page_content: str, parent: Document, doc_id: str) -> 'Chunk':
+        metadata = {key: parent.metadata[key] for key in INDEX_METADATA_KEYS if key in parent.metadata}
+        metadata['doc_id'] = doc_id
+        return cls(page_content, metadata, parent.metadata)
+
+    def to_document(self) -> Document:
+        # 只新建外层对象，page_content和metadata都不复制
+        return Document(page_content=self.page_content, metadata=self.metadata)
+
+    def __repr__(self):
+        return f"Chunk(page_content={self.page_content[:50]!r}, metadata={self.metadata})"
@@ -0,0 +1,89 @@
+import os
+import sys
+import hashlib
+from collections import deque
+from typing import List, Tuple
+
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+from src.core.file_handler.chunk import Chunk
+from langchain.docstore.document import Document
+
+# (父块内容哈希, doc_id, 子块es编号起点, 子块数)
+ChunkIndexRow = Tuple[str, str, int, int]
+
+
+def file_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def parent_hash(parent: Document, chunk_size: int) -> str:
+    # 子块的切分方式由父块内容和chunk_size决定，二者都不变时子块也不变
+    return hashlib.sha256(f"{chunk_size}\n{parent.page_content}".encode('utf-8')).hexdigest()
+
+
+class ChunkIndex:
+    """
+    一个文件已入库父块的内容哈希索引（FileChunks表），用于文件更新后增量入库
+
+    - 父块内容（及chunk_size）不变：沿用原来的doc_id，它的子块不再向量化和写入
+    - 新增或修改的父块：从已用的最大编号之后分配doc_id和子块es编号，只写入这部分
+    - 新版本中不再出现的父块（vanished）：入库完成后从milvus/es/Documents中删除
+    doc_id仍然是 file_id + '_' + 整数，新文件的编号与全量切分时一致
+    """
+    __slots__ = ('file_id', 'chunk_size', 'entries', 'next_parent', 'next_child', 'kept', 'added')
+
+    def __init__(self, file_id: str, chunk_size: int, rows: List[ChunkIndexRow] = ()):
+        self.file_id = file_id
+        self.chunk_size = chunk_size
+        # 同一文件中可能有内容完全相同的父块，同一哈希按顺序逐个匹配
+        self.entries = {}
+        self.next_parent = 0
+        self.next_child = 0
+        for row in rows:
+            self.entries.setdefault(row[0], deque()).append(row)
+            self.next_parent = max(self.next_parent, int(row[1].split('_')[-1]) + 1)
+            self.next_child = max(self.next_child, row[2] + row[3])
+        self.kept: List[ChunkIndexRow] = []
+        self.added: List[ChunkIndexRow] = []
+
+    def apply(self, docs: List[Chunk], full_docs: List[Tuple[str, Document]]) -> Tuple[List[Chunk], List[tuple]]:
+        """
+        过滤一批切分结果（split_docs的返回值），只返回需要写入的子块和父块，并为它们重新分配编号
+        返回的子块在es中的编号从调用前的next_child开始连续
+        """
+        children = {}
+        for doc in docs:
+            children.setdefault(doc.metadata['doc_id'], []).append(doc)
+        new_docs, new_full_docs = [], []
+        for doc_id, parent in full_docs:
+            chunk_hash = parent_hash(parent, self.chunk_size)
+            matched = self.entries.get(chunk_hash)
+            if matched:
+                self.kept.append(matched.popleft())
+                continue
+            sub_docs = children.get(doc_id, [])
+            new_id = self.file_id + '_' + str(self.next_parent)
+            self.next_parent += 1
+            for doc in sub_docs:
+                doc.metadata['doc_id'] = new_id
+            self.added.append((chunk_hash, new_id, self.next_child, len(sub_docs)))
+            self.next_child += len(sub_docs)
+            new_docs.extend(sub_docs)
+            new_full_docs.append((new_id, parent))
+        return new_docs, new_full_docs
+
+    def vanished(self) -> List[ChunkIndexRow]:
+        return [row for rows in self.entries.values() for row in rows]
+
+    def rows(self) -> List[ChunkIndexRow]:
+        return self.kept + self.added
+
+    @property
+    def chunks_number(self) -> int:
+        return len(self.kept) + len(self.added)
+
+    def es_ids(self, rows: List[ChunkIndexRow]) -> List[str]:
+        return [self.file_id + '_' + str(i) for row in rows for i in range(row[2], row[2] + row[3])]
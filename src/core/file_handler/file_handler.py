@@ -1,4 +1,3 @@
-import copy
 import os
 import sys
 current_script_path = os.path.abspath(__file__)
@@ -7,10 +6,10 @@ root_dir = os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))
 root_dir = os.path.dirname(root_dir)
 sys.path.append(root_dir)
 from src.utils.general_utils import get_time, num_tokens_embed, \
-     clear_string
-from typing import List
+     clear_string, embedding_tokenizer
+from typing import List, Iterable, Iterator
 from src.configs.configs import DEFAULT_CHILD_CHUNK_SIZE, \
-      UPLOAD_ROOT_PATH, SEPARATORS, DEFAULT_PARENT_CHUNK_SIZE
+      UPLOAD_ROOT_PATH, SEPARATORS, DEFAULT_PARENT_CHUNK_SIZE, MAX_CHARS, INGEST_STREAM_BATCH_PAGES
 from langchain.docstore.document import Document
 from src.utils.log_handler import insert_logger
 
@@ -18,6 +17,8 @@ from src.utils.log_handler import insert_logger
 from langchain_community.document_loaders import TextLoader, UnstructuredMarkdownLoader, Docx2txtLoader, UnstructuredPowerPointLoader, UnstructuredXMLLoader
 from langchain_community.document_loaders  import PyPDFLoader, UnstructuredImageLoader, UnstructuredHTMLLoader, UnstructuredURLLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from src.core.file_handler.token_splitter import TokenAwareSplitter
+from src.core.file_handler.chunk import Chunk
 import uuid
 import threading
 import re
@@ -28,11 +29,12 @@ import chardet
 
 # TODO同名文件直接覆盖
 class LocalFile:
-    def __init__(self, user_id, kb_id, file, file_name):
+    def __init__(self, user_id, kb_id, file, file_name, file_id=None):
         self.user_id = user_id
         self.kb_id = kb_id
         self.file_name = file_name
-        self.file_id = uuid.uuid4().hex
+        # 增量更新时沿用原文件的file_id，新版本保存在原文件的目录下
+        self.file_id = file_id or uuid.uuid4().hex
         self.file_url = ""
         if isinstance(file, Dict):
             self.file_location = "FAQ"
@@ -55,8 +57,8 @@ class LocalFile:
             file_dir = os.path.join(upload_path, self.kb_id, self.file_id)
             os.makedirs(file_dir, exist_ok=True)
             self.file_location = os.path.join(file_dir, self.file_name)
-            #  如果文件不存在：
-            if not os.path.exists(self.file_location):
+            #  如果文件不存在，或者是更新已有文件的新版本：
+            if file_id or not os.path.exists(self.file_location):
                 with open(self.file_location, 'wb') as f:
                     f.write(self.file_content)
 
@@ -258,78 +260,125 @@ class FileHandler:
         self.inject_metadata(docs)
 
     def inject_metadata(self, docs: List[Document]):
-        # 这里给每个docs片段的metadata里注入file_id
-        new_docs = []
-        for doc in docs:
-            page_content = re.sub(r'\t+', ' ', doc.page_content)  # 将制表符替换为单个空格
-            page_content = re.sub(r'\n{3,}', '\n\n', page_content)  # 将三个或更多换行符替换为两个
-            page_content = page_content.strip()  # 去除首尾空白字符
-            new_doc = Document(page_content=page_content)
-            new_doc.metadata["user_id"] = self.user_id
-            new_doc.metadata["kb_id"] = self.kb_id
-            new_doc.metadata["file_id"] = self.file_id
-            new_doc.metadata["file_name"] = self.file_name
-            new_doc.metadata["nos_key"] = self.file_location
-            new_doc.metadata["title_lst"] = doc.metadata.get("title_lst", [])
-            new_doc.metadata["page_id"] = doc.metadata.get("page_id", 0)
-            new_doc.metadata["has_table"] = doc.metadata.get("has_table", False)
-            new_doc.metadata["images"] = re.findall(r'!\[figure]\(\d+-figure-\d+.jpg.*?\)', page_content)
-            metadata_infos = {"知识库名": self.kb_name, '文件名': self.file_name}
-            new_doc.metadata['headers'] = metadata_infos
-
-            if 'faq_dict' not in doc.metadata:
-                new_doc.metadata['faq_dict'] = {}
-            else:
-                new_doc.metadata['faq_dict'] = doc.metadata['faq_dict']
-            new_docs.append(new_doc)
-        if new_docs:
-            insert_logger.info('langchain analysis content head: %s', new_docs[0].page_content[:100])
+        # 这里给每个docs片段的metadata里注入file_id，并合并短的document
+        insert_logger.info(f"before merge doc lens: {len(docs)}")
+        merged_docs = list(self.iter_merged_docs(docs))
+        if merged_docs:
+            insert_logger.info('langchain analysis content head: %s', merged_docs[0].page_content[:100])
         else:
             insert_logger.info('langchain analysis docs is empty!')
+        insert_logger.info(f"after merge doc lens: {len(merged_docs)}")
+        self.docs = merged_docs
+
+    def build_doc(self, doc: Document) -> Document:
+        page_content = re.sub(r'\t+', ' ', doc.page_content)  # 将制表符替换为单个空格
+        page_content = re.sub(r'\n{3,}', '\n\n', page_content)  # 将三个或更多换行符替换为两个
+        page_content = page_content.strip()  # 去除首尾空白字符
+        new_doc = Document(page_content=page_content)
+        new_doc.metadata["user_id"] = self.user_id
+        new_doc.metadata["kb_id"] = self.kb_id
+        new_doc.metadata["file_id"] = self.file_id
+        new_doc.metadata["file_name"] = self.file_name
+        new_doc.metadata["nos_key"] = self.file_location
+        new_doc.metadata["title_lst"] = doc.metadata.get("title_lst", [])
+        new_doc.metadata["page_id"] = doc.metadata.get("page_id", 0)
+        new_doc.metadata["has_table"] = doc.metadata.get("has_table", False)
+        new_doc.metadata["images"] = re.findall(r'!\[figure]\(\d+-figure-\d+.jpg.*?\)', page_content)
+        metadata_infos = {"知识库名": self.kb_name, '文件名': self.file_name}
+        new_doc.metadata['headers'] = metadata_infos
+
+        if 'faq_dict' not in doc.metadata:
+            new_doc.metadata['faq_dict'] = {}
+        else:
+            new_doc.metadata['faq_dict'] = doc.metadata['faq_dict']
+        return new_doc
 
-        # 合并短的document
-        insert_logger.info(f"before merge doc lens: {len(new_docs)}")
+    def iter_merged_docs(self, docs: Iterable[Document]) -> Iterator[Document]:
+        """
+        注入metadata并合并短的document，逐个产出合并完成的document
+        docs可以是生成器（如逐页加载的PDF），只有遇到不能再合并的下一个document时才产出上一个
+        """
         child_chunk_size = min(DEFAULT_CHILD_CHUNK_SIZE, int(self.chunk_size / 2))
-        merged_docs = []
-        for doc in new_docs:
-            if not merged_docs:
-                merged_docs.append(doc)
+        # 合并后文档的token数由各部分累加得到，不再对越来越长的last_doc反复编码
+        special_tokens = num_tokens_embed('')
+        last_doc = None
+        last_tokens = 0
+        for doc in docs:
+            doc = self.build_doc(doc)
+            doc_tokens = num_tokens_embed(doc.page_content)
+            if last_doc is None:
+                last_doc, last_tokens = doc, doc_tokens
+            elif last_tokens + doc_tokens <= child_chunk_size or doc_tokens < child_chunk_size / 4:
+                tmp_content_slices = doc.page_content.split('\n')
+                tmp_content_slices_clear = [line for line in tmp_content_slices if clear_string(line) not in
+                                            [clear_string(t) for t in last_doc.metadata['title_lst']]]
+                tmp_content = '\n'.join(tmp_content_slices_clear)
+                if tmp_content != doc.page_content:
+                    doc_tokens = num_tokens_embed(tmp_content)
+                last_tokens += doc_tokens - special_tokens
+                last_doc.page_content += '\n\n' + tmp_content
+                last_doc.metadata['title_lst'] += doc.metadata.get('title_lst', [])
+                last_doc.metadata['has_table'] = last_doc.metadata.get('has_table', False) or doc.metadata.get(
+                    'has_table', False)
+                last_doc.metadata['images'] += doc.metadata.get('images', [])
             else:
-                last_doc = merged_docs[-1]
-                if num_tokens_embed(last_doc.page_content) + num_tokens_embed(doc.page_content) <= child_chunk_size or \
-                        num_tokens_embed(doc.page_content) < child_chunk_size / 4:
-                    tmp_content_slices = doc.page_content.split('\n')
-                    tmp_content_slices_clear = [line for line in tmp_content_slices if clear_string(line) not in
-                                                [clear_string(t) for t in last_doc.metadata['title_lst']]]
-                    tmp_content = '\n'.join(tmp_content_slices_clear)
-                    last_doc.page_content += '\n\n' + tmp_content
-                    last_doc.metadata['title_lst'] += doc.metadata.get('title_lst', [])
-                    last_doc.metadata['has_table'] = last_doc.metadata.get('has_table', False) or doc.metadata.get(
-                        'has_table', False)
-                    last_doc.metadata['images'] += doc.metadata.get('images', [])
-                else:
-                    merged_docs.append(doc)
-        insert_logger.info(f"after merge doc lens: {len(merged_docs)}")
-        self.docs = merged_docs
-    
-    # TODO：可以异步进行
+                yield last_doc
+                last_doc, last_tokens = doc, doc_tokens
+        if last_doc is not None:
+            yield last_doc
+
+    def iter_pdf_batches(self, batch_docs: int = INGEST_STREAM_BATCH_PAGES,
+                         max_chars: int = MAX_CHARS) -> Iterator[Tuple[int, List[Chunk], List[tuple]]]:
+        """
+        逐页加载PDF，每凑够batch_docs个合并后的document就切分一次，产出 (累计content_length, 子块docs, 父块full_docs)
+        - 内存中只保留当前批次的页面和chunk，不需要先把整个PDF加载完
+        - 父块编号在批次之间连续，与一次性split_docs的结果一致
+        - 累计content_length超过max_chars时停止解析，产出一个空批次，由调用方按content_length标记失败
+        """
+        loader = PyPDFLoader(self.file_location)
+        content_length = 0
+        parent_offset = 0
+        batch = []
+        for doc in self.iter_merged_docs(loader.lazy_load()):
+            content_length += len(doc.page_content)
+            if content_length > max_chars:
+                insert_logger.warning(f"stop parsing {self.file_name}, content_length exceeds {max_chars}")
+                yield content_length, [], []
+                return
+            batch.append(doc)
+            if len(batch) >= batch_docs:
+                docs, full_docs = self.split_docs(batch, self.chunk_size, parent_offset)
+                parent_offset += len(full_docs)
+                batch = []
+                yield content_length, docs, full_docs
+        if batch:
+            docs, full_docs = self.split_docs(batch, self.chunk_size, parent_offset)
+            yield content_length, docs, full_docs
+
     @staticmethod
-    def split_docs(docs: List[Document], parent_chunk_size=DEFAULT_PARENT_CHUNK_SIZE):
-        # parent chunk size 默认是800
-        parent_splitter = RecursiveCharacterTextSplitter(
+    def build_splitter(chunk_size: int, chunk_overlap: int):
+        """
+        按token数切分的splitter，embedding的tokenizer支持offset_mapping时每个文档只编码一次
+        """
+        if embedding_tokenizer.is_fast:
+            return TokenAwareSplitter(chunk_size, chunk_overlap, SEPARATORS, embedding_tokenizer)
+        return RecursiveCharacterTextSplitter(
             separators=SEPARATORS,
-            chunk_size=parent_chunk_size,
-            chunk_overlap=0,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
             length_function=num_tokens_embed)
+
+    # TODO：可以异步进行
+    @staticmethod
+    def split_docs(docs: List[Document], parent_chunk_size=DEFAULT_PARENT_CHUNK_SIZE,
+                   parent_offset=0) -> Tuple[List[Chunk], List[Tuple[str, Document]]]:
+        # parent chunk size 默认是800
+        parent_splitter = FileHandler.build_splitter(parent_chunk_size, 0)
         # # This text splitter is used to create the child documents
         # # It should create documents smaller than the parent
         # child chunk size 默认是400 其中重叠部分长度为 100
         child_chunk_size = min(DEFAULT_CHILD_CHUNK_SIZE, int(parent_chunk_size / 2))
-        child_splitter = RecursiveCharacterTextSplitter(
-            separators=SEPARATORS,
-            chunk_size=child_chunk_size,
-            chunk_overlap=int(child_chunk_size / 3),
-            length_function=num_tokens_embed)
+        child_splitter = FileHandler.build_splitter(child_chunk_size, int(child_chunk_size / 3))
         # 先处理父文档，父文档没有重叠部分每一个都是单独的
         # documents = self.parent_splitter.split_documents(documents)
         split_documents = []
@@ -350,7 +399,8 @@ class FileHandler:
             split_documents.extend(parent_splitter.split_documents(need_split_docs))
         insert_logger.info(f"Inserting {len(split_documents)} parent documents")
         file_id = split_documents[0].metadata['file_id']
-        doc_ids = [file_id + '_' + str(i) for i, _ in enumerate(split_documents)]
+        # parent_offset用于分批切分同一个文件时保持父块编号连续
+        doc_ids = [file_id + '_' + str(parent_offset + i) for i, _ in enumerate(split_documents)]
         # 是否加入全文数据库中
         # if not add_to_docstore:
         #     raise ValueError(
@@ -360,29 +410,16 @@ class FileHandler:
         full_documents = []
         for i, doc in enumerate(split_documents):
             _id = doc_ids[i]
-            sub_docs = child_splitter.split_documents([doc])
-            for _doc in sub_docs:
-                # 为每个子片段添加主片段id
-                _doc.metadata["doc_id"] = _id
-                # _doc.page_content = f"[headers]({_doc.metadata['headers']})\n" + _doc.page_content  # 存入page_content，向量检索时会带上headers
-            documents.extend(sub_docs)
+            # 子块只保留索引元数据并引用父块的metadata，不再对每个子块deepcopy元数据
+            documents.extend(Chunk.from_parent(text, doc, _id) for text in child_splitter.split_text(doc.page_content))
             # TODO: 先不加下面的，后面要用再说
             # doc.page_content = f"[headers]({doc.metadata['headers']})\n" + doc.page_content  # 存入page_content，等检索后rerank时会带上headers信息
             # 用来存储每个完整的片段
             full_documents.append((_id, doc))
         insert_logger.info(f"Inserting {len(documents)} child documents, metadata: {documents[0].metadata}, page_content: {docs[0].page_content[:100]}...")
-        embed_documents = copy.deepcopy(documents)
-        # 补充metadata信息
-        for doc in embed_documents:
-            del doc.metadata['title_lst']
-            del doc.metadata['has_table']
-            del doc.metadata['images']
-            del doc.metadata['file_name']
-            del doc.metadata['nos_key']
-            del doc.metadata['page_id']
         # full_documents用来记录每一个父片段
         # 返回可以通用
-        return embed_documents, full_documents
+        return documents, full_documents
 
 
 
@@ -0,0 +1,178 @@
+import os
+import sys
+import asyncio
+import multiprocessing
+import time
+import traceback
+from typing import List, Tuple, AsyncIterator
+
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+from src.configs.configs import MAX_CHARS, INGEST_PARSE_WORKERS, INGEST_PARSE_TIMEOUT, INGEST_PARSE_MEMORY_LIMIT_MB, \
+    INGEST_STREAM_BATCH_PAGES
+from src.utils.log_handler import insert_logger
+from src.core.file_handler.chunk import Chunk
+
+
+class ParseError(Exception):
+    """
+    文件解析失败，message 会写入File表的msg字段
+    """
+    pass
+
+
+def _set_memory_limit(memory_limit_mb: int):
+    if memory_limit_mb > 0:
+        import resource
+        limit = memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _parse_in_child(conn, file_args: tuple, chunk_size: int, memory_limit_mb: int):
+    """
+    子进程入口：解析文件并切分父块和子块，结果通过管道发回
+    返回 ('ok', content_length, docs, full_docs) 或 ('error', 错误信息)
+    """
+    try:
+        _set_memory_limit(memory_limit_mb)
+        from src.core.file_handler.file_handler import FileHandler
+        file_handler = FileHandler(*file_args, chunk_size, None)
+        file_handler.split_file_to_docs()
+        content_length = sum([len(doc.page_content) for doc in file_handler.docs])
+        docs, full_docs = [], []
+        # 超长或为空的文件不再切分，由调用方按content_length标记失败
+        if 0 < content_length <= MAX_CHARS:
+            docs, full_docs = FileHandler.split_docs(file_handler.docs, chunk_size)
+        conn.send(('ok', content_length, docs, full_docs))
+    except MemoryError:
+        conn.send(('error', f"memory limit exceeded: {memory_limit_mb}MB"))
+    except Exception:
+        insert_logger.error(f"parse error: {file_args[5]}, {traceback.format_exc()}")
+        conn.send(('error', "split_file_to_docs error"))
+    finally:
+        conn.close()
+
+
+def _stream_pdf_in_child(conn, file_args: tuple, chunk_size: int, memory_limit_mb: int, batch_pages: int):
+    """
+    子进程入口：逐页解析PDF，每切分完一批就通过管道发回 ('batch', 累计content_length, docs, full_docs)，
+    结束时发送 ('done', content_length)，出错时发送 ('error', 错误信息)
+    管道写满时子进程阻塞在send上，下游处理慢时解析随之暂停
+    """
+    try:
+        _set_memory_limit(memory_limit_mb)
+        from src.core.file_handler.file_handler import FileHandler
+        file_handler = FileHandler(*file_args, chunk_size, None)
+        content_length = 0
+        for content_length, docs, full_docs in file_handler.iter_pdf_batches(batch_pages, MAX_CHARS):
+            if docs:
+                conn.send(('batch', content_length, docs, full_docs))
+        conn.send(('done', content_length))
+    except MemoryError:
+        conn.send(('error', f"memory limit exceeded: {memory_limit_mb}MB"))
+    except Exception:
+        insert_logger.error(f"parse error: {file_args[5]}, {traceback.format_exc()}")
+        conn.send(('error', "split_file_to_docs error"))
+    finally:
+        conn.close()
+
+
+class ParsePool:
+    """
+    在独立子进程中解析文件
+
+    - 每个文件由forkserver fork出一个子进程解析，不与入库服务的事件循环争抢GIL
+    - 超时后直接kill子进程，解析真正停止
+    - 子进程地址空间限制为 memory_limit_mb（RLIMIT_AS，0表示不限制），超限时只有该文件失败
+    - 同时解析的文件数不超过 pool_size
+    - PDF可以流式解析（iter_parse_pdf），逐批发回chunk，不必等整个文件解析完
+    forkserver在第一次解析前启动，此时milvus/grpc等线程尚未进入子进程，fork是安全的
+    """
+
+    def __init__(self, pool_size: int = INGEST_PARSE_WORKERS, timeout: float = INGEST_PARSE_TIMEOUT,
+                 memory_limit_mb: int = INGEST_PARSE_MEMORY_LIMIT_MB):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.ctx = multiprocessing.get_context('forkserver')
+        # 预先在forkserver中导入解析依赖，子进程fork后无需重复导入
+        self.ctx.set_forkserver_preload(['src.core.file_handler.file_handler'])
+        self._semaphore = asyncio.Semaphore(pool_size)
+        self.killed = 0
+
+    def _start(self, target, args: tuple):
+        parent_conn, child_conn = self.ctx.Pipe(duplex=False)
+        process = self.ctx.Process(target=target, args=(child_conn, *args), daemon=True)
+        process.start()
+        child_conn.close()
+        return parent_conn, process
+
+    def _recv(self, parent_conn, process, timeout: float):
+        if not parent_conn.poll(timeout):
+            process.kill()
+            self.killed += 1
+            raise ParseError(f"split_file_to_docs timeout: {self.timeout}s")
+        try:
+            result = parent_conn.recv()
+        except EOFError:
+            # 子进程没有发送结果就退出了（如被OOM killer或信号终止）
+            process.join(5)
+            raise ParseError(f"parse process exited with code {process.exitcode}")
+        if result[0] == 'error':
+            raise ParseError(result[1])
+        return result
+
+    @staticmethod
+    def _stop(parent_conn, process, kill: bool = False):
+        parent_conn.close()
+        if kill:
+            process.kill()
+        process.join(5)
+        if process.is_alive():
+            process.kill()
+            process.join()
+
+    def _run(self, file_args: tuple, chunk_size: int):
+        parent_conn, process = self._start(_parse_in_child, (file_args, chunk_size, self.memory_limit_mb))
+        try:
+            # 先读结果再join，避免结果较大时子进程阻塞在写管道上
+            result = self._recv(parent_conn, process, self.timeout)
+            return result[1], result[2], result[3]
+        finally:
+            self._stop(parent_conn, process)
+
+    async def parse(self, file_args: tuple, chunk_size: int) -> Tuple[int, List[Chunk], List[tuple]]:
+        """
+        file_args: (user_id, kb_name, kb_id, file_id, file_location, file_name, file_url)
+        返回 (content_length, 子块docs, 父块full_docs)
+        """
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._run, file_args, chunk_size)
+
+    async def iter_parse_pdf(self, file_args: tuple, chunk_size: int,
+                             batch_pages: int = INGEST_STREAM_BATCH_PAGES) -> AsyncIterator[tuple]:
+        """
+        流式解析PDF，依次产出 ('batch', 累计content_length, docs, full_docs)，最后产出 ('done', content_length)
+        超时只计算等待子进程产出的时间，调用方处理批次（下游阻塞）的时间不计入
+        调用方提前停止迭代时（需要aclose）子进程被kill
+        """
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            parent_conn, process = await loop.run_in_executor(
+                None, self._start, _stream_pdf_in_child,
+                (file_args, chunk_size, self.memory_limit_mb, batch_pages))
+            finished = False
+            try:
+                waited = 0.0
+                while not finished:
+                    start = time.perf_counter()
+                    result = await loop.run_in_executor(None, self._recv, parent_conn, process,
+                                                        max(self.timeout - waited, 0))
+                    waited += time.perf_counter() - start
+                    finished = result[0] == 'done'
+                    yield result
+            finally:
+                await loop.run_in_executor(None, self._stop, parent_conn, process, not finished)
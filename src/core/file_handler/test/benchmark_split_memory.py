@@ -0,0 +1,91 @@
+import os
+import sys
+import copy
+import time
+import argparse
+import tracemalloc
+
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path)))))
+sys.path.append(root_dir)
+
+from langchain_community.document_loaders import PyPDFLoader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from src.configs.configs import SEPARATORS, DEFAULT_PARENT_CHUNK_SIZE, DEFAULT_CHILD_CHUNK_SIZE
+from src.utils.general_utils import num_tokens_embed
+from src.core.file_handler.file_handler import FileHandler
+
+# 对比split_docs旧实现（子块deepcopy后删除字段）与Chunk实现的峰值内存和耗时
+# 用法: python benchmark_split_memory.py [--file std-Rust.pdf] [--scale 20]
+# scale 把PDF的页面重复多次，模拟大文件
+
+test_dir = os.path.dirname(current_script_path)
+
+
+def legacy_split_docs(docs, parent_chunk_size=DEFAULT_PARENT_CHUNK_SIZE):
+    parent_splitter = RecursiveCharacterTextSplitter(separators=SEPARATORS, chunk_size=parent_chunk_size,
+                                                     chunk_overlap=0, length_function=num_tokens_embed)
+    child_chunk_size = min(DEFAULT_CHILD_CHUNK_SIZE, int(parent_chunk_size / 2))
+    child_splitter = RecursiveCharacterTextSplitter(separators=SEPARATORS, chunk_size=child_chunk_size,
+                                                    chunk_overlap=int(child_chunk_size / 3),
+                                                    length_function=num_tokens_embed)
+    split_documents = []
+    for doc in docs:
+        if doc.metadata['has_table'] or num_tokens_embed(doc.page_content) <= parent_chunk_size:
+            split_documents.append(doc)
+        else:
+            split_documents.extend(parent_splitter.split_documents([doc]))
+    file_id = split_documents[0].metadata['file_id']
+    documents = []
+    full_documents = []
+    for i, doc in enumerate(split_documents):
+        _id = file_id + '_' + str(i)
+        sub_docs = child_splitter.split_documents([doc])
+        for _doc in sub_docs:
+            _doc.metadata["doc_id"] = _id
+        documents.extend(sub_docs)
+        full_documents.append((_id, doc))
+    embed_documents = copy.deepcopy(documents)
+    for doc in embed_documents:
+        for key in ('title_lst', 'has_table', 'images', 'file_name', 'nos_key', 'page_id'):
+            del doc.metadata[key]
+    return embed_documents, full_documents
+
+
+def measure(func, docs):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    result = func(docs)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, (current - base) / 1024 / 1024, (peak - base) / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--file', default='std-Rust.pdf')
+    parser.add_argument('--scale', type=int, default=20)
+    args = parser.parse_args()
+
+    file_path = os.path.join(test_dir, args.file)
+    pages = PyPDFLoader(file_path).load() * args.scale
+    file_handler = FileHandler('benchmark', 'benchmark', 'KBbenchmark', 'benchmark', file_path, args.file, None,
+                               DEFAULT_PARENT_CHUNK_SIZE, None)
+    file_handler.inject_metadata(pages)
+    docs = file_handler.docs
+    print(f"{args.file} x{args.scale}: {len(pages)} pages, {len(docs)} merged docs, "
+          f"{sum(len(doc.page_content) for doc in docs)} chars")
+
+    for name, func in [('deepcopy', legacy_split_docs), ('chunk', FileHandler.split_docs)]:
+        (chunks, parents), elapsed, retained, peak = measure(func, docs)
+        print(f"  {name:<8} time: {elapsed:.2f}s, peak: {peak:.1f}MB, retained: {retained:.1f}MB, "
+              f"children: {len(chunks)}, parents: {len(parents)}")
+        del chunks, parents
+
+
+if __name__ == '__main__':
+    main()
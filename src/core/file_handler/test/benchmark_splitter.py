@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+import argparse
+
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path)))))
+sys.path.append(root_dir)
+
+from langchain_community.document_loaders import PyPDFLoader, TextLoader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from src.configs.configs import SEPARATORS, DEFAULT_PARENT_CHUNK_SIZE, DEFAULT_CHILD_CHUNK_SIZE
+from src.utils.general_utils import num_tokens_embed
+from src.core.file_handler.token_splitter import TokenAwareSplitter
+
+# 对比 RecursiveCharacterTextSplitter(length_function=num_tokens_embed) 与 TokenAwareSplitter
+# 用法: python benchmark_splitter.py [--files std-Rust.pdf readme.md] [--repeat 3]
+
+test_dir = os.path.dirname(current_script_path)
+
+
+def load(file_name):
+    file_path = os.path.join(test_dir, file_name)
+    if file_name.lower().endswith('.pdf'):
+        return PyPDFLoader(file_path).load()
+    return TextLoader(file_path, encoding='utf-8').load()
+
+
+def run(splitter, docs, repeat):
+    best = float('inf')
+    chunks = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = splitter.split_documents(docs)
+        best = min(best, time.perf_counter() - start)
+    return best, chunks
+
+
+def describe(chunks, chunk_size):
+    lengths = [num_tokens_embed(chunk.page_content) for chunk in chunks]
+    return {
+        'chunks': len(chunks),
+        'mean_tokens': round(sum(lengths) / len(lengths), 1) if lengths else 0,
+        'max_tokens': max(lengths, default=0),
+        'over_size': sum(length > chunk_size for length in lengths),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', nargs='+', default=['std-Rust.pdf', 'readme.md'])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    child_chunk_size = min(DEFAULT_CHILD_CHUNK_SIZE, int(DEFAULT_PARENT_CHUNK_SIZE / 2))
+    settings = [('parent', DEFAULT_PARENT_CHUNK_SIZE, 0),
+                ('child', child_chunk_size, int(child_chunk_size / 3))]
+    for file_name in args.files:
+        docs = load(file_name)
+        print(f"{file_name}: {len(docs)} docs, {sum(len(doc.page_content) for doc in docs)} chars")
+        for name, chunk_size, chunk_overlap in settings:
+            baseline = RecursiveCharacterTextSplitter(separators=SEPARATORS, chunk_size=chunk_size,
+                                                      chunk_overlap=chunk_overlap, length_function=num_tokens_embed)
+            token_aware = TokenAwareSplitter(chunk_size, chunk_overlap, SEPARATORS)
+            baseline_time, baseline_chunks = run(baseline, docs, args.repeat)
+            token_time, token_chunks = run(token_aware, docs, args.repeat)
+            same = len(set(chunk.page_content for chunk in baseline_chunks) &
+                       set(chunk.page_content for chunk in token_chunks))
+            print(f"  {name} (chunk_size={chunk_size}, overlap={chunk_overlap})")
+            print(f"    recursive:   {baseline_time:.3f}s {describe(baseline_chunks, chunk_size)}")
+            print(f"    token_aware: {token_time:.3f}s {describe(token_chunks, chunk_size)}")
+            print(f"    speedup: {baseline_time / token_time:.1f}x, identical chunks: {same}/{len(baseline_chunks)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import os
+import sys
+
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path)))))
+sys.path.append(root_dir)
+from src.core.file_handler.chunk import Chunk
+from src.core.file_handler.chunk_index import ChunkIndex, parent_hash
+from langchain.docstore.document import Document
+
+FILE_ID = 'f1'
+CHUNK_SIZE = 800
+
+
+def split(parents, children_per_parent=2):
+    """模拟split_docs：父块按全量切分编号，每个父块切出children_per_parent个子块"""
+    docs, full_docs = [], []
+    for i, content in enumerate(parents):
+        doc_id = f'{FILE_ID}_{i}'
+        parent = Document(page_content=content, metadata={'file_id': FILE_ID})
+        full_docs.append((doc_id, parent))
+        docs += [Chunk.from_parent(f'{content}#{j}', parent, doc_id) for j in range(children_per_parent)]
+    return docs, full_docs
+
+
+def first_version(parents):
+    # 首次入库：空索引，全部父块都是新增的
+    index = ChunkIndex(FILE_ID, CHUNK_SIZE)
+    index.apply(*split(parents))
+    return index.rows()
+
+
+def test_new_file_numbering_matches_full_split():
+    index = ChunkIndex(FILE_ID, CHUNK_SIZE)
+    docs, full_docs = index.apply(*split(['a', 'b', 'c']))
+    assert [doc_id for doc_id, _ in full_docs] == ['f1_0', 'f1_1', 'f1_2']
+    assert [doc.metadata['doc_id'] for doc in docs] == ['f1_0', 'f1_0', 'f1_1', 'f1_1', 'f1_2', 'f1_2']
+    assert index.es_ids(index.added) == [f'f1_{i}' for i in range(6)]
+    assert not index.kept and not index.vanished()
+
+
+def test_unchanged_file_writes_nothing():
+    rows = first_version(['a', 'b', 'c'])
+    index = ChunkIndex(FILE_ID, CHUNK_SIZE, rows)
+    docs, full_docs = index.apply(*split(['a', 'b', 'c']))
+    assert docs == [] and full_docs == []
+    assert index.kept == rows
+    assert index.vanished() == []
+    assert index.chunks_number == 3
+
+
+def test_edited_and_removed_parents():
+    rows = first_version(['a', 'b', 'c'])
+    index = ChunkIndex(FILE_ID, CHUNK_SIZE, rows)
+    # b被修改为b2，c被删除
+    docs, full_docs = index.apply(*split(['a', 'b2']))
+    # 新父块从已用的最大编号之后分配，子块es编号也接在后面
+    assert [doc_id for doc_id, _ in full_docs] == ['f1_3']
+    assert [doc.metadata['doc_id'] for doc in docs] == ['f1_3', 'f1_3']
+    assert index.added == [(parent_hash(full_docs[0][1], CHUNK_SIZE), 'f1_3', 6, 2)]
+    assert index.es_ids(index.added) == ['f1_6', 'f1_7']
+    assert [row[1] for row in index.kept] == ['f1_0']
+    assert sorted(row[1] for row in index.vanished()) == ['f1_1', 'f1_2']
+    assert sorted(index.es_ids(index.vanished())) == ['f1_2', 'f1_3', 'f1_4', 'f1_5']
+    assert index.chunks_number == 2
+
+
+def test_duplicate_parents_matched_one_by_one():
+    rows = first_version(['a', 'a', 'b'])
+    # 内容相同的父块按顺序逐个匹配：只剩一个a时，多出的那个旧a需要删除
+    index = ChunkIndex(FILE_ID, CHUNK_SIZE, rows)
+    docs, full_docs = index.apply(*split(['a', 'b']))
+    assert docs == [] and full_docs == []
+    assert [row[1] for row in index.kept] == ['f1_0', 'f1_2']
+    assert [row[1] for row in index.vanished()] == ['f1_1']
+    # 重复的a变多时，超出旧版本个数的部分作为新增写入
+    index = ChunkIndex(FILE_ID, CHUNK_SIZE, rows)
+    docs, full_docs = index.apply(*split(['a', 'a', 'a', 'b']))
+    assert [doc_id for doc_id, _ in full_docs] == ['f1_3']
+    assert [row[1] for row in index.kept] == ['f1_0', 'f1_1', 'f1_2']
+    assert index.vanished() == []
+
+
+def test_chunk_size_change_reindexes_everything():
+    rows = first_version(['a', 'b'])
+    index = ChunkIndex(FILE_ID, 400, rows)
+    docs, full_docs = index.apply(*split(['a', 'b']))
+    assert [doc_id for doc_id, _ in full_docs] == ['f1_2', 'f1_3']
+    assert len(index.vanished()) == 2
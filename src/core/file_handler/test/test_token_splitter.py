@@ -0,0 +1,86 @@
+import os
+import sys
+from functools import lru_cache
+
+import pytest
+
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path)))))
+sys.path.append(root_dir)
+from langchain_community.document_loaders import PyPDFLoader, TextLoader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from src.configs.configs import SEPARATORS, DEFAULT_PARENT_CHUNK_SIZE, DEFAULT_CHILD_CHUNK_SIZE
+from src.utils.general_utils import num_tokens_embed
+from src.core.file_handler.token_splitter import TokenAwareSplitter
+
+# TokenAwareSplitter 与 RecursiveCharacterTextSplitter(length_function=num_tokens_embed) 在仓库自带文档上的对比
+# 跨越片段边界的token只算在前一段，个别chunk的边界可能与逐段编码的结果相差一个片段，因此按比例比较
+test_dir = os.path.dirname(current_script_path)
+FILES = ['readme.md', 'std-Rust.pdf']
+CHILD_CHUNK_SIZE = min(DEFAULT_CHILD_CHUNK_SIZE, int(DEFAULT_PARENT_CHUNK_SIZE / 2))
+SETTINGS = [(DEFAULT_PARENT_CHUNK_SIZE, 0), (CHILD_CHUNK_SIZE, int(CHILD_CHUNK_SIZE / 3))]
+# 边界相同的chunk占比下限
+MIN_SAME_BOUNDARY_RATIO = 0.95
+# 重新编码chunk时首尾的token可能与整篇编码时切分不同，允许超出chunk_size的token数
+TOKEN_SLACK = 2
+
+
+@lru_cache(maxsize=None)
+def load(file_name):
+    file_path = os.path.join(test_dir, file_name)
+    if file_name.lower().endswith('.pdf'):
+        return tuple(PyPDFLoader(file_path).load())
+    return tuple(TextLoader(file_path, encoding='utf-8').load())
+
+
+def boundaries(text, chunks):
+    """chunk在原文中的(start, end)，按顺序查找，重叠的chunk从上一个chunk的起点之后开始找"""
+    spans = []
+    pos = 0
+    for chunk in chunks:
+        start = text.find(chunk, pos)
+        assert start != -1, f"chunk is not a substring of the source text: {chunk[:50]!r}"
+        spans.append((start, start + len(chunk)))
+        pos = start + 1
+    return spans
+
+
+def split_both(file_name, chunk_size, chunk_overlap):
+    baseline = RecursiveCharacterTextSplitter(separators=SEPARATORS, chunk_size=chunk_size,
+                                              chunk_overlap=chunk_overlap, length_function=num_tokens_embed)
+    token_aware = TokenAwareSplitter(chunk_size, chunk_overlap, SEPARATORS)
+    return [(doc.page_content, baseline.split_text(doc.page_content), token_aware.split_text(doc.page_content))
+            for doc in load(file_name)]
+
+
+@pytest.mark.parametrize('chunk_size,chunk_overlap', SETTINGS)
+@pytest.mark.parametrize('file_name', FILES)
+def test_chunk_boundaries_match_recursive_splitter(file_name, chunk_size, chunk_overlap):
+    total, same = 0, 0
+    for text, baseline_chunks, token_chunks in split_both(file_name, chunk_size, chunk_overlap):
+        baseline_spans = boundaries(text, baseline_chunks)
+        token_spans = boundaries(text, token_chunks)
+        total += len(baseline_spans)
+        same += len(set(baseline_spans) & set(token_spans))
+    assert total > 0
+    assert same >= MIN_SAME_BOUNDARY_RATIO * total, f"{same}/{total} chunks have the same boundaries"
+
+
+@pytest.mark.parametrize('chunk_size,chunk_overlap', SETTINGS)
+@pytest.mark.parametrize('file_name', FILES)
+def test_chunk_token_counts_match_recursive_splitter(file_name, chunk_size, chunk_overlap):
+    baseline_lengths, token_lengths = [], []
+    for text, baseline_chunks, token_chunks in split_both(file_name, chunk_size, chunk_overlap):
+        baseline_lengths += [num_tokens_embed(chunk) for chunk in baseline_chunks]
+        unsplittable = {chunk for chunk in baseline_chunks if num_tokens_embed(chunk) > chunk_size}
+        for chunk in token_chunks:
+            length = num_tokens_embed(chunk)
+            token_lengths.append(length)
+            # 无法再切分的超长片段两者都会原样输出，其余chunk不超过chunk_size
+            if chunk not in unsplittable:
+                assert length <= chunk_size + TOKEN_SLACK, f"{length} tokens: {chunk[:50]!r}"
+    baseline_mean = sum(baseline_lengths) / len(baseline_lengths)
+    token_mean = sum(token_lengths) / len(token_lengths)
+    assert abs(token_mean - baseline_mean) <= 0.05 * baseline_mean
+    assert abs(len(token_lengths) - len(baseline_lengths)) <= max(2, 0.05 * len(baseline_lengths))
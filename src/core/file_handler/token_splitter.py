@@ -0,0 +1,125 @@
+import os
+import sys
+import re
+import copy
+from bisect import bisect_left
+from collections import deque
+from typing import List, Optional, Tuple
+
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+from src.configs.configs import SEPARATORS
+from src.utils.general_utils import embedding_tokenizer
+from langchain.docstore.document import Document
+
+Span = Tuple[int, int]
+
+
+class TokenAwareSplitter:
+    """
+    按token数切分文本，切分规则与 RecursiveCharacterTextSplitter(length_function=num_tokens_embed) 相同：
+    按separators的优先级递归切分，分隔符保留在后一段的开头，相邻小段合并到chunk_size以内，chunk之间重叠chunk_overlap个token
+
+    区别在于每个文档只用tokenizer编码一次（带offset_mapping），之后任意片段的token数都由offset二分查找得到，
+    不再在递归和合并过程中反复对候选字符串编码。
+    片段的token数按起点落在片段内的token计数，跨越片段边界的token只算在前一段；
+    special tokens（[CLS]/[SEP]等）每个chunk只计一次
+    """
+
+    def __init__(self, chunk_size: int, chunk_overlap: int = 0, separators: Optional[List[str]] = None,
+                 tokenizer=embedding_tokenizer):
+        if not getattr(tokenizer, 'is_fast', False):
+            raise ValueError("TokenAwareSplitter requires a fast tokenizer with offset mapping")
+        if chunk_overlap > chunk_size:
+            raise ValueError(f"chunk_overlap ({chunk_overlap}) is larger than chunk_size ({chunk_size})")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = separators if separators is not None else SEPARATORS
+        self.tokenizer = tokenizer
+        # 与num_tokens_embed(add_special_tokens=True)保持一致，每个chunk的预算扣除special tokens
+        self.budget = chunk_size - len(tokenizer.encode('', add_special_tokens=True))
+        self._patterns = {sep: re.compile(re.escape(sep)) for sep in self.separators if sep}
+
+    def _token_starts(self, text: str) -> List[int]:
+        encoding = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        return [start for start, end in encoding['offset_mapping']]
+
+    @staticmethod
+    def _length(starts: List[int], span: Span) -> int:
+        return bisect_left(starts, span[1]) - bisect_left(starts, span[0])
+
+    @staticmethod
+    def _strip(text: str, start: int, end: int) -> Optional[Span]:
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        return (start, end) if start < end else None
+
+    def _split_span(self, text: str, start: int, end: int, separator: str) -> List[Span]:
+        # 分隔符保留在后一段的开头，与keep_separator=True的行为一致
+        if separator == '':
+            return [(i, i + 1) for i in range(start, end)]
+        cuts = [m.start() for m in self._patterns[separator].finditer(text, start, end)]
+        bounds = [start] + cuts + [end]
+        return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1) if bounds[i] < bounds[i + 1]]
+
+    def _merge(self, text: str, starts: List[int], spans: List[Span]) -> List[Span]:
+        # spans在原文中首尾相连，合并后的chunk就是原文的一个区间
+        chunks = []
+        current = deque()
+        total = 0
+        for span in spans:
+            length = self._length(starts, span)
+            if total + length > self.budget and current:
+                chunk = self._strip(text, current[0][0], current[-1][1])
+                if chunk:
+                    chunks.append(chunk)
+                # 从头部弹出片段，直到剩余部分不超过重叠长度且能放下当前片段
+                while total > self.chunk_overlap or (total + length > self.budget and total > 0):
+                    total -= self._length(starts, current.popleft())
+            current.append(span)
+            total += length
+        if current:
+            chunk = self._strip(text, current[0][0], current[-1][1])
+            if chunk:
+                chunks.append(chunk)
+        return chunks
+
+    def _split(self, text: str, starts: List[int], start: int, end: int, separators: List[str]) -> List[Span]:
+        separator = separators[-1]
+        new_separators = []
+        for i, sep in enumerate(separators):
+            if sep == '':
+                separator = sep
+                break
+            if text.find(sep, start, end) != -1:
+                separator = sep
+                new_separators = separators[i + 1:]
+                break
+        final_chunks = []
+        good_splits = []
+        for span in self._split_span(text, start, end, separator):
+            if self._length(starts, span) < self.budget:
+                good_splits.append(span)
+                continue
+            if good_splits:
+                final_chunks.extend(self._merge(text, starts, good_splits))
+                good_splits = []
+            if not new_separators:
+                final_chunks.append(span)
+            else:
+                final_chunks.extend(self._split(text, starts, span[0], span[1], new_separators))
+        if good_splits:
+            final_chunks.extend(self._merge(text, starts, good_splits))
+        return final_chunks
+
+    def split_text(self, text: str) -> List[str]:
+        starts = self._token_starts(text)
+        return [text[start:end] for start, end in self._split(text, starts, 0, len(text), self.separators)]
+
+    def split_documents(self, documents: List[Document]) -> List[Document]:
+        return [Document(page_content=chunk, metadata=copy.deepcopy(doc.metadata))
+                for doc in documents for chunk in self.split_text(doc.page_content)]
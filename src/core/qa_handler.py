@@ -1,30 +1,40 @@
 
 from src.configs.configs import VECTOR_SEARCH_SCORE_THRESHOLD, CUSTOM_PROMPT_TEMPLATE, \
     SYSTEM, PROMPT_TEMPLATE, INSTRUCTIONS, SIMPLE_PROMPT_TEMPLATE, \
-    QUERY_REWRITE_ENABLED, QUERY_REWRITE_TARGET_LANG
+    QUERY_REWRITE_ENABLED, QUERY_REWRITE_TARGET_LANG, ANSWER_CACHE_ENABLED, RETRIEVAL_CACHE_ENABLED, \
+    CONDENSE_RETRIEVAL_ENABLED, CHAT_REQUEST_TIMEOUT, FAQ_INDEX_ENABLED, MULTI_QUERY_MAX_QUERIES, MULTI_QUERY_HYDE_ENABLED, \
+    BILINGUAL_RETRIEVAL_ENABLED, CONDENSE_CACHE_ENABLED
 from src.utils.general_utils import deduplicate_documents, num_tokens, num_tokens_rerank, my_print, replace_image_references
 from src.core.chains.condense_q_chain import RewriteQuestionChain
+from src.core.chains.history_window import HistoryWindow
+from src.core.chains.condense_classifier import CondenseClassifier
 from src.client.llm.llm_client import OpenAILLM
 from src.core.query_rewrite.pipeline import QueryRewritePipeline
+from src.core.cache.answer_cache import AnswerCache, AnswerCacheEntry
+from src.core.cache.retrieval_cache import RetrievalCache, kb_content_version
+from src.core.cache.faq_index import FaqIndex
+from src.core.cache.condense_cache import CondenseCache
 from langchain.schema import Document
-from langchain.schema.messages import AIMessage, HumanMessage
 from urllib3.util import Retry
 from requests.adapters import HTTPAdapter
 import requests
 from src.core.retriever.retriever import Retriever
+from src.core.retriever.image_relevance import ImageRelevance
 from src.client.database.elasticsearch.es_client import ESClient
 from src.client.database.milvus.milvus_client import MilvusClient
 from src.client.database.mysql.mysql_client import MysqlClient
 from src.utils.log_handler import debug_logger
+from src.utils.deadline import RequestDeadline
 from src.client.rerank.client import SBIRerank
 from src.client.embedding.embedding_client import SBIEmbeddings
+import asyncio
 import json
 import re
 import sys
 import os
 import time
 import traceback
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 # 获取当前脚本的绝对路径
 current_script_path = os.path.abspath(__file__)
 # 将项目根目录添加到sys.path
@@ -87,12 +97,80 @@ class QAHandler:
             self.query_rewrite_pipeline = QueryRewritePipeline()
         else:
             self.query_rewrite_pipeline = None
+        # 初始化问答结果缓存（默认关闭）
+        if ANSWER_CACHE_ENABLED:
+            self.answer_cache = AnswerCache(self.embeddings)
+        else:
+            self.answer_cache = None
+        # 初始化检索+rerank结果缓存
+        if RETRIEVAL_CACHE_ENABLED:
+            self.retrieval_cache = RetrievalCache()
+        else:
+            self.retrieval_cache = None
+        # 压缩后独立问题的缓存
+        self.condense_cache = CondenseCache() if CONDENSE_CACHE_ENABLED else None
+        # 问题压缩前的对话历史窗口（可选的历史摘要保存在这里）
+        self.history_window = HistoryWindow()
+        # 判断新问题是否需要结合对话历史压缩，独立问题跳过压缩的LLM调用
+        self.condense_classifier = CondenseClassifier()
+        # 回答结束后按与回答的相关性挑选展示的图片，复用milvus返回的chunk向量
+        self.image_relevance = ImageRelevance(self.embeddings)
+        # 初始化FAQ索引，在向量检索之前匹配FAQ
+        if FAQ_INDEX_ENABLED:
+            self.faq_index = FaqIndex(self.embeddings, self.mysql_client)
+        else:
+            self.faq_index = None
+
+    async def get_kb_versions(self, kb_ids, time_record) -> Optional[dict]:
+        """
+        读取知识库版本 {kb_id: (content_version, faq_version)}，每个请求在线程池中只查询一次，
+        FAQ索引、问答缓存和检索缓存共用；都未开启或查询失败时返回None，本次请求不使用这些缓存
+        """
+        if not kb_ids or (self.faq_index is None and self.answer_cache is None and self.retrieval_cache is None):
+            return None
+        t1 = time.perf_counter()
+        try:
+            kb_versions = await asyncio.get_running_loop().run_in_executor(
+                None, self.mysql_client.get_kb_versions, kb_ids)
+        except Exception as e:
+            debug_logger.error(f"get kb versions error: {traceback.format_exc()}")
+            kb_versions = None
+        time_record['get_kb_versions'] = round(time.perf_counter() - t1, 2)
+        return kb_versions
 
-    async def get_source_documents(self, query, retriever: Retriever, kb_ids, time_record, hybrid_search, top_k):
+    async def match_faq(self, kb_ids, question, time_record, kb_versions) -> Optional[Document]:
+        """
+        在FAQ索引中匹配问题，命中时返回FAQ对应的Document
+        """
+        if self.faq_index is None or not kb_ids or kb_versions is None:
+            return None
+        t1 = time.perf_counter()
+        try:
+            faq_versions = {kb_id: versions[1] for kb_id, versions in kb_versions.items()}
+            faq_doc = await self.faq_index.match(kb_ids, question, faq_versions)
+        except Exception as e:
+            debug_logger.error(f"faq index match error: {traceback.format_exc()}")
+            faq_doc = None
+        time_record['faq_index_match'] = round(time.perf_counter() - t1, 2)
+        return faq_doc
+
+    async def get_source_documents(self, query, retriever: Retriever, kb_ids, time_record, hybrid_search, top_k,
+                                   deadline: RequestDeadline = None, retrieval_queries: List[str] = None):
+        """
+        retrieval_queries: 多路检索的查询列表（包含query），为None时只用query检索
+        """
         source_documents = []
         start_time = time.perf_counter()
-        query_docs = await retriever.get_retrieved_documents(query, self.milvus_client, self.es_client, partition_keys=kb_ids, time_record=time_record,
-                                                             hybrid_search=hybrid_search, top_k=top_k)
+        # retriever.es_client是ElasticsearchStore，ESClient本身没有asimilarity_search
+        if retrieval_queries:
+            query_docs = await retriever.get_multi_query_retrieved_documents(retrieval_queries, self.milvus_client,
+                                                                             retriever.es_client, partition_keys=kb_ids,
+                                                                             time_record=time_record,
+                                                                             hybrid_search=hybrid_search, top_k=top_k,
+                                                                             deadline=deadline)
+        else:
+            query_docs = await retriever.get_retrieved_documents(query, self.milvus_client, retriever.es_client, partition_keys=kb_ids, time_record=time_record,
+                                                                 hybrid_search=hybrid_search, top_k=top_k, deadline=deadline)
         end_time = time.perf_counter()
         time_record['retriever_search'] = round(end_time - start_time, 2)
         debug_logger.info(
@@ -103,7 +181,7 @@ class QAHandler:
                 debug_logger.warning(
                     f"file_id: {doc.metadata['file_id']} is deleted")
                 continue
-            doc.metadata['retrieval_query'] = query  # 添加查询到文档的元数据中
+            doc.metadata.setdefault('retrieval_query', query)  # 添加查询到文档的元数据中，多路检索时已记录命中的查询
             if 'score' not in doc.metadata:
                 doc.metadata['score'] = 1 - \
                     (idx / len(query_docs))  # TODO 这个score怎么获取呢
@@ -115,37 +193,176 @@ class QAHandler:
 
         return source_documents
 
-    def process_query_rewrite(self, query: str, time_record: dict) -> str:
+    async def rerank_source_documents(self, query, rerank_query, source_documents, kb_ids, time_record):
+        """
+        对检索结果进行rerank并按分数过滤，返回 (文档列表, rerank是否成功)
+        """
+        try:
+            t1 = time.perf_counter()
+            debug_logger.info(
+                f"use rerank, rerank docs num: {len(source_documents)}")
+            source_documents = await self.rerank.arerank_documents(rerank_query, source_documents)
+            t2 = time.perf_counter()
+            time_record['rerank'] = round(t2 - t1, 2)
+            # 过滤掉低分的文档
+            debug_logger.info(f"rerank step1 num: {len(source_documents)}")
+            debug_logger.info(
+                f"rerank step1 scores: {[doc.metadata['score'] for doc in source_documents]}")
+            if len(source_documents) > 1:
+                # 如果没有大于等于0.28的分数则保留
+                if filtered_documents := [doc for doc in source_documents if doc.metadata['score'] >= 0.28]:
+                    source_documents = filtered_documents
+                debug_logger.info(
+                    f"rerank step2 num: {len(source_documents)}")
+                saved_docs = [source_documents[0]]
+                # 根据相对分数来过滤文档块
+                for doc in source_documents[1:]:
+                    debug_logger.info(
+                        f"rerank doc score: {doc.metadata['score']}")
+                    relative_difference = (
+                        saved_docs[0].metadata['score'] - doc.metadata['score']) / saved_docs[0].metadata['score']
+                    if relative_difference > 0.5:
+                        break
+                    else:
+                        saved_docs.append(doc)
+                source_documents = saved_docs
+                debug_logger.info(
+                    f"rerank step3 num: {len(source_documents)}")
+            return source_documents, True
+        except Exception as e:
+            time_record['rerank'] = 0.0
+            debug_logger.error(
+                f"query {query}: kb_ids: {kb_ids}, rerank error: {traceback.format_exc()}")
+            return source_documents, False
+
+    async def retrieve_and_rerank(self, query, retrieval_query, rerank_query, retriever: Retriever, kb_ids, time_record,
+                                  hybrid_search, top_k, rerank, retrieval_task: asyncio.Task = None,
+                                  deadline: RequestDeadline = None, retrieval_queries: List[str] = None,
+                                  kb_versions: dict = None):
+        """
+        检索 -> 去重 -> rerank -> 截断top_k。
+        检索+rerank的结果只取决于查询、kb_ids和检索参数，开启检索缓存时直接复用，跳过milvus、es和rerank服务
+        retrieval_task: 已经提前启动的retrieval_query检索任务（与问题压缩并发执行），为None时在这里检索
+        deadline: 请求截止时间，milvus、es、rerank超出预算时降级
+        retrieval_queries: 多路检索的查询列表，各路结果RRF融合后再rerank
+        kb_versions: get_kb_versions的结果，为None时不使用检索缓存
+        """
+        if not kb_ids:
+            if retrieval_task is not None:
+                retrieval_task.cancel()
+            return []
+        cache_key = None
+        kb_version = None
+        if self.retrieval_cache is not None and kb_versions is not None:
+            try:
+                cache_query = '\n'.join(retrieval_queries) if retrieval_queries else retrieval_query
+                cache_key = RetrievalCache.make_key(kb_ids, cache_query, rerank_query, top_k, hybrid_search, rerank)
+                kb_version = kb_content_version(kb_versions, kb_ids)
+                cached_documents = self.retrieval_cache.get(cache_key, kb_version)
+                if cached_documents is not None:
+                    time_record['retrieval_cache_hit'] = 1
+                    if retrieval_task is not None:
+                        retrieval_task.cancel()
+                    return cached_documents
+            except Exception as e:
+                debug_logger.error(f"retrieval cache get error: {traceback.format_exc()}")
+                cache_key = None
+
+        if retrieval_task is None:
+            retrieval_task = asyncio.create_task(self.get_source_documents(retrieval_query, retriever, kb_ids,
+                                                                           time_record, hybrid_search, top_k,
+                                                                           deadline=deadline,
+                                                                           retrieval_queries=retrieval_queries))
+        retrieval_tasks = [retrieval_task]
+        # 压缩后的问题与检索问题不同时，可以再用压缩后的问题检索一次，两路结果合并后一起rerank
+        if CONDENSE_RETRIEVAL_ENABLED and rerank_query and rerank_query != retrieval_query \
+                and rerank_query not in (retrieval_queries or []):
+            retrieval_tasks.append(asyncio.create_task(self.get_source_documents(rerank_query, retriever, kb_ids,
+                                                                                 time_record, hybrid_search, top_k,
+                                                                                 deadline=deadline)))
+        try:
+            results = await asyncio.gather(*retrieval_tasks)
+        except Exception:
+            for task in retrieval_tasks:
+                task.cancel()
+            raise
+        source_documents = [doc for docs in results for doc in docs]
+        # 将检索内容进行去重
+        source_documents = deduplicate_documents(source_documents)
+        rerank_ok = True
+        if rerank and len(source_documents) > 1 and num_tokens_rerank(query) <= 300:
+            rerank_coro = self.rerank_source_documents(query, rerank_query, source_documents, kb_ids, time_record)
+            if deadline is not None:
+                # 超出rerank阶段预算时跳过rerank，保留检索顺序
+                rerank_result = await deadline.run('rerank', rerank_coro)
+            else:
+                rerank_result = await rerank_coro
+            if rerank_result is None:
+                rerank_ok = False
+            else:
+                source_documents, rerank_ok = rerank_result
+        # es检索+milvus检索结果最多可能是2k
+        source_documents = source_documents[:top_k]
+        # rerank失败或有阶段被降级的结果不写入缓存，避免重试时一直拿到不完整的结果
+        if cache_key is not None and rerank_ok and not (deadline is not None and deadline.degraded):
+            self.retrieval_cache.put(cache_key, kb_version, source_documents)
+        return source_documents
+
+    async def process_query_rewrite(self, query: str, time_record: dict, hyde: bool = False) -> dict:
         """
-        简单的查询重写处理，返回处理后的查询
+        查询重写处理，返回pipeline的结果：{'original', 'translated', 'rewrites', 'hyde', ...}
+        失败时translated为原始查询
         """
+        fallback = {'original': query, 'translated': query, 'rewrites': [], 'hyde': None}
         if not self.query_rewrite_pipeline:
-            return query
+            return fallback
 
         try:
             t1 = time.perf_counter()
             debug_logger.info(f"Processing query rewrite for: {query}")
 
             # 使用query_rewrite pipeline处理查询
-            result = self.query_rewrite_pipeline.process(
-                query, target_lang=QUERY_REWRITE_TARGET_LANG)
+            result = await self.query_rewrite_pipeline.aprocess(
+                query, target_lang=QUERY_REWRITE_TARGET_LANG, hyde=hyde)
 
             # 优先使用翻译后的查询，如果没有翻译则使用原始查询
             processed_query = result['translated'] if result['translated'] else query
+            result['translated'] = processed_query
 
             t2 = time.perf_counter()
             time_record['query_rewrite'] = round(t2 - t1, 2)
+            memo_cache = self.query_rewrite_pipeline.memo_cache
+            if memo_cache is not None:
+                # 本次请求的命中/未命中次数，以及当前worker缓存的累计命中率
+                time_record['query_rewrite_cache_hits'] = result['cache_hits']
+                time_record['query_rewrite_cache_misses'] = result['cache_misses']
+                time_record['query_rewrite_cache_hit_rate'] = memo_cache.stats()['hit_rate']
             debug_logger.info(
                 f"Query rewrite completed in {time_record['query_rewrite']}s")
             debug_logger.info(
                 f"Original query: {query} -> Processed query: {processed_query}")
 
-            return processed_query
+            return result
 
         except Exception as e:
             debug_logger.error(f"Query rewrite error: {e}")
             time_record['query_rewrite'] = 0.0
-            return query
+            return fallback
+
+    @staticmethod
+    def build_retrieval_queries(query: str, rewrite_result: dict, max_queries: int) -> List[str]:
+        """
+        多路检索的查询列表：原始问题、翻译后问题、重写结果、HyDE假设答案，去重后按顺序截断到max_queries
+        不足两路时返回None，走单路检索
+        """
+        candidates = [query, rewrite_result.get('translated')] + list(rewrite_result.get('rewrites') or []) + \
+                     [rewrite_result.get('hyde')]
+        retrieval_queries = []
+        for candidate in candidates:
+            if candidate and candidate.strip() and candidate not in retrieval_queries:
+                retrieval_queries.append(candidate)
+        retrieval_queries = retrieval_queries[:max(1, min(max_queries, MULTI_QUERY_MAX_QUERIES))]
+        return retrieval_queries if len(retrieval_queries) > 1 else None
 
     def reprocess_source_documents(self, custom_llm: OpenAILLM, query: str,
                                    source_docs: List[Document],
@@ -263,6 +480,34 @@ class QAHandler:
         if streaming:
             response['result'] = "data: [DONE]\n\n"
             yield response, history
+
+    @staticmethod
+    async def replay_cached_answer(query, cached: AnswerCacheEntry, condense_question, time_record, chat_history,
+                                   streaming, chunk_size=16):
+        """
+        回放问答缓存中的答案，流式请求时按chunk_size切片输出，模拟大模型的流式返回
+        """
+        history = chat_history + [[query, cached.answer]]
+        response = {"query": query,
+                    "prompt": cached.prompt,
+                    "result": cached.answer,
+                    "condense_question": condense_question,
+                    "retrieval_documents": cached.retrieval_documents,
+                    "source_documents": cached.source_documents}
+        if cached.show_images:
+            response['show_images'] = cached.show_images
+        for key in ['llm_completed', 'total_tokens', 'prompt_tokens', 'completion_tokens']:
+            if key not in time_record:
+                time_record[key] = 0
+
+        if not streaming:
+            yield response, history
+            return
+        for i in range(0, len(cached.answer), chunk_size):
+            delta = {'answer': cached.answer[i:i + chunk_size]}
+            yield dict(response, result='data: ' + json.dumps(delta, ensure_ascii=False)), history
+        response['result'] = "data: [DONE]\n\n"
+        yield response, history
     # 生成prompt
 
     def generate_prompt(self, query, source_docs, prompt_template):
@@ -332,126 +577,209 @@ class QAHandler:
             source_documents = retrieval_documents
 
         debug_logger.info(f"source_documents len: {len(source_documents)}")
+        await self.attach_parent_images(source_documents)
         return source_documents, retrieval_documents
 
+    async def attach_parent_images(self, docs: List[Document]):
+        """
+        检索到的子块只有索引元数据，图片保存在父块的metadata中，按doc_id取出后写入子块的metadata['images']
+        """
+        doc_ids = list({doc.metadata['doc_id'] for doc in docs if doc.metadata.get('doc_id')})
+        if not doc_ids:
+            return
+        try:
+            parent_images = await asyncio.get_running_loop().run_in_executor(
+                None, self.mysql_client.get_parent_images, doc_ids)
+        except Exception as e:
+            debug_logger.error(f"get parent images error: {traceback.format_exc()}")
+            return
+        for doc in docs:
+            images = parent_images.get(doc.metadata.get('doc_id'))
+            if images:
+                doc.metadata['images'] = images
+
     async def get_knowledge_based_answer(self, model, max_token, kb_ids, query, retriever, custom_prompt, time_record,
                                          temperature, api_base, api_key, api_context_length, top_p, top_k, web_chunk_size,
                                          chat_history=None, streaming: bool = True, rerank: bool = False,
-                                         only_need_search_results: bool = False, hybrid_search=False):
+                                         only_need_search_results: bool = False, hybrid_search=False,
+                                         deadline: RequestDeadline = None, multi_query: bool = False,
+                                         max_queries: int = MULTI_QUERY_MAX_QUERIES, conversation_id: str = None,
+                                         condense_skip: bool = False, user_id: str = None):
         # 创建与大模型交互句柄
         custom_llm = OpenAILLM(model, max_token, api_base,
                                api_key, api_context_length, top_p, temperature)
         if chat_history is None:
             chat_history = []
+        # 请求截止时间，各阶段超出预算时降级，保证尾延迟有上界
+        if deadline is None:
+            deadline = RequestDeadline(CHAT_REQUEST_TIMEOUT, time_record)
+        kb_versions = await self.get_kb_versions(kb_ids, time_record)
+        # 没有对话历史时，原问题就是独立问题，最先匹配FAQ，命中则不再做重写、检索和大模型生成
+        faq_doc = None
+        if not chat_history:
+            faq_doc = await self.match_faq(kb_ids, query, time_record, kb_versions)
 
         # 在最开始进行query_rewrite处理
-        if QUERY_REWRITE_ENABLED and self.query_rewrite_pipeline:
+        retrieval_queries = None
+        if faq_doc is not None:
+            retrieval_query = query
+            condense_question = query
+        elif QUERY_REWRITE_ENABLED and self.query_rewrite_pipeline:
             debug_logger.info("Processing query rewrite...")
-            processed_query = self.process_query_rewrite(query, time_record)
+            # 超出预算时使用原问题
+            rewrite_result = await deadline.run('query_rewrite',
+                                                self.process_query_rewrite(query, time_record,
+                                                                           hyde=multi_query and MULTI_QUERY_HYDE_ENABLED))
+            if rewrite_result is None:
+                rewrite_result = {'original': query, 'translated': query, 'rewrites': [], 'hyde': None}
+            processed_query = rewrite_result['translated']
             retrieval_query = processed_query
             condense_question = processed_query
+            # 多路检索：原始问题、翻译、重写和HyDE一起检索，RRF融合
+            if multi_query:
+                retrieval_queries = self.build_retrieval_queries(query, rewrite_result, max_queries)
+            elif BILINGUAL_RETRIEVAL_ENABLED and processed_query != query:
+                # 双语检索：原文和译文的向量在同一次milvus请求中检索，避免只用译文时漏掉原语言的文档
+                retrieval_queries = [query, processed_query]
+            debug_logger.info(f"retrieval_queries: {retrieval_queries}")
         else:
             retrieval_query = query
             condense_question = query
+        # 检索使用的是retrieval_query，不依赖问题压缩的结果
+        # 有对话历史时提前启动检索，与压缩问题的LLM调用并发执行，不再把压缩耗时放在关键路径上
+        retrieval_task = None
+        if chat_history and kb_ids:
+            retrieval_task = asyncio.create_task(self.get_source_documents(retrieval_query, retriever, kb_ids,
+                                                                           time_record, hybrid_search, top_k,
+                                                                           deadline=deadline,
+                                                                           retrieval_queries=retrieval_queries))
+        # 本轮压缩后的独立问题，记录为会话状态供下一轮压缩复用；压缩失败、降级时不记录
+        condense_state = query
         # 如果有对话历史就将对话历史和query结合进行query重写
         if chat_history:
-            formatted_chat_history = []
-            for msg in chat_history:
-                # 对话历史格式化
-                formatted_chat_history += [
-                    HumanMessage(content=msg[0]),
-                    AIMessage(content=msg[1]),
-                ]
-            debug_logger.info(
-                f"formatted_chat_history: {formatted_chat_history}")
-
-            rewrite_q_chain = RewriteQuestionChain(
-                model_name=model, openai_api_base=api_base, openai_api_key=api_key)
-            # 将对话历史和查询输入到对话模版中
-            full_prompt = rewrite_q_chain.condense_q_prompt.format(
-                chat_history=formatted_chat_history,
-                question=query
-            )
-            # 如果总token数超过限制(4096-256)，从前往后删除历史消息
-            while custom_llm.num_tokens_from_messages([full_prompt]) >= 4096 - 256:
-                formatted_chat_history = formatted_chat_history[2:]
+            need_condense = True
+            if condense_skip:
+                need_condense, condense_reason = await self.condense_classifier.aneeds_condense(query, chat_history)
+                debug_logger.info(f"need_condense: {need_condense}, reason: {condense_reason}")
+            # 重试、重新生成同一轮时直接复用压缩结果
+            condense_key = None
+            cached_condense = None
+            if need_condense and self.condense_cache is not None:
+                condense_key = CondenseCache.make_key(chat_history, query, model, user_id, conversation_id)
+                cached_condense = self.condense_cache.get(condense_key)
+            if not need_condense:
+                # 问题本身是独立问题，沿用query_rewrite的结果（或原问题）
+                time_record['condense_skipped'] = 1
+            elif cached_condense is not None:
+                condense_question = cached_condense
+                condense_state = cached_condense
+                time_record['condense_cache_hit'] = 1
+            else:
+                condense_state = None
+                # 有上一轮的会话状态时，只需上一轮的独立问题和回答，不必带上完整的对话历史
+                condense_history = chat_history
+                previous_condensed = None
+                if self.condense_cache is not None:
+                    previous_condensed = self.condense_cache.previous_turn(user_id, conversation_id, chat_history)
+                if previous_condensed is not None:
+                    condense_history = [[previous_condensed, chat_history[-1][1]]]
+                    time_record['condense_state_reuse'] = 1
+                rewrite_q_chain = RewriteQuestionChain(
+                    model_name=model, openai_api_base=api_base, openai_api_key=api_key)
+                # 总token数限制为4096-256，扣除不含对话历史的prompt后即为对话历史的预算
+                base_prompt = rewrite_q_chain.condense_q_prompt.format(chat_history=[], question=query)
+                history_budget = 4096 - 256 - custom_llm.num_tokens_from_messages([base_prompt])
+                # 对话历史格式化：一次遍历保留预算内最近的若干轮，开启摘要时更早的对话用后台生成的摘要代替
+                formatted_chat_history, kept_turns = self.history_window.build_messages(
+                    condense_history, lambda text: custom_llm.num_tokens_from_messages([text]), history_budget,
+                    chat_model=rewrite_q_chain.chat_model)
+                debug_logger.info(
+                    f"formatted_chat_history: {formatted_chat_history}")
+                # 将对话历史和查询输入到对话模版中
                 full_prompt = rewrite_q_chain.condense_q_prompt.format(
                     chat_history=formatted_chat_history,
                     question=query
                 )
-            debug_logger.info(
-                f"Subtract formatted_chat_history: {len(chat_history) * 2} -> {len(formatted_chat_history)}")
-            try:
-                t1 = time.perf_counter()
-                # 调用大模型对 带有对话历史的查询 进行重写
-                condense_question = await rewrite_q_chain.condense_q_chain.ainvoke(
-                    {
-                        "chat_history": formatted_chat_history,
-                        "question": query,
-                    },
-                )
-                t2 = time.perf_counter()
-                # 时间保留两位小数
-                time_record['condense_q_chain'] = round(t2 - t1, 2)
-                time_record['rewrite_completion_tokens'] = custom_llm.num_tokens_from_messages([
-                                                                                               condense_question])
                 debug_logger.info(
-                    f"condense_q_chain time: {time_record['condense_q_chain']}s")
-            except Exception as e:
-                debug_logger.error(f"condense_q_chain error: {e}")
-                condense_question = query
-            debug_logger.info(f"condense_question: {condense_question}")
-            time_record['rewrite_prompt_tokens'] = custom_llm.num_tokens_from_messages(
-                [full_prompt, condense_question])
-        # 如果有kb_ids那么需要对重写后的查询进行向量检索
-        if kb_ids:
-            source_documents = await self.get_source_documents(retrieval_query, retriever, kb_ids, time_record,
-                                                               hybrid_search, top_k)
-        else:
-            source_documents = []
-
-        # 对检索的内容进行rerank
-        # 将检索内容进行去重
-        source_documents = deduplicate_documents(source_documents)
-        if rerank and len(source_documents) > 1 and num_tokens_rerank(query) <= 300:
+                    f"Subtract formatted_chat_history: {len(condense_history) * 2} -> {kept_turns * 2}")
+                try:
+                    t1 = time.perf_counter()
+                    # 调用大模型对 带有对话历史的查询 进行重写，超出预算时直接使用原问题
+                    condensed = await deadline.run('condense', rewrite_q_chain.condense_q_chain.ainvoke(
+                        {
+                            "chat_history": formatted_chat_history,
+                            "question": query,
+                        },
+                    ))
+                    t2 = time.perf_counter()
+                    # 时间保留两位小数
+                    time_record['condense_q_chain'] = round(t2 - t1, 2)
+                    if condensed is None:
+                        condense_question = query
+                    else:
+                        condense_question = condensed
+                        condense_state = condensed
+                        if condense_key is not None:
+                            self.condense_cache.put(condense_key, condense_question)
+                        time_record['rewrite_completion_tokens'] = custom_llm.num_tokens_from_messages([
+                                                                                                       condense_question])
+                    debug_logger.info(
+                        f"condense_q_chain time: {time_record['condense_q_chain']}s")
+                except Exception as e:
+                    debug_logger.error(f"condense_q_chain error: {e}")
+                    condense_question = query
+                debug_logger.info(f"condense_question: {condense_question}")
+                time_record['rewrite_prompt_tokens'] = custom_llm.num_tokens_from_messages(
+                    [full_prompt, condense_question])
+            # 有对话历史时使用压缩后的独立问题匹配FAQ
+            faq_doc = await self.match_faq(kb_ids, condense_question, time_record, kb_versions)
+        if self.condense_cache is not None and condense_state is not None:
+            self.condense_cache.remember_turn(user_id, conversation_id, len(chat_history), query, condense_state)
+        if faq_doc is not None:
+            if retrieval_task is not None:
+                retrieval_task.cancel()
+            time_record['faq_index_hit'] = 1
+            if only_need_search_results:
+                yield [faq_doc], None
+                return
+            faq_dict = faq_doc.metadata['faq_dict']
+            async for response, history in self.generate_response(faq_dict['question'], faq_dict['answer'],
+                                                                  condense_question, [faq_doc], time_record,
+                                                                  chat_history, streaming, 'MATCH_FAQ'):
+                yield response, history
+            return
+        # 查询问答缓存，命中则直接回放缓存的答案，跳过检索、rerank和大模型生成
+        prompt_config = {'custom_prompt': custom_prompt, 'top_k': top_k, 'rerank': rerank,
+                         'hybrid_search': hybrid_search, 'multi_query': bool(retrieval_queries)}
+        use_answer_cache = bool(self.answer_cache is not None and kb_ids and kb_versions is not None
+                                and not only_need_search_results)
+        answer_cache_embedding = None
+        answer_cache_version = None
+        if use_answer_cache:
             try:
                 t1 = time.perf_counter()
-                debug_logger.info(
-                    f"use rerank, rerank docs num: {len(source_documents)}")
-                source_documents = await self.rerank.arerank_documents(condense_question, source_documents)
-                t2 = time.perf_counter()
-                time_record['rerank'] = round(t2 - t1, 2)
-                # 过滤掉低分的文档
-                debug_logger.info(f"rerank step1 num: {len(source_documents)}")
-                debug_logger.info(
-                    f"rerank step1 scores: {[doc.metadata['score'] for doc in source_documents]}")
-                if len(source_documents) > 1:
-                    # 如果没有大于等于0.28的分数则保留
-                    if filtered_documents := [doc for doc in source_documents if doc.metadata['score'] >= 0.28]:
-                        source_documents = filtered_documents
-                    debug_logger.info(
-                        f"rerank step2 num: {len(source_documents)}")
-                    saved_docs = [source_documents[0]]
-                    # 根据相对分数来过滤文档块
-                    for doc in source_documents[1:]:
-                        debug_logger.info(
-                            f"rerank doc score: {doc.metadata['score']}")
-                        relative_difference = (
-                            saved_docs[0].metadata['score'] - doc.metadata['score']) / saved_docs[0].metadata['score']
-                        if relative_difference > 0.5:
-                            break
-                        else:
-                            saved_docs.append(doc)
-                    source_documents = saved_docs
-                    debug_logger.info(
-                        f"rerank step3 num: {len(source_documents)}")
+                answer_cache_version = kb_content_version(kb_versions, kb_ids)
+                cached, answer_cache_embedding = await self.answer_cache.lookup(
+                    kb_ids, condense_question, model, prompt_config, answer_cache_version)
+                time_record['answer_cache_lookup'] = round(time.perf_counter() - t1, 2)
             except Exception as e:
-                time_record['rerank'] = 0.0
-                debug_logger.error(
-                    f"query {query}: kb_ids: {kb_ids}, rerank error: {traceback.format_exc()}")
-
-        # es检索+milvus检索结果最多可能是2k
-        source_documents = source_documents[:top_k]
+                debug_logger.error(f"answer cache lookup error: {traceback.format_exc()}")
+                cached = None
+                use_answer_cache = False
+            if cached is not None:
+                time_record['answer_cache_hit'] = 1
+                if retrieval_task is not None:
+                    retrieval_task.cancel()
+                async for response, history in self.replay_cached_answer(query, cached, condense_question, time_record,
+                                                                         chat_history, streaming):
+                    yield response, history
+                return
+        # 如果有kb_ids那么需要对重写后的查询进行向量检索，并对检索的内容进行rerank
+        source_documents = await self.retrieve_and_rerank(query, retrieval_query, condense_question, retriever, kb_ids,
+                                                          time_record, hybrid_search, top_k, rerank,
+                                                          retrieval_task=retrieval_task, deadline=deadline,
+                                                          retrieval_queries=retrieval_queries,
+                                                          kb_versions=kb_versions)
         # TODO:
         # rerank之后删除headers，只保留文本内容，用于后续处理
         # TODO: 不知道这个在rerank里什么作用
@@ -483,6 +811,7 @@ class QAHandler:
 
         extra_msg = None
         total_images_number = 0
+        image_candidates = None
         retrieval_documents = []
         if source_documents:
             # 如果有自定义Prompt，则使用自定义Prompt
@@ -540,6 +869,9 @@ class QAHandler:
                     doc.page_content = replace_image_references(
                         doc.page_content, doc.metadata['file_id'])
             debug_logger.info(f"total_images_number: {total_images_number}")
+            # 在生成回答之前准备好带图文档的向量矩阵，回答结束后只需计算回答的向量
+            if total_images_number != 0:
+                image_candidates = ImageRelevance.prepare(source_documents)
 
             t2 = time.perf_counter()
             time_record['reprocess'] = round(t2 - t1, 2)
@@ -564,6 +896,8 @@ class QAHandler:
 
         t1 = time.perf_counter()
         has_first_return = False
+        # 大模型调用使用剩余的全部时间作为超时
+        custom_llm.timeout = max(deadline.remaining(), 1.0)
 
         acc_resp = ''
         # 在这之前应该对source_docs的file_id进行排序后，生成Prompt
@@ -618,25 +952,19 @@ class QAHandler:
                     last_return_time - t1, 2) - time_record['llm_first_return']
                 history[-1][1] = acc_resp
                 # 如果有图片，需要处理回答带图的情况
-                if total_images_number != 0:
-                    docs_with_images = [
-                        doc for doc in source_documents if doc.metadata.get('images', [])]
+                if image_candidates is not None:
                     time1 = time.perf_counter()
-                    relevant_docs = await self.calculate_relevance_optimized(
-                        question=query,
-                        llm_answer=acc_resp,
-                        reference_docs=docs_with_images,
-                        top_k=1
-                    )
                     show_images = ["\n### 引用图文如下：\n"]
+                    try:
+                        relevant_docs = await self.image_relevance.select(acc_resp, image_candidates, top_k=1)
+                    except Exception as e:
+                        debug_logger.error(f"image relevance error: {traceback.format_exc()}")
+                        relevant_docs = []
                     # 输出图片信息
                     for doc in relevant_docs:
-                        print(f"文档: {doc['document']}...")  # 只打印前50个字符
-                        print(f"最相关段落: {doc['segment']}...")  # 打印最相关段落的前100个字符
-                        print(f"与LLM回答的相似度: {doc['similarity_llm']:.4f}")
-                        print(f"原始问题相关性分数: {doc['question_score']:.4f}")
-                        print(f"综合得分: {doc['combined_score']:.4f}")
-                        print()
+                        debug_logger.info(f"image doc: {doc['segment']}..., similarity_llm: {doc['similarity_llm']:.4f}, "
+                                          f"question_score: {doc['question_score']:.4f}, "
+                                          f"combined_score: {doc['combined_score']:.4f}")
                         for image in doc['document'].metadata.get('images', []):
                             image_str = replace_image_references(
                                 image, doc['document'].metadata['file_id'])
@@ -651,5 +979,13 @@ class QAHandler:
                     time_record["obtain_images_time"] = round(time2 - time1, 2)
                     if len(show_images) > 1:
                         response['show_images'] = show_images
+                # 写入问答缓存
+                if use_answer_cache and not deadline.degraded:
+                    try:
+                        self.answer_cache.store(kb_ids, condense_question, model, prompt_config, answer_cache_embedding,
+                                                answer_cache_version, acc_resp, prompt, source_documents,
+                                                retrieval_documents, response.get('show_images'))
+                    except Exception as e:
+                        debug_logger.error(f"answer cache store error: {traceback.format_exc()}")
 
             yield response, history
@@ -1,12 +1,59 @@
-from langdetect import detect
-from typing import List
+from langdetect import detect, DetectorFactory
+from typing import List, Tuple
+import numpy as np
 
+# langdetect内部有随机采样，固定种子保证同一文本的检测结果稳定
+DetectorFactory.seed = 0
 
-def detect_language(text: str) -> str:
+# 脚本占比判定的置信度低于该值时，才使用langdetect
+SCRIPT_CONFIDENCE_THRESHOLD = 0.6
+# 一个汉字的信息量大约相当于几个拉丁字母，按该比例折算拉丁字母数
+LATIN_LETTERS_PER_CJK = 4.0
+# 汉字折算后的占比不低于该值时判为中文
+ZH_MIN_SHARE = 0.3
+
+
+def _script_counts(texts: List[str]) -> np.ndarray:
     """
-    检测输入文本的语言类型。
-    返回：'zh'（中文）、'en'（英文）、或其他langdetect支持的语言代码
+    统计每个文本中各类字符的数量，返回 shape=(len(texts), 4) 的数组：
+    [汉字, 拉丁字母, 日文假名/韩文, 其他非ASCII字母]
+    所有文本拼成一个码位数组，一次向量化计算完成
     """
+    codes = [np.frombuffer(t.encode('utf-32-le'), dtype=np.uint32) for t in texts]
+    lengths = np.array([len(c) for c in codes])
+    counts = np.zeros((len(texts), 4), dtype=np.int64)
+    if lengths.sum() == 0:
+        return counts
+    all_codes = np.concatenate(codes)
+    cjk = ((all_codes >= 0x4E00) & (all_codes <= 0x9FFF)) | ((all_codes >= 0x3400) & (all_codes <= 0x4DBF))
+    latin = ((all_codes >= 0x41) & (all_codes <= 0x5A)) | ((all_codes >= 0x61) & (all_codes <= 0x7A))
+    kana_hangul = ((all_codes >= 0x3040) & (all_codes <= 0x30FF)) | ((all_codes >= 0xAC00) & (all_codes <= 0xD7AF))
+    other = (all_codes >= 0xC0) & ~cjk & ~kana_hangul & ~((all_codes >= 0x2000) & (all_codes <= 0x33FF)) \
+        & ~((all_codes >= 0xFF00) & (all_codes <= 0xFFEF))
+    masks = np.stack([cjk, latin, kana_hangul, other], axis=1).astype(np.int64)
+    # 按文本分段求和，空文本保持为0
+    non_empty = lengths > 0
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])[non_empty]
+    counts[non_empty] = np.add.reduceat(masks, starts, axis=0)
+    return counts
+
+
+def _classify_counts(cjk: int, latin: int, kana_hangul: int, other: int) -> Tuple[str, float]:
+    # 日文、韩文交给langdetect判断
+    if kana_hangul:
+        return 'unknown', 0.0
+    latin_weight = latin / LATIN_LETTERS_PER_CJK
+    total = cjk + latin_weight + other
+    if total == 0:
+        return 'unknown', 0.0
+    cjk_share = cjk / total
+    # 中文问题里常夹带英文术语（如"Rust中的trait怎么用"），汉字折算后占比达到ZH_MIN_SHARE即判为中文
+    if cjk_share >= ZH_MIN_SHARE:
+        return 'zh', min(1.0, 2 * cjk_share)
+    return 'en', latin_weight / total
+
+
+def _langdetect_language(text: str) -> str:
     try:
         lang = detect(text)
         # 更精确的语言映射
@@ -36,8 +83,31 @@ def detect_language(text: str) -> str:
             return 'unknown'
 
 
+def detect_language_with_confidence(text: str) -> Tuple[str, float]:
+    """
+    按汉字/拉丁字母占比快速判断语言，返回 (语言, 置信度)。
+    置信度低于 SCRIPT_CONFIDENCE_THRESHOLD 时使用langdetect的结果，此时置信度为脚本判定的原值
+    """
+    lang, confidence = _classify_counts(*_script_counts([text])[0])
+    if confidence < SCRIPT_CONFIDENCE_THRESHOLD:
+        return _langdetect_language(text), confidence
+    return lang, confidence
+
+
+def detect_language(text: str) -> str:
+    """
+    检测输入文本的语言类型。
+    返回：'zh'（中文）、'en'（英文）、或其他langdetect支持的语言代码
+    """
+    return detect_language_with_confidence(text)[0]
+
+
 def batch_detect_language(texts: List[str]) -> List[str]:
     """
-    批量检测语言类型
+    批量检测语言类型，字符统计对整批文本一次完成，只有低置信度的文本才逐条调用langdetect
     """
-    return [detect_language(t) for t in texts]
+    langs = []
+    for text, counts in zip(texts, _script_counts(list(texts))):
+        lang, confidence = _classify_counts(*counts)
+        langs.append(lang if confidence >= SCRIPT_CONFIDENCE_THRESHOLD else _langdetect_language(text))
+    return langs
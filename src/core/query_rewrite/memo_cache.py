@@ -0,0 +1,157 @@
+import os
+import re
+import sys
+import sqlite3
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from typing import Optional
+
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+from src.configs.configs import QUERY_REWRITE_CACHE_MAX_SIZE, QUERY_REWRITE_CACHE_TTL, QUERY_REWRITE_CACHE_PATH
+from src.utils.log_handler import debug_logger
+
+
+def normalize_query(query: str) -> str:
+    # 只统一空白和句末标点，不改变大小写，翻译和重写结果对大小写敏感
+    query = re.sub(r'\s+', ' ', query.strip())
+    return query.rstrip('?？。.!！~ ')
+
+
+class RewriteMemoCache:
+    """
+    query预处理结果缓存：(query, 目标语言) -> 翻译结果，(query, 模式) -> 重写结果
+
+    - 进程内 LRU + TTL
+    - 可选的本地sqlite文件作为二级缓存，同一台机器上的多个Sanic worker共享
+    异步接口（aget/aput）中sqlite的读写在单独的线程中执行，事件循环上只访问内存中的LRU
+    """
+
+    def __init__(self, max_size: int = QUERY_REWRITE_CACHE_MAX_SIZE, ttl: float = QUERY_REWRITE_CACHE_TTL,
+                 db_path: Optional[str] = QUERY_REWRITE_CACHE_PATH):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db_path = db_path
+        self._entries = OrderedDict()
+        # _lock只保护内存中的LRU，sqlite连接由_db_lock保护，事件循环不会等待磁盘IO
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rewrite_memo')
+        # 每个进程各自打开sqlite连接，fork出的worker不复用父进程的连接
+        self._conn = None
+        self._conn_pid = None
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(kind: str, option: str, query: str) -> str:
+        return f"{kind}|{option}|{normalize_query(query)}"
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries),
+                'hit_rate': round(self.hits / total, 3) if total else 0.0}
+
+    def _get_conn(self):
+        if self.db_path is None:
+            return None
+        if self._conn is None or self._conn_pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=1, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS memo (key TEXT PRIMARY KEY, value TEXT, created REAL)")
+            conn.commit()
+            self._conn, self._conn_pid = conn, os.getpid()
+        return self._conn
+
+    def _remember(self, key: str, created: float, value: str):
+        with self._lock:
+            self._entries[key] = (created, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_local(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if now - entry[0] <= self.ttl:
+                self._entries.move_to_end(key)
+                return entry[1]
+            del self._entries[key]
+            return None
+
+    def get_persistent(self, key: str) -> Optional[str]:
+        if self.db_path is None:
+            return None
+        now = time.time()
+        try:
+            with self._db_lock:
+                conn = self._get_conn()
+                row = conn.execute("SELECT value, created FROM memo WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            debug_logger.warning(f"rewrite memo cache read error: {e}")
+            return None
+        if row is None or now - row[1] > self.ttl:
+            return None
+        self._remember(key, row[1], row[0])
+        return row[0]
+
+    def put_persistent(self, key: str, value: str, created: float):
+        if self.db_path is None:
+            return
+        try:
+            with self._db_lock:
+                conn = self._get_conn()
+                conn.execute("INSERT OR REPLACE INTO memo (key, value, created) VALUES (?, ?, ?)",
+                             (key, value, created))
+                self._puts += 1
+                # 定期清理过期条目
+                if self._puts % 100 == 0:
+                    conn.execute("DELETE FROM memo WHERE created < ?", (created - self.ttl,))
+                conn.commit()
+        except sqlite3.Error as e:
+            debug_logger.warning(f"rewrite memo cache write error: {e}")
+
+    def _count(self, value: Optional[str]) -> Optional[str]:
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.get_local(key)
+        if value is None:
+            value = self.get_persistent(key)
+        return self._count(value)
+
+    def put(self, key: str, value: str):
+        if not value:
+            return
+        now = time.time()
+        self._remember(key, now, value)
+        self.put_persistent(key, value, now)
+
+    async def aget(self, key: str) -> Optional[str]:
+        value = self.get_local(key)
+        if value is None and self.db_path is not None:
+            value = await asyncio.get_running_loop().run_in_executor(self.executor, self.get_persistent, key)
+        return self._count(value)
+
+    async def aput(self, key: str, value: str):
+        if not value:
+            return
+        now = time.time()
+        self._remember(key, now, value)
+        if self.db_path is not None:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.put_persistent, key, value, now)
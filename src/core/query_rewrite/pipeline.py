@@ -1,12 +1,43 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from .language_detect import detect_language
 from .translator import LocalTranslator
-from .rewriter import llm_openai_rewrite
+from .rewriter import llm_openai_rewrite, allm_openai_rewrite
+from .memo_cache import RewriteMemoCache
+from src.configs.configs import QUERY_REWRITE_CACHE_ENABLED
 from typing import List, Dict
 
 
 class QueryRewritePipeline:
     def __init__(self):
         self.translator = LocalTranslator()
+        # MarianMT的generate是CPU密集的同步调用，放到单独的线程中执行，避免阻塞事件循环
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='query_rewrite')
+        # 翻译、重写结果缓存，重复的query不再调用模型
+        self.memo_cache = RewriteMemoCache() if QUERY_REWRITE_CACHE_ENABLED else None
+
+    def _cache_get(self, kind: str, option: str, query: str, result: dict):
+        if self.memo_cache is None:
+            return None
+        value = self.memo_cache.get(self.memo_cache.make_key(kind, option, query))
+        result['cache_hits' if value is not None else 'cache_misses'] += 1
+        return value
+
+    def _cache_put(self, kind: str, option: str, query: str, value: str):
+        if self.memo_cache is not None:
+            self.memo_cache.put(self.memo_cache.make_key(kind, option, query), value)
+
+    async def _acache_get(self, kind: str, option: str, query: str, result: dict):
+        # sqlite二级缓存的读写在缓存自己的线程中执行，不阻塞事件循环
+        if self.memo_cache is None:
+            return None
+        value = await self.memo_cache.aget(self.memo_cache.make_key(kind, option, query))
+        result['cache_hits' if value is not None else 'cache_misses'] += 1
+        return value
+
+    async def _acache_put(self, kind: str, option: str, query: str, value: str):
+        if self.memo_cache is not None:
+            await self.memo_cache.aput(self.memo_cache.make_key(kind, option, query), value)
 
     def process(self, query: str, target_lang: str = 'en') -> Dict[str, List[str]]:
         """
@@ -14,19 +45,58 @@ class QueryRewritePipeline:
         1. 语言检测
         2. 必要时翻译
         3. LLM重写优化
-        返回：{'original': 原始query, 'translated': 翻译后query, 'rewrites': 重写query列表}
+        返回：{'original': 原始query, 'translated': 翻译后query, 'rewrites': 重写query列表,
+              'cache_hits': 缓存命中次数, 'cache_misses': 缓存未命中次数}
         """
         lang = detect_language(query)
-        result = {'original': query, 'translated': None, 'rewrites': []}
+        result = {'original': query, 'translated': None, 'rewrites': [], 'cache_hits': 0, 'cache_misses': 0}
         # 翻译（如原文非目标语言）
         if lang != target_lang:
-            translated = self.translator.translate(
-                [query], src_lang=lang, tgt_lang=target_lang)[0]
+            translated = self._cache_get('translate', target_lang, query, result)
+            if translated is None:
+                translated = self.translator.translate(
+                    [query], src_lang=lang, tgt_lang=target_lang)[0]
+                self._cache_put('translate', target_lang, query, translated)
             result['translated'] = translated
-            # 对翻译后query做扩展
-            rewrites = [llm_openai_rewrite(translated, mode='rewrite')]
         else:
             result['translated'] = query
-            rewrites = [llm_openai_rewrite(query, mode='rewrite')]
-        result['rewrites'] = rewrites
+        # 对翻译后query做扩展
+        rewrite = self._cache_get('rewrite', 'rewrite', result['translated'], result)
+        if rewrite is None:
+            rewrite = llm_openai_rewrite(result['translated'], mode='rewrite')
+            self._cache_put('rewrite', 'rewrite', result['translated'], rewrite)
+        result['rewrites'] = [rewrite]
+        return result
+
+    async def _arewrite(self, query: str, mode: str, result: dict) -> str:
+        rewrite = await self._acache_get('rewrite', mode, query, result)
+        if rewrite is None:
+            rewrite = await allm_openai_rewrite(query, mode=mode)
+            await self._acache_put('rewrite', mode, query, rewrite)
+        return rewrite
+
+    async def aprocess(self, query: str, target_lang: str = 'en', hyde: bool = False) -> Dict[str, List[str]]:
+        """
+        process的异步版本：翻译在线程池中执行，重写使用共享的异步LLM客户端（一次调用）
+        hyde=True 时并发生成一段HyDE假设答案，放在 result['hyde'] 中，用于多路检索
+        """
+        lang = detect_language(query)
+        result = {'original': query, 'translated': None, 'rewrites': [], 'hyde': None, 'cache_hits': 0,
+                  'cache_misses': 0}
+        if lang != target_lang:
+            translated = await self._acache_get('translate', target_lang, query, result)
+            if translated is None:
+                loop = asyncio.get_running_loop()
+                translated = (await loop.run_in_executor(
+                    self.executor, self.translator.translate, [query], lang, target_lang))[0]
+                await self._acache_put('translate', target_lang, query, translated)
+            result['translated'] = translated
+        else:
+            result['translated'] = query
+        if hyde:
+            rewrite, result['hyde'] = await asyncio.gather(self._arewrite(result['translated'], 'rewrite', result),
+                                                           self._arewrite(result['translated'], 'hyde', result))
+        else:
+            rewrite = await self._arewrite(result['translated'], 'rewrite', result)
+        result['rewrites'] = [rewrite]
         return result
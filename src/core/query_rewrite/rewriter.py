@@ -1,58 +1,79 @@
-import requests
-from typing import Literal
-from openai import OpenAI
+from typing import Dict, Tuple
+from openai import OpenAI, AsyncOpenAI
 
+SYSTEM_PROMPT = "You are a query rewriting assistant."
 
-def llm_openai_rewrite(query, mode='rewrite', model='Qwen2.5-7B-Instruct', base_url="http://0.0.0.0:2333/v1", api_key="YOUR_API_KEY"):
-    client = OpenAI(
-        api_key=api_key,
-        base_url=base_url
-    )
-    # 首先去除无用信息
-    removal_prompt = f"""The following questions may contain useless information. 
-    If they contain information irrelevant to the core issue, please remove the useless information 
-    and return the refined information.
+# 客户端按(base_url, api_key)复用，避免每次重写都新建连接池
+_clients: Dict[Tuple[str, str], OpenAI] = {}
+_async_clients: Dict[Tuple[str, str], AsyncOpenAI] = {}
 
-    Here is an example:
-    Question: 2020 NBA, champion of the Los Angeles Lakers! Tell me, what's the Langchain framework?
-    Refined information: Tell me, what's the Langchain framework?
 
-    The Task is:
-    Question: {query}
-    Refined information:
-    """
+def get_client(base_url: str, api_key: str) -> OpenAI:
+    key = (base_url, api_key)
+    if key not in _clients:
+        _clients[key] = OpenAI(api_key=api_key, base_url=base_url)
+    return _clients[key]
+
+
+def get_async_client(base_url: str, api_key: str) -> AsyncOpenAI:
+    key = (base_url, api_key)
+    if key not in _async_clients:
+        _async_clients[key] = AsyncOpenAI(api_key=api_key, base_url=base_url)
+    return _async_clients[key]
 
-    removal_response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": "You are a query rewriting assistant."},
-            {"role": "user", "content": removal_prompt}
-        ],
-        temperature=0.5,
-        top_p=0.95
-    )
-    query = removal_response.choices[0].message.content.strip()
-    print(f"Refined query: {query}")
+
+def build_rewrite_prompt(query: str, mode: str = 'rewrite') -> str:
+    """
+    去除无用信息和重写/HyDE合并为一个prompt，一次LLM调用完成
+    """
+    # 首先去除无用信息
+    removal_instruction = """The question may contain useless information.
+First, silently remove any information irrelevant to the core issue.
+For example, "2020 NBA, champion of the Los Angeles Lakers! Tell me, what's the Langchain framework?"
+should be treated as "Tell me, what's the Langchain framework?"."""
 
     if mode == 'rewrite':
-        #   user_prompt = f"Please rewrite the following question to a more suitable English query for knowledge retrieval.\nQuestion: {query}\nRewritten query:"
-        user_prompt = f"""Please rewrite the following question to a more suitable English query for knowledge retrieval. 
+        return f"""{removal_instruction}
+Then rewrite the refined question to a more suitable English query for knowledge retrieval.
 Keep the core meaning and intent of the original question, but make it more specific and searchable.
+Only output the rewritten query.
 Question: {query}
 Rewritten query:"""
     elif mode == 'hyde':
-        user_prompt = f"""Based on your knowledge, write a concise hypothetical answer to the following question (for retrieval).
+        return f"""{removal_instruction}
+Then, based on your knowledge, write a concise hypothetical answer to the refined question (for retrieval).
 Keep it under 150 words and focus on the most relevant information.
+Only output the hypothetical answer.
 Question: {query}
 Hypothetical answer:"""
     else:
-        user_prompt = query
+        return query
+
 
+def llm_openai_rewrite(query, mode='rewrite', model='Qwen2.5-7B-Instruct', base_url="http://0.0.0.0:2333/v1", api_key="YOUR_API_KEY"):
+    client = get_client(base_url, api_key)
     response = client.chat.completions.create(
         model=model,
         messages=[
-            {"role": "system", "content": "You are a query rewriting assistant."},
-            {"role": "user", "content": user_prompt}
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": build_rewrite_prompt(query, mode)}
+        ],
+        temperature=0.5,
+        top_p=0.95
+    )
+    return response.choices[0].message.content.strip()
+
+
+async def allm_openai_rewrite(query, mode='rewrite', model='Qwen2.5-7B-Instruct', base_url="http://0.0.0.0:2333/v1", api_key="YOUR_API_KEY"):
+    """
+    llm_openai_rewrite的异步版本，使用共享的AsyncOpenAI客户端，不阻塞事件循环
+    """
+    client = get_async_client(base_url, api_key)
+    response = await client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": build_rewrite_prompt(query, mode)}
         ],
         temperature=0.5,
         top_p=0.95
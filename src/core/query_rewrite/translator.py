@@ -1,40 +1,127 @@
 # ===== 默认使用 MarianMT 翻译器 =====
+import os
+import sys
+import threading
 from transformers import MarianMTModel, MarianTokenizer
-from typing import List
+from typing import Dict, List, Tuple
+
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+from src.configs.configs import TRANSLATOR_BACKEND, TRANSLATOR_ONNX_DIR, TRANSLATOR_ONNX_INT8, \
+    TRANSLATOR_GREEDY_MAX_TOKENS
+from src.utils.log_handler import debug_logger
+
+MODEL_NAMES = {
+    ('zh', 'en'): "Helsinki-NLP/opus-mt-zh-en",
+    ('en', 'zh'): "Helsinki-NLP/opus-mt-en-zh",
+}
+ONNX_FILE_NAMES = ('encoder_model.onnx', 'decoder_model.onnx', 'decoder_with_past_model.onnx')
+
+
+def export_onnx(model_name: str, output_dir: str, int8: bool = True) -> str:
+    """
+    导出MarianMT的encoder-decoder为ONNX（可选动态INT8量化），返回模型目录。依赖optimum[onnxruntime]
+    """
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    fp32_dir = os.path.join(output_dir, 'fp32')
+    model = ORTModelForSeq2SeqLM.from_pretrained(model_name, export=True)
+    model.save_pretrained(fp32_dir)
+    MarianTokenizer.from_pretrained(model_name).save_pretrained(fp32_dir)
+    if not int8:
+        return fp32_dir
+
+    int8_dir = os.path.join(output_dir, 'int8')
+    qconfig = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+    for file_name in ONNX_FILE_NAMES:
+        quantizer = ORTQuantizer.from_pretrained(fp32_dir, file_name=file_name)
+        quantizer.quantize(save_dir=int8_dir, quantization_config=qconfig)
+    MarianTokenizer.from_pretrained(model_name).save_pretrained(int8_dir)
+    return int8_dir
 
 
 class LocalTranslator:
-    def __init__(self):
-        self.zh2en_tokenizer = MarianTokenizer.from_pretrained(
-            "Helsinki-NLP/opus-mt-zh-en")
-        self.zh2en_model = MarianMTModel.from_pretrained(
-            "Helsinki-NLP/opus-mt-zh-en")
-        self.en2zh_tokenizer = MarianTokenizer.from_pretrained(
-            "Helsinki-NLP/opus-mt-en-zh")
-        self.en2zh_model = MarianMTModel.from_pretrained(
-            "Helsinki-NLP/opus-mt-en-zh")
+    """
+    MarianMT翻译器，按翻译方向懒加载：只有第一次翻译某个方向时才加载对应模型，未使用的方向不占内存。
+    backend='onnx' 时使用导出的ONNX（可选INT8）模型，optimum不可用时退回PyTorch。
+    """
+
+    def __init__(self, backend: str = TRANSLATOR_BACKEND, onnx_dir: str = TRANSLATOR_ONNX_DIR,
+                 int8: bool = TRANSLATOR_ONNX_INT8, greedy_max_tokens: int = TRANSLATOR_GREEDY_MAX_TOKENS):
+        self.backend = backend
+        self.onnx_dir = onnx_dir
+        self.int8 = int8
+        self.greedy_max_tokens = greedy_max_tokens
+        # (src_lang, tgt_lang) -> (tokenizer, model)
+        self._models: Dict[Tuple[str, str], tuple] = {}
+        self._lock = threading.Lock()
+
+    def _load_onnx(self, model_name: str, direction: Tuple[str, str]):
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+
+        output_dir = os.path.join(self.onnx_dir, f"{direction[0]}-{direction[1]}")
+        model_dir = os.path.join(output_dir, 'int8' if self.int8 else 'fp32')
+        if not os.path.exists(model_dir):
+            debug_logger.info(f"export translator to onnx: {model_name} -> {model_dir}")
+            model_dir = export_onnx(model_name, output_dir, self.int8)
+        suffix = '_quantized' if self.int8 else ''
+        model = ORTModelForSeq2SeqLM.from_pretrained(
+            model_dir,
+            encoder_file_name=f'encoder_model{suffix}.onnx',
+            decoder_file_name=f'decoder_model{suffix}.onnx',
+            decoder_with_past_file_name=f'decoder_with_past_model{suffix}.onnx')
+        return MarianTokenizer.from_pretrained(model_dir), model
+
+    def _get_model(self, src_lang: str, tgt_lang: str):
+        direction = (src_lang, tgt_lang)
+        if direction in self._models:
+            return self._models[direction]
+        if direction not in MODEL_NAMES:
+            raise ValueError(f'不支持的语言对: {src_lang}->{tgt_lang}')
+        with self._lock:
+            if direction not in self._models:
+                model_name = MODEL_NAMES[direction]
+                loaded = None
+                if self.backend == 'onnx':
+                    try:
+                        loaded = self._load_onnx(model_name, direction)
+                    except ImportError:
+                        debug_logger.warning("optimum[onnxruntime] is not installed, translator falls back to torch")
+                if loaded is None:
+                    model = MarianMTModel.from_pretrained(model_name)
+                    model.eval()
+                    loaded = (MarianTokenizer.from_pretrained(model_name), model)
+                debug_logger.info(f"translator loaded: {src_lang}->{tgt_lang}, backend: {type(loaded[1]).__name__}")
+                self._models[direction] = loaded
+        return self._models[direction]
+
+    def _generate(self, texts: List[str], src_lang: str, tgt_lang: str) -> List[str]:
+        tokenizer, model = self._get_model(src_lang, tgt_lang)
+        inputs = tokenizer(texts, return_tensors="pt", padding=True, truncation=True)
+        input_len = inputs['input_ids'].shape[1]
+        # 译文长度和原文长度相当，按输入长度限制生成长度，避免异常输入一直生成到模型上限
+        max_new_tokens = min(2 * input_len + 10, 512)
+        generate_kwargs = {'max_new_tokens': max_new_tokens}
+        # 短查询用贪心解码，beam search对检索query的质量提升很小，但耗时成倍增加；长查询沿用模型配置的num_beams
+        if input_len <= self.greedy_max_tokens:
+            generate_kwargs['num_beams'] = 1
+        translated = model.generate(**inputs, **generate_kwargs)
+        return [tokenizer.decode(t, skip_special_tokens=True) for t in translated]
 
     def zh2en(self, texts: List[str]) -> List[str]:
-        inputs = self.zh2en_tokenizer(
-            texts, return_tensors="pt", padding=True, truncation=True)
-        translated = self.zh2en_model.generate(**inputs)
-        return [self.zh2en_tokenizer.decode(t, skip_special_tokens=True) for t in translated]
+        return self._generate(texts, 'zh', 'en')
 
     def en2zh(self, texts: List[str]) -> List[str]:
-        inputs = self.en2zh_tokenizer(
-            texts, return_tensors="pt", padding=True, truncation=True)
-        translated = self.en2zh_model.generate(**inputs)
-        return [self.en2zh_tokenizer.decode(t, skip_special_tokens=True) for t in translated]
+        return self._generate(texts, 'en', 'zh')
 
     def translate(self, texts: List[str], src_lang: str, tgt_lang: str) -> List[str]:
         if src_lang == tgt_lang:
             return texts
-        if src_lang == 'zh' and tgt_lang == 'en':
-            return self.zh2en(texts)
-        elif src_lang == 'en' and tgt_lang == 'zh':
-            return self.en2zh(texts)
-        else:
-            raise ValueError(f'不支持的语言对: {src_lang}->{tgt_lang}')
+        return self._generate(texts, src_lang, tgt_lang)
 
 
 # ===== Seed-X vLLM 方案保留（以后可切换） =====
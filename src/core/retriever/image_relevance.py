@@ -0,0 +1,97 @@
+import os
+import sys
+from typing import List, Optional
+
+import numpy as np
+
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+from src.client.embedding.embedding_client import SBIEmbeddings
+from src.utils.log_handler import debug_logger
+from langchain.schema import Document
+
+# 综合得分中与回答相似度的权重，其余为检索/rerank分数
+ANSWER_SIMILARITY_WEIGHT = 0.7
+
+
+class ImageCandidates:
+    """
+    带图片的参考文档及其归一化后的向量矩阵，在大模型生成回答之前准备好
+    missing 为没有milvus向量的文档（如es检索结果）下标，回答结束后与回答一起计算向量
+    """
+    __slots__ = ('docs', 'matrix', 'missing', 'question_scores')
+
+    def __init__(self, docs: List[Document], matrix: Optional[np.ndarray], missing: List[int],
+                 question_scores: np.ndarray):
+        self.docs = docs
+        self.matrix = matrix
+        self.missing = missing
+        self.question_scores = question_scores
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+class ImageRelevance:
+    """
+    按与大模型回答的相关性挑选要展示图片的参考文档
+
+    - 候选文档的图片（metadata['images']）由prepare_source_documents从父块的metadata中取出
+    - 复用milvus检索时返回的chunk向量（metadata['embedding']），不再对图片文档逐段重新计算向量
+    - 回答结束后只计算一次回答的向量（缺少向量的文档与回答在同一次请求中计算），矩阵乘法得到余弦相似度
+    - 综合得分 = ANSWER_SIMILARITY_WEIGHT * 与回答的相似度 + (1 - ANSWER_SIMILARITY_WEIGHT) * 检索/rerank分数
+    """
+
+    def __init__(self, embeddings: SBIEmbeddings, answer_weight: float = ANSWER_SIMILARITY_WEIGHT):
+        self.embeddings = embeddings
+        self.answer_weight = answer_weight
+
+    @staticmethod
+    def prepare(docs: List[Document]) -> Optional[ImageCandidates]:
+        docs = [doc for doc in docs if doc.metadata.get('images', [])]
+        if not docs:
+            return None
+        vectors = [doc.metadata.get('embedding') for doc in docs]
+        missing = [i for i, vector in enumerate(vectors) if vector is None or len(vector) == 0]
+        matrix = None
+        if len(missing) < len(docs):
+            dim = next(len(vector) for vector in vectors if vector is not None and len(vector) != 0)
+            missing_set = set(missing)
+            matrix = np.zeros((len(docs), dim), dtype=np.float32)
+            for i, vector in enumerate(vectors):
+                if i not in missing_set:
+                    matrix[i] = vector
+            matrix = _normalize(matrix)
+        question_scores = np.asarray([float(doc.metadata.get('score', 0)) for doc in docs], dtype=np.float32)
+        return ImageCandidates(docs, matrix, missing, question_scores)
+
+    async def select(self, llm_answer: str, candidates: ImageCandidates, top_k: int = 1) -> List[dict]:
+        """
+        返回综合得分最高的top_k个文档：[{'document', 'segment', 'similarity_llm', 'question_score', 'combined_score'}]
+        """
+        texts = [llm_answer] + [candidates.docs[i].page_content for i in candidates.missing]
+        vectors = _normalize(np.asarray(await self.embeddings.aembed_documents(texts), dtype=np.float32))
+        answer_vector = vectors[0]
+        matrix = candidates.matrix
+        if candidates.missing:
+            if matrix is None:
+                matrix = np.zeros((len(candidates.docs), vectors.shape[1]), dtype=np.float32)
+            else:
+                matrix = matrix.copy()
+            matrix[candidates.missing] = vectors[1:]
+        similarities = matrix @ answer_vector
+        combined = self.answer_weight * similarities + (1 - self.answer_weight) * candidates.question_scores
+        order = np.argsort(-combined)[:top_k]
+        debug_logger.info(f"image relevance: docs num: {len(candidates.docs)}, "
+                          f"reused embeddings: {len(candidates.docs) - len(candidates.missing)}, "
+                          f"combined scores: {np.round(combined, 4).tolist()}")
+        return [{'document': candidates.docs[i],
+                 'segment': candidates.docs[i].page_content[:100],
+                 'similarity_llm': float(similarities[i]),
+                 'question_score': float(candidates.question_scores[i]),
+                 'combined_score': float(combined[i])} for i in order]
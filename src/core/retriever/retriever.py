@@ -1,11 +1,13 @@
 
 
+import asyncio
 import os
 import sys
 from typing import List
 
 from src.configs.configs import DEFAULT_PARENT_CHUNK_SIZE
-from src.utils.general_utils import get_time_async
+from src.utils.general_utils import get_time_async, reciprocal_rank_fusion
+from src.utils.deadline import RequestDeadline
 current_script_path = os.path.abspath(__file__)
 # 将项目根目录添加到sys.path
 root_dir = os.path.dirname(os.path.dirname(os.path.dirname(current_script_path)))
@@ -36,10 +38,18 @@ class Retriever:
         return await self.aadd_documents(docs, parent_chunk_size=parent_chunk_size,
                                                    es_client=self.es_client, ids=ids, single_parent=single_parent)
     async def get_retrieved_documents(self, query: str, vector_store: MilvusClient, es_store: ESClient, partition_keys: List[str], time_record: dict,
-                                    hybrid_search: bool, top_k: int, expr: str = None):
+                                    hybrid_search: bool, top_k: int, expr: str = None, deadline: RequestDeadline = None):
         milvus_start_time = time.perf_counter()
         #  把milvus搜索转为Document类型 
-        query_docs = vector_store.search_docs(query, expr, top_k, partition_keys)
+        # search_docs是同步调用（embedding请求+milvus检索），放到milvus客户端的线程池中执行，避免阻塞事件循环
+        loop = asyncio.get_running_loop()
+        milvus_search = loop.run_in_executor(vector_store.executor, vector_store.search_docs,
+                                             query, expr, top_k, partition_keys)
+        if deadline is not None:
+            # 超出milvus阶段预算时放弃向量检索结果，退化为无参考文档的回答
+            query_docs = await deadline.run('milvus', milvus_search, fallback=[])
+        else:
+            query_docs = await milvus_search
         for doc in query_docs:
             doc.metadata['retrieval_source'] = 'milvus'
         milvus_end_time = time.perf_counter()
@@ -49,7 +59,12 @@ class Retriever:
             return query_docs
         try:
             filter = [{"terms": {"metadata.kb_id.keyword": partition_keys}}]
-            es_sub_docs = await es_store.asimilarity_search(query, k=top_k, filter=filter)
+            es_search = es_store.asimilarity_search(query, k=top_k, filter=filter)
+            if deadline is not None:
+                # 超出es阶段预算时跳过es，只使用milvus的结果
+                es_sub_docs = await deadline.run('es', es_search, fallback=[])
+            else:
+                es_sub_docs = await es_search
             print(es_sub_docs)
             for doc in es_sub_docs:
                 doc.metadata['retrieval_source'] = 'es'
@@ -58,4 +73,47 @@ class Retriever:
             query_docs.extend(es_sub_docs)
         except Exception as e:
             debug_logger.error(f"Error in get_retrieved_documents on es_search: {e}")
-        return query_docs
\ No newline at end of file
+        return query_docs
+
+    async def get_multi_query_retrieved_documents(self, queries: List[str], vector_store: MilvusClient, es_store,
+                                                  partition_keys: List[str], time_record: dict, hybrid_search: bool,
+                                                  top_k: int, expr: str = None, deadline: RequestDeadline = None,
+                                                  rrf_k: int = 60):
+        """
+        多路查询检索：所有查询一次batch计算向量，一次milvus多向量检索（data=[v1, v2, ...]），
+        es的各路检索与milvus并发执行，结果用RRF融合
+        """
+        milvus_start_time = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        embeddings = await vector_store.embeddings.aembed_documents(queries)
+        milvus_search = loop.run_in_executor(vector_store.executor, vector_store.search_docs_by_embeddings,
+                                             embeddings, expr, top_k, partition_keys)
+        searches = [deadline.run('milvus', milvus_search, fallback=[]) if deadline is not None else milvus_search]
+        if hybrid_search:
+            filter = [{"terms": {"metadata.kb_id.keyword": partition_keys}}]
+            # 单路es失败不影响其它路的结果
+            es_search = asyncio.gather(*[es_store.asimilarity_search(query, k=top_k, filter=filter)
+                                         for query in queries], return_exceptions=True)
+            searches.append(deadline.run('es', es_search, fallback=[]) if deadline is not None else es_search)
+        results = await asyncio.gather(*searches)
+        time_record['retriever_multi_query'] = round(time.perf_counter() - milvus_start_time, 2)
+
+        ranked_lists = []
+        for query, docs in zip(queries, results[0]):
+            for doc in docs:
+                doc.metadata['retrieval_source'] = 'milvus'
+                doc.metadata['retrieval_query'] = query
+            ranked_lists.append(docs)
+        if hybrid_search:
+            for query, docs in zip(queries, results[1]):
+                if isinstance(docs, Exception):
+                    debug_logger.error(f"Error in get_multi_query_retrieved_documents on es_search: {docs}")
+                    continue
+                for doc in docs:
+                    doc.metadata['retrieval_source'] = 'es'
+                    doc.metadata['retrieval_query'] = query
+                ranked_lists.append(docs)
+        fused_docs = reciprocal_rank_fusion(ranked_lists, k=rrf_k)
+        debug_logger.info(f"multi query retrieval: {len(queries)} queries, {len(ranked_lists)} ranked lists, "
+                          f"{sum(len(docs) for docs in ranked_lists)} docs fused into {len(fused_docs)}")
+        return fused_docs
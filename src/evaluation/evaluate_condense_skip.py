@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+评测"独立问题跳过问题压缩"，样本来自线上真实的多轮问答日志（QaLogs，或导出的jsonl）：
+1. 离线：日志中的问题都经过了LLM压缩，压缩结果与原问题不同即视为需要压缩（标签），
+   统计分类器对不需要压缩的问题的跳过率，以及对需要压缩的问题的误跳过率，并输出误跳过的例子
+2. 在线（--online）：只对分类器判为跳过的样本，分别以 condense_skip=True/False 调用 local_doc_chat，
+   用 LLM 判断跳过压缩后的答案与压缩后的答案是否一致，对比一致率和耗时
+日志中已跳过压缩（condense_skipped）或没有压缩结果的记录不参与评测
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import requests
+from tqdm import tqdm
+from datetime import datetime
+
+# 将项目根目录添加到sys.path
+current_script_path = os.path.abspath(__file__)
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(current_script_path)))
+sys.path.append(root_dir)
+from src.configs.configs import DEFAULT_API_BASE, DEFAULT_API_KEY, DEFAULT_MODEL_NAME
+from src.core.chains.condense_classifier import CondenseClassifier
+
+CHAT_URL = "http://127.0.0.1:8777/api/local_doc_qa/local_doc_chat"
+JUDGE_URL = "https://api.chatanywhere.tech/v1/chat/completions"
+JUDGE_API_KEY = ""
+JUDGE_MODEL = "gpt-5-mini"
+
+JUDGE_PROMPT = (
+    "Given a question and two answers produced from the same knowledge base, output ONLY 1 if answer B "
+    "conveys the same key information as answer A for this question; otherwise output 0. Do not explain."
+)
+
+
+def _normalize(text):
+    return re.sub(r'[\s\W_]+', '', text or '').lower()
+
+
+def _parse_json(value, default):
+    if isinstance(value, (list, dict)):
+        return value
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def load_logs_from_mysql(limit):
+    from src.client.database.mysql.mysql_client import MysqlClient
+    rows = MysqlClient(pool_size=1).get_multi_turn_qalogs(limit)
+    keys = ["qa_id", "kb_ids", "query", "history", "condense_question", "condense_skipped"]
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def load_logs_from_file(path, limit):
+    # 每行一条QaLogs记录，字段同上
+    logs = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                logs.append(json.loads(line))
+    return logs[:limit] if limit else logs
+
+
+def build_samples(logs):
+    """
+    样本：history 为日志中的对话历史，condense_question 为当时LLM压缩的结果，
+    need_condense 为压缩结果是否改写了原问题
+    """
+    samples = []
+    for log in logs:
+        history = _parse_json(log.get("history"), [])
+        condense_question = log.get("condense_question") or ""
+        if not history or not condense_question or log.get("condense_skipped"):
+            continue
+        samples.append({"qa_id": log.get("qa_id"), "kb_ids": _parse_json(log.get("kb_ids"), []),
+                        "history": history, "question": log["query"], "condense_question": condense_question,
+                        "need_condense": _normalize(condense_question) != _normalize(log["query"])})
+    return samples
+
+
+def evaluate_offline(samples, show_examples=20):
+    classifier = CondenseClassifier()
+    stats = {False: [0, 0], True: [0, 0]}
+    false_skips = []
+    for sample in samples:
+        need, reason = classifier.needs_condense(sample["question"], sample["history"])
+        sample["predicted_need_condense"] = need
+        sample["reason"] = reason
+        stats[sample["need_condense"]][0] += int(not need)
+        stats[sample["need_condense"]][1] += 1
+        if sample["need_condense"] and not need:
+            false_skips.append(sample)
+    skipped, total = stats[False]
+    false_skipped, need_total = stats[True]
+    print(f"standalone skip rate: {skipped}/{total} ({skipped / max(total, 1):.1%})")
+    print(f"need-condense false skip rate: {false_skipped}/{need_total} ({false_skipped / max(need_total, 1):.1%})")
+    print(f"overall skipped: {classifier.skipped}/{classifier.total}")
+    for sample in false_skips[:show_examples]:
+        print(f"  false skip [{sample['reason']}]: {sample['question']} -> {sample['condense_question']}")
+    return {"standalone_skip_rate": round(skipped / max(total, 1), 4),
+            "false_skip_rate": round(false_skipped / max(need_total, 1), 4),
+            "standalone": total, "need_condense": need_total}
+
+
+def local_doc_chat(sample, kb_ids, condense_skip):
+    payload = {
+        "user_id": "Qwen3",
+        "user_info": "5678",
+        "max_token": 1024,
+        "kb_ids": kb_ids,
+        "question": sample["question"],
+        "history": sample["history"],
+        "streaming": False,
+        "rerank": True,
+        "model": DEFAULT_MODEL_NAME,
+        "api_base": DEFAULT_API_BASE,
+        "api_key": DEFAULT_API_KEY,
+        "api_context_length": 10000,
+        "top_p": 0.99,
+        "temperature": 0.5,
+        "top_k": 10,
+        "condense_skip": condense_skip,
+    }
+    resp = requests.post(CHAT_URL, json=payload, timeout=120)
+    data = resp.json()
+    if resp.status_code != 200 or data.get("code") != 200:
+        print("chat error:", data)
+        return None
+    return data
+
+
+def llm_judge(question, answer_a, answer_b):
+    """返回 0 或 1"""
+    payload = {
+        "model": JUDGE_MODEL,
+        "temperature": 0,
+        "messages": [
+            {"role": "system", "content": JUDGE_PROMPT},
+            {"role": "user", "content": f"Question: {question}\nAnswer A: {answer_a[:2000]}\nAnswer B: {answer_b[:2000]}"}
+        ]
+    }
+    headers = {"Authorization": f"Bearer {JUDGE_API_KEY}", "Content-Type": "application/json"}
+    resp = requests.post(JUDGE_URL, headers=headers, json=payload, timeout=30)
+    if resp.status_code != 200:
+        print("judge error:", resp.text)
+        return 0
+    try:
+        return int(resp.json()["choices"][0]["message"]["content"].strip()[0])
+    except Exception as e:
+        print("parse error:", e)
+        return 0
+
+
+def evaluate_online(samples, kb_ids):
+    # 判为需要压缩的样本两种模式走同一条路径，只比较判为跳过的样本
+    skipped_samples = [s for s in samples if not s["predicted_need_condense"]]
+    scores, latencies = [], {False: [], True: []}
+    for sample in tqdm(skipped_samples, desc="condense_skip"):
+        answers = {}
+        for condense_skip in (False, True):
+            start = time.perf_counter()
+            data = local_doc_chat(sample, kb_ids or sample["kb_ids"], condense_skip)
+            latencies[condense_skip].append(time.perf_counter() - start)
+            answers[condense_skip] = data.get("response", "") if data else ""
+        sample["answer_condensed"] = answers[False]
+        sample["answer_skipped"] = answers[True]
+        sample["consistent"] = llm_judge(sample["condense_question"], answers[False], answers[True])
+        scores.append(sample["consistent"])
+    summary = {
+        "compared": len(skipped_samples),
+        "consistency": round(sum(scores) / max(len(scores), 1), 4),
+        "avg_latency_condensed": round(sum(latencies[False]) / max(len(latencies[False]), 1), 2),
+        "avg_latency_skipped": round(sum(latencies[True]) / max(len(latencies[True]), 1), 2),
+    }
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--online", action="store_true", help="调用local_doc_chat对比跳过前后的答案")
+    parser.add_argument("--logs_file", default="", help="导出的QaLogs jsonl，不指定时从mysql读取")
+    parser.add_argument("--kb_ids", nargs="*", default=[], help="在线评测使用的知识库，默认使用日志中的kb_ids")
+    parser.add_argument("--limit", type=int, default=1000, help="最多读取的日志条数")
+    args = parser.parse_args()
+
+    logs = load_logs_from_file(args.logs_file, args.limit) if args.logs_file else load_logs_from_mysql(args.limit)
+    samples = build_samples(logs)
+    print(f"logs: {len(logs)}, samples: {len(samples)}")
+    result = {"offline": evaluate_offline(samples), "samples": samples}
+    if args.online:
+        result["online"] = evaluate_online(samples, args.kb_ids)
+
+    output_file = f"condense_skip_result_{datetime.now().strftime('%m%d%H%M%S')}.json"
+    with open(output_file, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"results saved -> {output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,8 @@ import os
 
 import time
 import traceback
+import functools
+import math
 import urllib
 
 from tqdm import tqdm
@@ -29,6 +31,7 @@ from src.core.qa_handler import QAHandler
 from src.utils.log_handler import debug_logger
 from src.utils.general_utils import  fast_estimate_file_char_count
 from src.core.file_handler.file_handler import LocalFile, FileHandler
+from src.core.file_handler.chunk_index import file_hash
 from sanic import request
 from sanic.response import text as sanic_text
 from sanic.response import json as sanic_json
@@ -36,8 +39,11 @@ from sanic.response import ResponseStream
 from datetime import datetime, timedelta
 from src.configs.configs import DEFAULT_PARENT_CHUNK_SIZE, \
     MAX_CHARS, VECTOR_SEARCH_TOP_K, DEFAULT_API_BASE, DEFAULT_API_KEY,\
-          DEFAULT_API_CONTEXT_LENGTH, DEFAULT_MODEL_PATH
+          DEFAULT_API_CONTEXT_LENGTH, DEFAULT_MODEL_PATH, CHAT_REQUEST_TIMEOUT, MULTI_QUERY_ENABLED, \
+          MULTI_QUERY_MAX_QUERIES, CONDENSE_SKIP_ENABLED, FILE_QUEUE_NOTIFY_URL
+from src.utils.deadline import RequestDeadline
 import uuid
+import aiohttp
 
 def format_source_documents(ori_source_documents):
     source_documents = []
@@ -79,6 +85,22 @@ def format_time_record(time_record):
             token_usage['total_tokens'] += token_usage['rewrite_completion_tokens']
     return {"time_usage": time_usage, "token_usage": token_usage}
 
+async def notify_file_queue():
+    # 通知入库服务有新文件，接收到通知的worker立即领取；通知失败时由入库服务的定时轮询兜底
+    if not FILE_QUEUE_NOTIFY_URL:
+        return
+    try:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=1)) as session:
+            async with session.post(FILE_QUEUE_NOTIFY_URL) as resp:
+                await resp.read()
+    except Exception as e:
+        debug_logger.warning(f"notify file queue failed: {e}")
+
+async def save_qalog(qa_handler: QAHandler, chat_data):
+    # 问答日志的INSERT是同步的mysql调用，放到线程池中执行，不阻塞事件循环
+    await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+        qa_handler.mysql_client.add_qalog, **chat_data))
+
 @get_time_async
 async def document(req: request):
     description = """
@@ -148,7 +170,8 @@ async def upload_files(req: request):
     kb_id = safe_get(req, 'kb_id')
     # kb_id = correct_kb_id(kb_id)
     debug_logger.info("kb_id %s", kb_id)
-    mode = safe_get(req, 'mode', default='soft')  # soft代表不上传同名文件，strong表示强制上传同名文件
+    # soft代表不上传同名文件，strong表示强制上传同名文件，update表示同名文件作为新版本增量更新（只写入变化的父块）
+    mode = safe_get(req, 'mode', default='soft')
     debug_logger.info("mode: %s", mode)
     chunk_size = safe_get(req, 'chunk_size', default=DEFAULT_PARENT_CHUNK_SIZE)
     debug_logger.info("chunk_size: %s", chunk_size)
@@ -186,26 +209,47 @@ async def upload_files(req: request):
         file_names.append(file_name)   
 
     exist_file_names = []
-    if mode == 'soft':
+    update_files = {}
+    if mode == 'update':
+        # 已入库完成且有父块哈希索引的同名文件可以增量更新，其余同名文件与soft模式一样跳过
+        update_files = {f[1]: f for f in qa_handler.mysql_client.get_indexed_files_by_name(user_id, kb_id, file_names)}
+    if mode in ('soft', 'update'):
         exist_files = qa_handler.mysql_client.check_file_exist_by_name(user_id, kb_id, file_names)
-        exist_file_names = [f[1] for f in exist_files]
+        exist_file_names = [f[1] for f in exist_files if f[1] not in update_files]
         for exist_file in exist_files:
             file_id, file_name, file_size, status = exist_file
-            debug_logger.info(f"{file_name}, {status}, existed files, skip upload")
+            if file_name not in update_files:
+                debug_logger.info(f"{file_name}, {status}, existed files, skip upload")
             # await post_data(user_id, -1, file_id, status, msg='existed files, skip upload')
 
+    # 内容完全相同的文件（不论文件名）直接跳过，strong模式除外
+    content_hashes = [None if isinstance(file, str) else file_hash(file.body) for file in files]
+    exist_hashes = set()
+    if mode != 'strong':
+        exist_hashes = {f[2] for f in qa_handler.mysql_client.check_file_exist_by_hash(
+            user_id, kb_id, [h for h in content_hashes if h])}
+
     now = datetime.now()
     timestamp = now.strftime("%Y%m%d%H%M")
 
     failed_files = []
     record_exist_files = []
-    for file, file_name in zip(files, file_names):
+    updated_files = []
+    for file, file_name, content_hash in zip(files, file_names, content_hashes):
         # 对于数据库中同名文件直接跳过，不保存到本地服务器上
         if file_name in exist_file_names:
             record_exist_files.append(file_name)
             continue
-        # 将文件保存到本地
-        local_file = LocalFile(user_id, kb_id, file, file_name)
+        if content_hash in exist_hashes:
+            debug_logger.info(f"{file_name}, {content_hash}, identical content exists, skip upload")
+            record_exist_files.append(file_name)
+            continue
+        if content_hash and mode != 'strong':
+            # 同一次请求中内容相同的文件只上传一次
+            exist_hashes.add(content_hash)
+        # 将文件保存到本地，更新已有文件时覆盖原文件目录下的旧版本
+        old_file_id = update_files[file_name][0] if file_name in update_files else None
+        local_file = LocalFile(user_id, kb_id, file, file_name, file_id=old_file_id)
         # TODO：功能待完善，上传文件类型检查
         chars = fast_estimate_file_char_count(local_file.file_location)
         debug_logger.info(f"{file_name} char_size: {chars}")
@@ -216,11 +260,23 @@ async def upload_files(req: request):
         file_id = local_file.file_id
         file_size = len(local_file.file_content)
         file_location = local_file.file_location
-        # local_files.append(local_file)
-        # 加到mysql数据库中
-        msg = qa_handler.mysql_client.add_file(file_id, user_id, kb_id, file_name, file_size, file_location,
-                                                   chunk_size, timestamp)
-        debug_logger.info(f"{file_name}, {file_id}, {msg}")
+        if old_file_id:
+            # 沿用原文件的file_id重新入库，入库时与旧版本按父块哈希比对，只写入变化的部分
+            old_file_location = update_files[file_name][2]
+            qa_handler.mysql_client.requeue_file_version(old_file_id, file_size, file_location, chunk_size,
+                                                         timestamp, content_hash)
+            debug_logger.info(f"{file_name}, {old_file_id}, update to new version: {file_location}")
+            updated_files.append(file_name)
+            if old_file_location != file_location and os.path.exists(old_file_location):
+                os.remove(old_file_location)
+        else:
+            # local_files.append(local_file)
+            # 加到mysql数据库中
+            msg = qa_handler.mysql_client.add_file(file_id, user_id, kb_id, file_name, file_size, file_location,
+                                                   chunk_size, timestamp, content_hash=content_hash)
+            debug_logger.info(f"{file_name}, {file_id}, {msg}")
+        data.append({"file_id": file_id, "file_name": file_name, "status": "gray", "bytes": file_size,
+                     "timestamp": timestamp, "estimated_chars": chars})
         # # 将文件切割向量化并保存到向量数据库中
         # kb_name = qa_handler.mysql_client.get_knowledge_base_name([local_file.kb_id])[0][2]
         # file_handler = FileHandler(local_file.user_id, kb_name, local_file.kb_id, 
@@ -268,6 +324,10 @@ async def upload_files(req: request):
         msg = f"warning, {record_exist_files} exist in {user_id} and {kb_id}, skip upload."
     else:
         msg = "success，后台正在飞速上传文件，请耐心等待"
+    if updated_files:
+        msg += f" {updated_files} will be updated incrementally."
+    if len(record_exist_files) + len(failed_files) < len(files):
+        await notify_file_queue()
     return sanic_json({"code": 200, "msg": msg, "data": data})
 
 
@@ -308,9 +368,32 @@ async def local_doc_chat(req: request):
 
     hybrid_search = safe_get(req, 'hybrid_search', False)
     chunk_size = safe_get(req, 'chunk_size', DEFAULT_PARENT_CHUNK_SIZE)
+    # 整个请求的超时时间（秒），从收到请求开始计算
+    timeout = safe_get(req, 'timeout', CHAT_REQUEST_TIMEOUT)
+    # 多路检索及本次请求的最大检索路数（不超过MULTI_QUERY_MAX_QUERIES）
+    multi_query = safe_get(req, 'multi_query', MULTI_QUERY_ENABLED)
+    max_queries = safe_get(req, 'max_queries', MULTI_QUERY_MAX_QUERIES)
+    # 会话id，客户端在后续轮次回传，服务端据此复用同一会话的问题压缩结果
+    # 只有客户端传入的id参与压缩缓存；未传时按完整对话历史缓存，响应中返回新生成的id供后续轮次使用
+    client_conversation_id = safe_get(req, 'conversation_id') or None
+    conversation_id = client_conversation_id or uuid.uuid4().hex
+    # 跳过独立问题的压缩需要请求显式开启，CONDENSE_SKIP_ENABLED为服务端总开关
+    condense_skip = bool(safe_get(req, 'condense_skip', False)) and CONDENSE_SKIP_ENABLED
 
     debug_logger.info('rerank %s', rerank)
 
+    # timeout必须是正数，max_queries限制在[1, MULTI_QUERY_MAX_QUERIES]之间，参数非法时返回2001而不是500
+    try:
+        timeout = float(timeout)
+    except (TypeError, ValueError):
+        timeout = None
+    if timeout is None or not math.isfinite(timeout) or timeout <= 0:
+        return sanic_json({"code": 2001, "msg": "fail, timeout should be a positive number"})
+    try:
+        max_queries = min(max(int(max_queries), 1), MULTI_QUERY_MAX_QUERIES)
+    except (TypeError, ValueError):
+        return sanic_json({"code": 2001, "msg": "fail, max_queries should be an integer"})
+
     if len(kb_ids) > 20:
         return sanic_json({"code": 2005, "msg": "fail, kb_ids length should less than or equal to 20"})
     
@@ -363,7 +446,11 @@ async def local_doc_chat(req: request):
     debug_logger.info("top_k: %s", top_k)
     debug_logger.info("temperature: %s", temperature)
     debug_logger.info("hybrid_search: %s", hybrid_search)
+    debug_logger.info("multi_query: %s, max_queries: %s", multi_query, max_queries)
+    debug_logger.info("conversation_id: %s", conversation_id)
+    debug_logger.info("condense_skip: %s", condense_skip)
     debug_logger.info("chunk_size: %s", chunk_size)
+    debug_logger.info("timeout: %s", timeout)
 
     qa_handler.milvus_client.load_collection_(user_id)
     if kb_ids:
@@ -386,6 +473,7 @@ async def local_doc_chat(req: request):
     preprocess_end = time.perf_counter()
     time_record = {}
     time_record['preprocess'] = round(preprocess_end - preprocess_start, 2)
+    deadline = RequestDeadline(timeout, time_record, start=preprocess_start)
     # 获取查询的时间，更新mysql中知识库的最后查询时间,获取格式为'2021-08-01 00:00:00'的时间戳
     # qa_timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))
     # for kb_id in kb_ids:
@@ -413,7 +501,13 @@ async def local_doc_chat(req: request):
                                                                                     api_key=api_key,
                                                                                     api_context_length=api_context_length,
                                                                                     top_p=top_p,
-                                                                                    top_k=top_k
+                                                                                    top_k=top_k,
+                                                                                    deadline=deadline,
+                                                                                    multi_query=multi_query,
+                                                                                    max_queries=max_queries,
+                                                                                    conversation_id=client_conversation_id,
+                                                                                    condense_skip=condense_skip,
+                                                                                    user_id=user_id
                                                                                     ):
                 chunk_data = resp["result"]
                 if not chunk_data:
@@ -434,8 +528,9 @@ async def local_doc_chat(req: request):
                                 'history': history,
                                 'condense_question': resp['condense_question'], 'prompt': resp['prompt'],
                                 'result': result, 'retrieval_documents': retrieval_documents,
-                                'source_documents': source_documents}
-                    qa_handler.mysql_client.add_qalog(**chat_data)
+                                'source_documents': source_documents,
+                                'condense_skipped': bool(time_record.get('condense_skipped'))}
+                    await save_qalog(qa_handler, chat_data)
                     debug_logger.info("chat_data: %s", chat_data)
                     debug_logger.info("response: %s", chat_data['result'])
                     stream_res = {
@@ -449,7 +544,8 @@ async def local_doc_chat(req: request):
                         "source_documents": source_documents,
                         "retrieval_documents": retrieval_documents,
                         "time_record": formatted_time_record,
-                        "show_images": resp.get('show_images', [])
+                        "show_images": resp.get('show_images', []),
+                        "conversation_id": conversation_id
                     }
                 else:
                     time_record['rollback_length'] = resp.get('rollback_length', 0)
@@ -493,7 +589,13 @@ async def local_doc_chat(req: request):
                                                                            api_key=api_key,
                                                                            api_context_length=api_context_length,
                                                                            top_p=top_p,
-                                                                           top_k=top_k
+                                                                           top_k=top_k,
+                                                                           deadline=deadline,
+                                                                           multi_query=multi_query,
+                                                                           max_queries=max_queries,
+                                                                           conversation_id=client_conversation_id,
+                                                                           condense_skip=condense_skip,
+                                                                           user_id=user_id
                                                                            ):
             pass
             
@@ -509,15 +611,16 @@ async def local_doc_chat(req: request):
                     'history': history, "condense_question": resp['condense_question'], "model": model,
                     "product_source": request_source,
                     'retrieval_documents': retrieval_documents, 'prompt': resp['prompt'], 'result': resp['result'],
-                    'source_documents': source_documents}
-        # qa_handler.mysql_client.add_qalog(**chat_data)
+                    'source_documents': source_documents,
+                    'condense_skipped': bool(time_record.get('condense_skipped'))}
+        await save_qalog(qa_handler, chat_data)
         debug_logger.info("chat_data: %s", chat_data)
         debug_logger.info("response: %s", chat_data['result'])
         return sanic_json({"code": 200, "msg": "success no stream chat", "question": question,
                         "response": resp["result"], "model": model,
                         "history": history, "condense_question": resp['condense_question'],
                         "source_documents": source_documents, "retrieval_documents": retrieval_documents,
-                        "time_record": formatted_time_record})
+                        "time_record": formatted_time_record, "conversation_id": conversation_id})
 
 @get_time_async
 async def list_kbs(req: request):
@@ -610,6 +713,79 @@ async def upload_faqs(req: request):
             {"file_id": file_id, "file_name": file_name, "status": "gray", "length": file_size,
              "timestamp": timestamp})
     debug_logger.info(f"end insert {len(faqs)} faqs to mysql, user_id: {user_id}, kb_id: {kb_id}")
-
     msg = "success，后台正在飞速上传文件，请耐心等待"
+    if data:
+        await notify_file_queue()
     return sanic_json({"code": 200, "msg": msg, "data": data})
+
+@get_time_async
+async def delete_docs(req: request):
+    qa_handler: QAHandler = req.app.ctx.qa_handler
+    user_id = safe_get(req, 'user_id')
+    user_info = safe_get(req, 'user_info', "1234")
+    passed, msg = check_user_id_and_user_info(user_id, user_info)
+    if not passed:
+        return sanic_json({"code": 2001, "msg": msg})
+    user_id = user_id + '__' + user_info
+    debug_logger.info("delete_docs %s", user_id)
+    kb_id = safe_get(req, 'kb_id')
+    file_ids = safe_get(req, 'file_ids')
+    if not file_ids:
+        return sanic_json({"code": 2001, "msg": "fail, file_ids is empty"})
+    not_exist_kb_ids = qa_handler.mysql_client.check_kb_exist(user_id, [kb_id])
+    if not_exist_kb_ids:
+        msg = "invalid kb_id: {}, please check...".format(not_exist_kb_ids)
+        return sanic_json({"code": 2001, "msg": msg})
+    # 软删除后文件立即不再参与检索，milvus/es/Documents中的数据由入库服务在后台分批清理
+    task_id, total = qa_handler.mysql_client.create_delete_task(user_id, kb_id, file_ids)
+    qa_handler.mysql_client.bump_kb_content_version(kb_id)
+    debug_logger.info(f"delete_docs task: {task_id}, kb_id: {kb_id}, files: {total}")
+    await notify_file_queue()
+    return sanic_json({"code": 200, "msg": "success，后台正在删除文件，可通过get_delete_progress查询进度",
+                       "data": {"task_id": task_id, "total": total}})
+
+@get_time_async
+async def delete_knowledge_base(req: request):
+    qa_handler: QAHandler = req.app.ctx.qa_handler
+    user_id = safe_get(req, 'user_id')
+    user_info = safe_get(req, 'user_info', "1234")
+    passed, msg = check_user_id_and_user_info(user_id, user_info)
+    if not passed:
+        return sanic_json({"code": 2001, "msg": msg})
+    user_id = user_id + '__' + user_info
+    debug_logger.info("delete_knowledge_base %s", user_id)
+    kb_ids = safe_get(req, 'kb_ids')
+    if not kb_ids:
+        return sanic_json({"code": 2001, "msg": "fail, kb_ids is empty"})
+    not_exist_kb_ids = qa_handler.mysql_client.check_kb_exist(user_id, kb_ids)
+    if not_exist_kb_ids:
+        msg = "invalid kb_id: {}, please check...".format(not_exist_kb_ids)
+        return sanic_json({"code": 2001, "msg": msg})
+    data = []
+    for kb_id in kb_ids:
+        task_id, total = qa_handler.mysql_client.create_delete_task(user_id, kb_id)
+        qa_handler.mysql_client.bump_kb_content_version(kb_id)
+        debug_logger.info(f"delete_knowledge_base task: {task_id}, kb_id: {kb_id}, files: {total}")
+        data.append({"kb_id": kb_id, "task_id": task_id, "total": total})
+    await notify_file_queue()
+    return sanic_json({"code": 200, "msg": "success，后台正在删除知识库，可通过get_delete_progress查询进度",
+                       "data": data})
+
+@get_time_async
+async def get_delete_progress(req: request):
+    qa_handler: QAHandler = req.app.ctx.qa_handler
+    user_id = safe_get(req, 'user_id')
+    user_info = safe_get(req, 'user_info', "1234")
+    passed, msg = check_user_id_and_user_info(user_id, user_info)
+    if not passed:
+        return sanic_json({"code": 2001, "msg": msg})
+    user_id = user_id + '__' + user_info
+    task_id = safe_get(req, 'task_id')
+    task = qa_handler.mysql_client.get_delete_task(user_id, task_id)
+    if task is None:
+        return sanic_json({"code": 2001, "msg": "invalid task_id: {}".format(task_id)})
+    task['delete_kb'] = bool(task['delete_kb'])
+    task['creation_time'] = str(task['creation_time'])
+    task['update_time'] = str(task['update_time'])
+    task['progress'] = round(task['done'] / task['total'], 4) if task['total'] else 1.0
+    return sanic_json({"code": 200, "msg": "success", "data": task})
@@ -0,0 +1,333 @@
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import socket
+import argparse
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+from src.configs.configs import DEFAULT_PARENT_CHUNK_SIZE, MAX_CHARS, INGEST_PARSE_WORKERS, INGEST_EMBED_WORKERS, \
+    LOCAL_EMBED_BATCH, FILE_QUEUE_LEASE_TIMEOUT
+from src.utils.log_handler import insert_logger
+from src.utils.general_utils import check_user_id_and_user_info, check_filename, fast_estimate_file_char_count
+from src.client.embedding.embedding_client import SBIEmbeddings, _process_query
+from src.client.database.milvus.milvus_client import MilvusClient
+from src.client.database.mysql.mysql_client import MysqlClient
+from src.client.database.elasticsearch.es_client import ESClient
+from src.core.file_handler.chunk_index import file_hash
+from src.server.handle_file_server.ingest_pipeline import IngestPipeline
+
+"""
+批量导入目录到知识库，不经过upload_files和入库队列：
+
+    python src/server/handle_file_server/bulk_ingest.py --dir raw_files/XiangshanDocs --user_id abc --kb_name 香山文档
+
+- 文件原地引用（file_location为文件的绝对路径），不再读入内存再写到上传目录
+- 直接使用IngestPipeline：子进程池解析、大批量向量化（--embed local 在当前进程用EmbeddingBackend计算）、批量写入
+- 断点续传：每个文件的内容哈希、file_id和状态记录在checkpoint文件中，重新运行时跳过已完成且未修改的文件，
+  修改过的文件按父块哈希增量更新，中断时未完成的文件清理后重新导入
+- 与知识库中已有文件内容相同的文件跳过
+"""
+
+SUPPORTED_EXTENSIONS = ('.txt', '.pdf', '.md', '.docx', '.doc', '.html', '.ppt', '.pptx', '.xml',
+                        '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff')
+
+
+class LocalEmbeddings:
+    """
+    在当前进程中用EmbeddingBackend（onnx）计算向量，不经过embedding服务的HTTP接口
+    与SBIEmbeddings.aembed_documents接口一致，推理在单独的线程中串行执行
+    """
+
+    def __init__(self, use_cpu: bool = False, batch_size: int = LOCAL_EMBED_BATCH):
+        from src.server.embedding_server.embedding_backend import EmbeddingBackend
+        self.backend = EmbeddingBackend(use_cpu=use_cpu)
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        embeddings = self.backend.encode([_process_query(text) for text in texts], batch_size=self.batch_size,
+                                         normalize_to_unit=True, return_numpy=True,
+                                         max_length=self.backend.max_length)
+        return embeddings.tolist()
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._embed, texts)
+
+
+class Checkpoint:
+    """
+    断点续传记录，按相对路径记录每个文件的 {'hash', 'file_id', 'status', 'msg'}
+    status: green 已入库，red 失败，skipped 跳过（内容重复或超长），yellow 导入中（进程中断时留下）
+    写入时先写临时文件再rename，进程在任何时刻退出都不会留下损坏的记录
+    """
+
+    def __init__(self, path: str, flush_interval: float = 5.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.data = {'user_id': None, 'kb_id': None, 'files': {}}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.data = json.load(f)
+        self._dirty = False
+        self._last_flush = time.monotonic()
+
+    @property
+    def files(self) -> dict:
+        return self.data['files']
+
+    def update(self, rel_path: str, **fields):
+        self.files.setdefault(rel_path, {}).update(fields)
+        self._dirty = True
+        if time.monotonic() - self._last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not self._dirty:
+            return
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+        self._last_flush = time.monotonic()
+
+
+def hash_file(path: str) -> str:
+    with open(path, 'rb') as f:
+        return file_hash(f.read())
+
+
+def scan_dir(root: str, extensions: Tuple[str, ...]) -> List[Tuple[str, str]]:
+    files = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = sorted(d for d in dir_names if not d.startswith('.'))
+        for file_name in sorted(file_names):
+            if file_name.lower().endswith(extensions):
+                path = os.path.join(dir_path, file_name)
+                files.append((os.path.relpath(path, root), os.path.abspath(path)))
+    return files
+
+
+class BulkIngest:
+    def __init__(self, pipeline: IngestPipeline, mysql_client: MysqlClient, milvus_client: MilvusClient,
+                 es_client: ESClient, checkpoint: Checkpoint, user_id: str, kb_id: str, chunk_size: int,
+                 concurrency: int, retry_failed: bool):
+        self.pipeline = pipeline
+        self.mysql_client = mysql_client
+        self.milvus_client = milvus_client
+        self.es_client = es_client
+        self.checkpoint = checkpoint
+        self.user_id = user_id
+        self.kb_id = kb_id
+        self.chunk_size = chunk_size
+        self.retry_failed = retry_failed
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # 本次运行中已导入的文件内容哈希，内容相同的文件只导入一次
+        self._hashes = set()
+        self.stats = {'green': 0, 'red': 0, 'skipped': 0, 'unchanged': 0, 'chunks': 0, 'chars': 0}
+        self.start = None
+        # 导入中的文件与入库队列一样持有租约，删除任务据此等待导入结束，进程退出后租约过期
+        self.owner = f"bulk_ingest:{socket.gethostname()}:{os.getpid()}"
+
+    async def _keep_alive(self, file_id: str):
+        while True:
+            await asyncio.sleep(FILE_QUEUE_LEASE_TIMEOUT / 3)
+            try:
+                if not self.mysql_client.renew_file_lease(file_id, self.owner, FILE_QUEUE_LEASE_TIMEOUT):
+                    insert_logger.warning(f"{self.owner} lost lease of file: {file_id}")
+                    return
+            except Exception as e:
+                insert_logger.error(f"renew lease error, file_id: {file_id}, {e}")
+
+    def _cleanup(self, file_id: str):
+        # 上次导入中途退出：写入了多少数据未知，按file_id全部删除并清空父块索引，再完整导入一次
+        rows = self.mysql_client.get_chunk_index(file_id)
+        self.milvus_client.delete_expr(f'file_id == "{file_id}"', self.user_id)
+        self.es_client.delete_by_file_ids([file_id])
+        self.mysql_client.delete_parent_chunks([row[1] for row in rows])
+        self.mysql_client.replace_chunk_index(file_id, [])
+
+    async def ingest_file(self, rel_path: str, path: str):
+        async with self._semaphore:
+            try:
+                await self._ingest_file(rel_path, path)
+            except Exception as e:
+                insert_logger.error(f'bulk ingest {rel_path} error: {traceback.format_exc()}')
+                self.stats['red'] += 1
+                self.checkpoint.update(rel_path, status='red', msg=str(e)[:200])
+
+    async def _ingest_file(self, rel_path: str, path: str):
+        loop = asyncio.get_running_loop()
+        content_hash = await loop.run_in_executor(None, hash_file, path)
+        entry = self.checkpoint.files.get(rel_path, {})
+        if entry.get('hash') == content_hash and (entry.get('status') in ('green', 'skipped') or
+                                                  (entry.get('status') == 'red' and not self.retry_failed)):
+            self.stats['unchanged'] += 1
+            return
+        file_name = check_filename(os.path.basename(path), max_length=200)
+        if file_name is None:
+            self.stats['skipped'] += 1
+            self.checkpoint.update(rel_path, hash=content_hash, status='skipped', msg='file name too long')
+            return
+        chars = fast_estimate_file_char_count(path)
+        if chars and chars > MAX_CHARS:
+            self.stats['skipped'] += 1
+            self.checkpoint.update(rel_path, hash=content_hash, status='skipped',
+                                   msg=f'chars {chars} exceeds {MAX_CHARS}')
+            return
+        file_size = os.path.getsize(path)
+        timestamp = time.strftime("%Y%m%d%H%M")
+        file_id, status = entry.get('file_id'), entry.get('status')
+        if not file_id:
+            # checkpoint落盘前进程退出：File表中已有该文件的记录，沿用它而不是当作重复内容跳过
+            row = self.mysql_client.get_file_by_location(self.user_id, self.kb_id, path, content_hash)
+            if row is not None:
+                file_id, status = row
+                if status == 'green':
+                    self._hashes.add(content_hash)
+                    self.stats['unchanged'] += 1
+                    self.checkpoint.update(rel_path, hash=content_hash, file_id=file_id, status='green', msg='')
+                    return
+        if file_id:
+            if not self.mysql_client.acquire_file_lease(file_id, self.owner, FILE_QUEUE_LEASE_TIMEOUT):
+                # 文件正在被入库服务或另一个导入进程处理，下次运行时再导入
+                self.stats['skipped'] += 1
+                insert_logger.warning(f'bulk ingest {rel_path}: {file_id} is being ingested by another process')
+                return
+            if status != 'green':
+                await loop.run_in_executor(self.milvus_client.executor, self._cleanup, file_id)
+            # 已导入过的文件：沿用file_id，入库时按父块哈希与上一版本比对
+            self.mysql_client.requeue_file_version(file_id, file_size, path, self.chunk_size, timestamp,
+                                                   content_hash, status='yellow')
+        else:
+            if content_hash in self._hashes or \
+                    self.mysql_client.check_file_exist_by_hash(self.user_id, self.kb_id, [content_hash]):
+                self.stats['skipped'] += 1
+                self.checkpoint.update(rel_path, hash=content_hash, status='skipped', msg='identical content exists')
+                return
+            file_id = uuid.uuid4().hex
+            # yellow状态的文件不会被入库队列领取
+            self.mysql_client.add_file(file_id, self.user_id, self.kb_id, file_name, file_size, path,
+                                       self.chunk_size, timestamp, status='yellow', content_hash=content_hash)
+            self.mysql_client.acquire_file_lease(file_id, self.owner, FILE_QUEUE_LEASE_TIMEOUT)
+        self._hashes.add(content_hash)
+        self.checkpoint.update(rel_path, hash=content_hash, file_id=file_id, status='yellow', msg='')
+        # 写入数据前落盘，中断后重新运行时能找到file_id并清理写了一半的数据
+        self.checkpoint.flush()
+        file_info = (0, file_id, self.user_id, file_name, self.kb_id, path, file_size, '', self.chunk_size)
+        time_record = {}
+        keep_alive = asyncio.create_task(self._keep_alive(file_id))
+        try:
+            status, content_length, chunks_number, msg = await self.pipeline.submit(file_info, time_record)
+        finally:
+            keep_alive.cancel()
+        self.mysql_client.update_file_result(file_id, status, content_length, chunks_number, msg)
+        self.stats[status] = self.stats.get(status, 0) + 1
+        if status == 'green':
+            self.stats['chars'] += max(content_length, 0)
+            msg = ''
+        insert_logger.info(f'bulk ingest {rel_path}: {status}, {json.dumps(time_record, ensure_ascii=False)}')
+        self.checkpoint.update(rel_path, status=status, msg=msg[:200])
+
+    def report(self, total: int) -> str:
+        elapsed = time.perf_counter() - self.start
+        done = sum(self.stats[key] for key in ('green', 'red', 'skipped', 'unchanged'))
+        # 写入milvus的子块数，包括失败文件已写入的部分
+        chunks = self.pipeline.metrics()['stages']['vector_write']['items']
+        ingested = self.stats['green'] + self.stats['red']
+        return (f"[{done}/{total}] {elapsed:.0f}s, green: {self.stats['green']}, red: {self.stats['red']}, "
+                f"skipped: {self.stats['skipped']}, unchanged: {self.stats['unchanged']}, "
+                f"docs/s: {ingested / elapsed:.2f}, chunks/s: {chunks / elapsed:.1f}")
+
+    async def _report_progress(self, total: int, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            print(self.report(total), flush=True)
+
+    async def run(self, files: List[Tuple[str, str]], report_interval: float):
+        self.start = time.perf_counter()
+        reporter = asyncio.create_task(self._report_progress(len(files), report_interval))
+        try:
+            await asyncio.gather(*[self.ingest_file(rel_path, path) for rel_path, path in files])
+        finally:
+            reporter.cancel()
+            self.checkpoint.flush()
+        if self.stats['green']:
+            # 知识库内容已变化，递增版本号使检索缓存失效
+            self.mysql_client.bump_kb_content_version(self.kb_id)
+        print(self.report(len(files)), flush=True)
+        print(json.dumps(self.pipeline.metrics(), ensure_ascii=False, indent=1), flush=True)
+
+
+async def main(args):
+    passed, msg = check_user_id_and_user_info(args.user_id, args.user_info)
+    if not passed:
+        raise SystemExit(msg)
+    user_id = args.user_id + '__' + args.user_info
+    root = os.path.abspath(args.dir)
+    checkpoint = Checkpoint(args.checkpoint or os.path.join(root, '.bulk_ingest_checkpoint.json'))
+    if checkpoint.data['user_id'] not in (None, user_id):
+        raise SystemExit(f"checkpoint belongs to user {checkpoint.data['user_id']}, use another --checkpoint")
+
+    mysql_client = MysqlClient()
+    kb_id = args.kb_id or checkpoint.data['kb_id']
+    if kb_id is None:
+        if not args.kb_name:
+            raise SystemExit("either --kb_id or --kb_name is required")
+        kb_id = 'KB' + uuid.uuid4().hex
+        mysql_client.new_milvus_base(kb_id, user_id, args.kb_name)
+        print(f"created knowledge base {args.kb_name}: {kb_id}")
+    elif mysql_client.check_kb_exist(user_id, [kb_id]):
+        raise SystemExit(f"invalid kb_id: {kb_id}")
+    if checkpoint.data['kb_id'] not in (None, kb_id):
+        raise SystemExit(f"checkpoint belongs to kb {checkpoint.data['kb_id']}, use another --checkpoint")
+    checkpoint.data['user_id'] = user_id
+    checkpoint.data['kb_id'] = kb_id
+
+    extensions = tuple(ext if ext.startswith('.') else '.' + ext for ext in args.extensions)
+    files = scan_dir(root, extensions)
+    print(f"{len(files)} files under {root}, kb_id: {kb_id}, checkpoint: {checkpoint.path}")
+
+    embeddings = LocalEmbeddings(use_cpu=args.use_cpu) if args.embed == 'local' else SBIEmbeddings()
+    milvus_client = MilvusClient()
+    es_client = ESClient()
+    pipeline = IngestPipeline(milvus_client, mysql_client, es_client, embeddings,
+                              parse_workers=args.parse_workers, embed_workers=args.embed_workers,
+                              embed_batch_size=args.embed_batch_size, queue_size=args.queue_size)
+    pipeline.start()
+    bulk = BulkIngest(pipeline, mysql_client, milvus_client, es_client, checkpoint, user_id, kb_id,
+                      args.chunk_size, args.concurrency, args.retry_failed)
+    await bulk.run(files, args.report_interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='批量导入目录中的文件到知识库')
+    parser.add_argument('--dir', required=True, help='要导入的目录，递归遍历')
+    parser.add_argument('--user_id', required=True)
+    parser.add_argument('--user_info', default='1234')
+    parser.add_argument('--kb_id', default=None, help='导入到已有知识库')
+    parser.add_argument('--kb_name', default=None, help='新建知识库的名称（没有--kb_id且checkpoint中也没有时）')
+    parser.add_argument('--chunk_size', type=int, default=DEFAULT_PARENT_CHUNK_SIZE)
+    parser.add_argument('--extensions', nargs='+', default=list(SUPPORTED_EXTENSIONS))
+    parser.add_argument('--checkpoint', default=None, help='默认为 <dir>/.bulk_ingest_checkpoint.json')
+    parser.add_argument('--embed', choices=['server', 'local'], default='server',
+                        help='server: 请求embedding服务；local: 当前进程中用EmbeddingBackend计算')
+    parser.add_argument('--use_cpu', action='store_true', help='--embed local时只用CPU')
+    parser.add_argument('--concurrency', type=int, default=16, help='同时在流水线中的文件数')
+    parser.add_argument('--parse_workers', type=int, default=max(INGEST_PARSE_WORKERS, (os.cpu_count() or 2) // 2))
+    parser.add_argument('--embed_workers', type=int, default=INGEST_EMBED_WORKERS)
+    parser.add_argument('--embed_batch_size', type=int, default=256)
+    parser.add_argument('--queue_size', type=int, default=16)
+    parser.add_argument('--retry_failed', action='store_true', help='重新导入上次失败且未修改的文件')
+    parser.add_argument('--report_interval', type=float, default=10)
+    asyncio.run(main(parser.parse_args()))
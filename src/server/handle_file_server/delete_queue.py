@@ -0,0 +1,109 @@
+import os
+import sys
+from typing import Optional
+
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+from src.configs.configs import FILE_QUEUE_LEASE_TIMEOUT, FILE_QUEUE_MAX_ATTEMPTS
+from src.utils.log_handler import insert_logger
+
+DELETE_TASK_FIELDS = "task_id, user_id, kb_id, delete_kb, total, done"
+
+
+class DeleteTaskQueue:
+    """
+    基于DeleteTasks表的删除任务队列，租约机制与FileJobQueue相同：
+
+    - 领取：SELECT ... FOR UPDATE SKIP LOCKED，同一事务内改为running并写入租约
+    - 进度：每清理完一批文件写入done并续租；worker崩溃后租约过期，任务重新变为pending，
+      已清理的文件已移出任务，重新执行时从剩下的文件继续
+    - 重试次数达到 max_attempts 后标记为failed
+    """
+
+    def __init__(self, pool, owner: str, lease_timeout: int = FILE_QUEUE_LEASE_TIMEOUT,
+                 max_attempts: int = FILE_QUEUE_MAX_ATTEMPTS):
+        self.pool = pool
+        self.owner = owner
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+
+    async def claim(self) -> Optional[tuple]:
+        """
+        领取一个待执行的任务，返回 (task_id, user_id, kb_id, delete_kb, total, done)，没有任务时返回None
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                try:
+                    await cur.execute(
+                        f"SELECT {DELETE_TASK_FIELDS} FROM DeleteTasks WHERE status = 'pending' "
+                        f"ORDER BY id ASC LIMIT 1 FOR UPDATE SKIP LOCKED")
+                    task = await cur.fetchone()
+                    if task is None:
+                        await conn.commit()
+                        return None
+                    await cur.execute(
+                        "UPDATE DeleteTasks SET status = 'running', lease_owner = %s, "
+                        "lease_expires = DATE_ADD(NOW(), INTERVAL %s SECOND), attempts = attempts + 1 "
+                        "WHERE task_id = %s", (self.owner, self.lease_timeout, task[0]))
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+        insert_logger.info(f"{self.owner} claimed delete task: {task[0]}, kb_id: {task[2]}, files: {task[4]}")
+        return task
+
+    async def progress(self, task_id: str, done: int) -> bool:
+        """
+        写入已清理的文件数并续租，租约已被回收时返回False
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "UPDATE DeleteTasks SET done = %s, lease_expires = DATE_ADD(NOW(), INTERVAL %s SECOND) "
+                    "WHERE task_id = %s AND status = 'running' AND lease_owner = %s",
+                    (done, self.lease_timeout, task_id, self.owner))
+                await conn.commit()
+                return cur.rowcount > 0
+
+    async def complete(self, task_id: str, done: int) -> bool:
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "UPDATE DeleteTasks SET status = 'done', done = %s, msg = 'success', "
+                    "lease_owner = NULL, lease_expires = NULL "
+                    "WHERE task_id = %s AND status = 'running' AND lease_owner = %s",
+                    (done, task_id, self.owner))
+                await conn.commit()
+                return cur.rowcount > 0
+
+    async def release(self, task_id: str, msg: str):
+        """
+        执行出错时释放任务，未达到重试次数的重新变为pending
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "UPDATE DeleteTasks SET status = IF(attempts >= %s, 'failed', 'pending'), msg = %s, "
+                    "lease_owner = NULL, lease_expires = NULL "
+                    "WHERE task_id = %s AND status = 'running' AND lease_owner = %s",
+                    (self.max_attempts, msg[:255], task_id, self.owner))
+                await conn.commit()
+
+    async def reclaim_expired(self) -> int:
+        """
+        回收租约过期的任务（执行它的worker已崩溃或卡死），返回重新入队的任务数
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "UPDATE DeleteTasks SET status = IF(attempts >= %s, 'failed', 'pending'), "
+                    "lease_owner = NULL, lease_expires = NULL "
+                    "WHERE status = 'running' AND lease_expires < NOW()", (self.max_attempts,))
+                reclaimed = cur.rowcount
+                await conn.commit()
+        if reclaimed:
+            insert_logger.warning(f"reclaim expired delete tasks: {reclaimed}")
+        return reclaimed
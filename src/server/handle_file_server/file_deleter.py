@@ -0,0 +1,77 @@
+import os
+import sys
+import json
+import time
+import asyncio
+from typing import List, Tuple
+
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+from src.configs.configs import DELETE_BATCH_SIZE, FILE_QUEUE_POLL_INTERVAL
+from src.client.database.milvus.milvus_client import MilvusClient
+from src.client.database.mysql.mysql_client import MysqlClient
+from src.client.database.elasticsearch.es_client import ESClient
+from src.server.handle_file_server.delete_queue import DeleteTaskQueue
+from src.utils.log_handler import insert_logger
+
+
+class FileDeleter:
+    """
+    执行删除任务：每次取batch_size个已软删除的文件，依次删除
+
+    - milvus：按用户集合、知识库分区分组，'file_id in [...]' 表达式删除
+    - es：按metadata.file_id delete_by_query，不依赖子块编号（增量更新后的编号不连续）
+    - mysql：Documents按doc_id前缀删除，以及FileChunks、Faqs、FileImages，最后把文件移出任务
+    每一步都可以重复执行，一批中途失败时整批重试，不会留下孤立的向量；
+    正在入库的文件等入库结束（租约释放或过期）后再清理
+    """
+
+    def __init__(self, milvus_client: MilvusClient, mysql_client: MysqlClient, es_client: ESClient,
+                 batch_size: int = DELETE_BATCH_SIZE, wait_interval: float = FILE_QUEUE_POLL_INTERVAL):
+        self.milvus_client = milvus_client
+        self.mysql_client = mysql_client
+        self.es_client = es_client
+        self.batch_size = batch_size
+        self.wait_interval = wait_interval
+
+    def _purge(self, files: List[Tuple[str, str, str]]):
+        groups = {}
+        for file_id, user_id, kb_id in files:
+            groups.setdefault((user_id, kb_id), []).append(file_id)
+        for (user_id, kb_id), file_ids in groups.items():
+            self.milvus_client.delete_expr(f'file_id in {json.dumps(file_ids)}', user_id, partition_name=kb_id)
+        file_ids = [file[0] for file in files]
+        self.es_client.delete_by_file_ids(file_ids)
+        self.mysql_client.purge_files(file_ids)
+
+    async def run(self, queue: DeleteTaskQueue, task: tuple) -> bool:
+        """
+        执行一个任务直到所有文件清理完成，租约丢失时返回False（任务已由其它worker接手）
+        """
+        task_id, user_id, kb_id, delete_kb, total, done = task
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        while True:
+            files = self.mysql_client.get_delete_task_files(task_id, self.batch_size)
+            remaining = self.mysql_client.count_delete_task_files(task_id)
+            if not files:
+                if not remaining:
+                    break
+                # 剩下的文件正在入库，续租后等待
+                if not await queue.progress(task_id, total - remaining):
+                    return False
+                await asyncio.sleep(self.wait_interval)
+                continue
+            batch_start = time.perf_counter()
+            await loop.run_in_executor(self.milvus_client.executor, self._purge, files)
+            done = total - remaining + len(files)
+            insert_logger.info(f"delete task {task_id}: purged {len(files)} files in "
+                               f"{round(time.perf_counter() - batch_start, 2)}s, progress: {done}/{total}")
+            if not await queue.progress(task_id, done):
+                return False
+        insert_logger.info(f"delete task {task_id} done, kb_id: {kb_id}, delete_kb: {bool(delete_kb)}, "
+                           f"files: {total}, cost: {round(time.perf_counter() - start, 2)}s")
+        return await queue.complete(task_id, total)
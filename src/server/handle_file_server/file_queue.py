@@ -0,0 +1,146 @@
+import os
+import sys
+import asyncio
+from typing import List, Tuple
+
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+from src.configs.configs import FILE_QUEUE_LEASE_TIMEOUT, FILE_QUEUE_MAX_ATTEMPTS
+from src.utils.log_handler import insert_logger
+
+FILE_INFO_FIELDS = ("id, file_id, user_id, file_name, kb_id, file_location, file_size, file_url, chunk_size, "
+                    "attempts, needs_rebuild")
+
+
+class FileJobQueue:
+    """
+    基于File表的文件入库任务队列
+
+    - 领取：在 (status, deleted, timestamp) 索引上按时间顺序 SELECT ... FOR UPDATE SKIP LOCKED，
+      同一事务内把领到的文件改为yellow并写入租约（lease_owner, lease_expires），多个worker并发领取互不阻塞
+    - 续租：处理过程中定期延长租约；worker崩溃后租约过期，文件重新变为gray由其它worker领取，
+      重试次数达到 max_attempts 后标记为red
+    - 完成：只有仍持有租约的worker才能写入处理结果
+    - 重试（attempts > 1）前由IngestPipeline清理中断的入库写入的数据；租约被回收的worker写入结果失败时标记
+      needs_rebuild，文件处理完成后重新变为gray，按file_id清空后完整入库一次（两个worker的doc_id可能重复）
+    需要MySQL 8.0+（SKIP LOCKED）
+    """
+
+    def __init__(self, pool, owner: str, lease_timeout: int = FILE_QUEUE_LEASE_TIMEOUT,
+                 max_attempts: int = FILE_QUEUE_MAX_ATTEMPTS):
+        self.pool = pool
+        self.owner = owner
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+
+    async def claim(self, limit: int) -> List[tuple]:
+        """
+        领取最多limit个待处理文件，返回File记录：(id, file_id, user_id, file_name, kb_id, file_location, file_size,
+        file_url, chunk_size, attempts, needs_rebuild)
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                try:
+                    await cur.execute(
+                        "SELECT id FROM File WHERE status = 'gray' AND deleted = 0 "
+                        "ORDER BY timestamp ASC, id ASC LIMIT %s FOR UPDATE SKIP LOCKED", (limit,))
+                    ids = [row[0] for row in await cur.fetchall()]
+                    if not ids:
+                        await conn.commit()
+                        return []
+                    placeholders = ','.join(['%s'] * len(ids))
+                    await cur.execute(
+                        f"UPDATE File SET status = 'yellow', lease_owner = %s, "
+                        f"lease_expires = DATE_ADD(NOW(), INTERVAL %s SECOND), attempts = attempts + 1 "
+                        f"WHERE id IN ({placeholders})", (self.owner, self.lease_timeout, *ids))
+                    await cur.execute(f"SELECT {FILE_INFO_FIELDS} FROM File WHERE id IN ({placeholders}) "
+                                      f"ORDER BY timestamp ASC, id ASC", ids)
+                    file_infos = list(await cur.fetchall())
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+        insert_logger.info(f"{self.owner} claimed files: {[file_info[1] for file_info in file_infos]}")
+        return file_infos
+
+    async def renew(self, id: int) -> bool:
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "UPDATE File SET lease_expires = DATE_ADD(NOW(), INTERVAL %s SECOND) "
+                    "WHERE id = %s AND status = 'yellow' AND lease_owner = %s", (self.lease_timeout, id, self.owner))
+                await conn.commit()
+                return cur.rowcount > 0
+
+    async def keep_alive(self, id: int):
+        """
+        处理期间每隔 lease_timeout/3 续租一次，随处理任务一起取消
+        """
+        while True:
+            await asyncio.sleep(self.lease_timeout / 3)
+            try:
+                if not await self.renew(id):
+                    insert_logger.warning(f"{self.owner} lost lease of file id: {id}")
+                    return
+            except Exception as e:
+                insert_logger.error(f"renew lease error, id: {id}, {e}")
+
+    async def complete(self, id: int, status: str, content_length: int, chunks_number: int, msg: str) -> bool:
+        """
+        写入处理结果并释放租约，租约已经被回收（超时后被其它worker领取）时不写入，返回False
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                # 处理期间被标记为需要重建的文件重新入队
+                await cur.execute(
+                    "UPDATE File SET status = IF(needs_rebuild, 'gray', %s), content_length = %s, chunks_number = %s, "
+                    "msg = %s, lease_owner = NULL, lease_expires = NULL "
+                    "WHERE id = %s AND status = 'yellow' AND lease_owner = %s",
+                    (status, content_length, chunks_number, msg, id, self.owner))
+                await conn.commit()
+                return cur.rowcount > 0
+
+    async def mark_rebuild(self, id: int):
+        """
+        租约已被回收但本worker已经写入了数据：标记文件需要重建。接手的worker还在处理时由它完成后重新入队，
+        否则直接重新入队
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "UPDATE File SET needs_rebuild = 1, status = IF(status = 'yellow', status, 'gray'), "
+                    "attempts = IF(status = 'yellow', attempts, 0) WHERE id = %s AND deleted = 0", (id,))
+                await conn.commit()
+
+    async def reclaim_expired(self) -> Tuple[int, List[tuple]]:
+        """
+        回收租约过期的文件（处理它的worker已崩溃或卡死），返回 (重新入队的文件数, 重试次数用完标记为red的File记录)
+        标记为red的文件不会再重试，调用方需要清理中断的入库写入的数据
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                try:
+                    await cur.execute(
+                        f"SELECT {FILE_INFO_FIELDS} FROM File WHERE status = 'yellow' AND lease_expires < NOW() "
+                        f"AND attempts >= %s FOR UPDATE SKIP LOCKED", (self.max_attempts,))
+                    failed = list(await cur.fetchall())
+                    if failed:
+                        placeholders = ','.join(['%s'] * len(failed))
+                        await cur.execute(
+                            f"UPDATE File SET status = 'red', msg = %s, lease_owner = NULL, lease_expires = NULL "
+                            f"WHERE id IN ({placeholders})",
+                            (f"process failed after {self.max_attempts} attempts", *[row[0] for row in failed]))
+                    await cur.execute(
+                        "UPDATE File SET status = 'gray', lease_owner = NULL, lease_expires = NULL "
+                        "WHERE status = 'yellow' AND lease_expires < NOW()")
+                    requeued = cur.rowcount
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+        if failed or requeued:
+            insert_logger.warning(f"reclaim expired leases, requeued: {requeued}, failed: {len(failed)}")
+        return requeued, failed
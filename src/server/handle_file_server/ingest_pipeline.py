@@ -0,0 +1,577 @@
+import os
+import sys
+import asyncio
+import json
+import random
+import time
+import traceback
+from typing import List, Tuple
+
+# 获取当前脚本的绝对路径
+current_script_path = os.path.abspath(__file__)
+# 将项目根目录添加到sys.path
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(current_script_path))))
+sys.path.append(root_dir)
+from src.configs.configs import MAX_CHARS, INGEST_PARSE_WORKERS, INGEST_EMBED_WORKERS, INGEST_EMBED_BATCH_SIZE, \
+    INGEST_QUEUE_SIZE, INGEST_METRICS_INTERVAL, ES_BULK_BATCH_SIZE, ES_BULK_CONCURRENCY
+from src.core.file_handler.file_handler import FileHandler
+from src.core.file_handler.parse_pool import ParsePool, ParseError
+from src.core.file_handler.chunk_index import ChunkIndex
+from src.client.embedding.embedding_client import SBIEmbeddings
+from src.client.database.milvus.milvus_client import MilvusClient
+from src.client.database.mysql.mysql_client import MysqlClient
+from src.client.database.elasticsearch.es_client import ESClient
+from src.utils.log_handler import insert_logger
+
+INSERT_TIMEOUT_SECONDS = 300
+
+
+class IngestJob:
+    """
+    一个文件在流水线中的状态。文件的chunk以ChunkBatch为单位在各阶段流转，
+    解析结束（parsed）且所有批次写入完成（pending为0）时设置future的结果
+    index 为文件的父块哈希索引，文件更新时只有变化的父块及其子块进入下游
+    """
+    __slots__ = ('file_info', 'content_length', 'chunks_number', 'docs_number', 'pending', 'parsed', 'written',
+                 'completing', 'index', 'time_record', 'start', 'enqueued', 'future')
+
+    def __init__(self, file_info, time_record: dict, future: asyncio.Future):
+        self.file_info = file_info
+        self.content_length = -1
+        # 父块数
+        self.chunks_number = 0
+        # 需要写入的子块数
+        self.docs_number = 0
+        # 尚未走完流水线的批次数
+        self.pending = 0
+        self.parsed = False
+        # 已写入milvus的批次数，文件失败时据此清理已写入的数据
+        self.written = 0
+        self.completing = False
+        self.index = None
+        self.time_record = time_record
+        self.start = time.perf_counter()
+        # 进入当前阶段队列的时间，用于统计排队耗时
+        self.enqueued = self.start
+        self.future = future
+
+    @property
+    def file_id(self):
+        return self.file_info[1]
+
+    # 队列领取的文件带有重试次数和是否需要重建，批量导入的文件在提交前已自行清理，没有这两个字段
+    @property
+    def attempts(self):
+        return self.file_info[9] if len(self.file_info) > 9 else 0
+
+    @property
+    def needs_rebuild(self):
+        return bool(self.file_info[10]) if len(self.file_info) > 10 else False
+
+    @property
+    def failed(self):
+        # 成功的文件在所有批次写完后才设置结果，批次还在流转时future已完成只可能是失败
+        return self.future.done()
+
+
+class ChunkBatch:
+    """
+    一个文件的一批chunk，普通文件只有一批，流式解析的PDF每解析完若干页产出一批
+    offset 为这批子块在文件中的起始编号
+    """
+    __slots__ = ('job', 'docs', 'full_docs', 'embeddings', 'offset', 'enqueued')
+
+    def __init__(self, job: IngestJob, docs: list, full_docs: list, offset: int):
+        self.job = job
+        self.docs = docs
+        self.full_docs = full_docs
+        self.embeddings = []
+        self.offset = offset
+        self.enqueued = time.perf_counter()
+
+
+class StageMetrics:
+    """
+    单个阶段的统计：队列深度、处理的批次数和chunk数、忙碌时间（解析阶段一个文件记一批）
+    """
+    __slots__ = ('name', 'queue', 'workers', 'batches', 'items', 'errors', 'busy', 'wait')
+
+    def __init__(self, name: str, queue: asyncio.Queue, workers: int):
+        self.name = name
+        self.queue = queue
+        self.workers = workers
+        self.batches = 0
+        self.items = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.wait = 0.0
+
+    def record(self, batches: int, items: int, busy: float, wait: float):
+        self.batches += batches
+        self.items += items
+        self.busy += busy
+        self.wait += wait
+
+    def snapshot(self, elapsed: float) -> dict:
+        return {
+            'queue_depth': self.queue.qsize(),
+            'batches': self.batches,
+            'items': self.items,
+            'errors': self.errors,
+            'items_per_second': round(self.items / self.busy, 2) if self.busy else 0.0,
+            'avg_wait': round(self.wait / self.batches, 2) if self.batches else 0.0,
+            # 阶段所有worker的忙碌时间占比，接近1说明该阶段是瓶颈
+            'utilization': round(self.busy / (elapsed * self.workers), 3) if elapsed else 0.0,
+        }
+
+
+class IngestPipeline:
+    """
+    文件入库流水线：解析 -> 向量化 -> milvus/mysql写入 -> es写入，阶段之间用有界队列连接
+
+    - 解析：parse_workers 个并发的解析任务（独立子进程中执行，见ParsePool），文件N+1的解析与文件N的向量化重叠；
+      PDF流式解析，每解析完若干页就把这批chunk送入下游，大文件的第一批chunk不必等整个文件解析完就能入库
+    - 向量化：embed_workers 个批处理任务，队列中多个批次的chunk合并成一次请求，保持embedding服务满载
+    - milvus/mysql写入：单个写入任务串行执行（load_collection_会切换milvus客户端的当前集合），按列批量insert
+    - es写入：es_workers 个任务用helpers.async_bulk写入，队列中的批次合并到es_batch_size个chunk，与下一个文件的milvus写入重叠；
+      有文件在入库时放宽索引的refresh_interval，写入不再逐批refresh，文件完成时refresh一次（同时完成的文件共用）
+    队列有界，下游变慢时上游阻塞在put上（流式解析的子进程随之阻塞在管道上），内存中的chunk数有上界
+    """
+
+    def __init__(self, milvus_client: MilvusClient, mysql_client: MysqlClient, es_client: ESClient,
+                 embeddings: SBIEmbeddings = None, parse_workers: int = INGEST_PARSE_WORKERS,
+                 embed_workers: int = INGEST_EMBED_WORKERS, embed_batch_size: int = INGEST_EMBED_BATCH_SIZE,
+                 queue_size: int = INGEST_QUEUE_SIZE, es_workers: int = ES_BULK_CONCURRENCY,
+                 es_batch_size: int = ES_BULK_BATCH_SIZE):
+        self.milvus_client = milvus_client
+        self.mysql_client = mysql_client
+        self.es_client = es_client
+        self.embeddings = embeddings or SBIEmbeddings()
+        self.parse_workers = parse_workers
+        self.embed_workers = embed_workers
+        self.embed_batch_size = embed_batch_size
+        self.es_workers = es_workers
+        self.es_batch_size = es_batch_size
+        self.parse_pool = ParsePool(parse_workers)
+        self.parse_queue = asyncio.Queue(queue_size)
+        self.embed_queue = asyncio.Queue(queue_size)
+        self.write_queue = asyncio.Queue(queue_size)
+        self.es_queue = asyncio.Queue(queue_size)
+        self.stages = {
+            'parse': StageMetrics('parse', self.parse_queue, parse_workers),
+            'embed': StageMetrics('embed', self.embed_queue, embed_workers),
+            'vector_write': StageMetrics('vector_write', self.write_queue, 1),
+            'es_write': StageMetrics('es_write', self.es_queue, es_workers),
+        }
+        self.completed = 0
+        self.failed = 0
+        self.started = None
+        self._tasks = []
+        self._background = set()
+        # es refresh的请求序号和已完成refresh覆盖到的序号，见_refresh_es
+        self._refresh_requested = 0
+        self._refreshed = 0
+        self._refresh_lock = asyncio.Lock()
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._tasks = [asyncio.create_task(self._parse_worker()) for _ in range(self.parse_workers)]
+        self._tasks += [asyncio.create_task(self._embed_worker()) for _ in range(self.embed_workers)]
+        self._tasks.append(asyncio.create_task(self._vector_writer()))
+        self._tasks += [asyncio.create_task(self._es_writer()) for _ in range(self.es_workers)]
+        self._tasks.append(asyncio.create_task(self._report_metrics()))
+
+    async def submit(self, file_info, time_record: dict) -> Tuple[str, int, int, str]:
+        """
+        提交一个文件并等待处理完成，返回 (status, content_length, chunks_number, msg)
+        """
+        job = IngestJob(file_info, time_record, asyncio.get_running_loop().create_future())
+        if self.es_client is not None:
+            await self.es_client.aenter_bulk_mode()
+        await self.parse_queue.put(job)
+        return await job.future
+
+    def metrics(self) -> dict:
+        elapsed = time.perf_counter() - self.started if self.started else 0.0
+        return {
+            'completed': self.completed,
+            'failed': self.failed,
+            'stages': {name: stage.snapshot(elapsed) for name, stage in self.stages.items()},
+        }
+
+    def _finish(self, job: IngestJob, status: str, msg: str):
+        if job.future.done():
+            return
+        if status == 'green':
+            self.completed += 1
+        else:
+            self.failed += 1
+        job.future.set_result((status, job.content_length, job.chunks_number, msg))
+        if self.es_client is not None:
+            self._spawn(self.es_client.aexit_bulk_mode())
+
+    def _fail(self, stage: str, jobs: List[IngestJob], msg: str):
+        self.stages[stage].errors += len(jobs)
+        for job in jobs:
+            self._finish(job, 'red', msg)
+            self._settle(job)
+
+    def _settle(self, job: IngestJob):
+        """
+        所有批次都走完流水线后：失败的文件清理已写入的chunk，解析已结束的文件标记完成
+        """
+        if job.pending:
+            return
+        if job.failed:
+            if job.written:
+                job.written = 0
+                self._spawn(self._discard(job))
+        elif job.parsed and not job.completing:
+            job.completing = True
+            self._spawn(self._complete(job))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def _release(self, batch: ChunkBatch):
+        job = batch.job
+        job.pending -= 1
+        if not job.failed and 'first_chunk_time' not in job.time_record:
+            # 第一批chunk入库的耗时，流式解析的大文件远小于upload_total_time
+            job.time_record['first_chunk_time'] = round(time.perf_counter() - job.start, 2)
+        self._settle(job)
+
+    def _delete_chunks(self, job: IngestJob, rows: list):
+        """
+        删除一组父块（ChunkIndex的行）在milvus、es和Documents表中的数据
+        """
+        user_id = job.file_info[2]
+        doc_ids = [row[1] for row in rows]
+        for i in range(0, len(doc_ids), 1000):
+            expr = f'file_id == "{job.file_id}" and doc_id in {json.dumps(doc_ids[i:i + 1000])}'
+            self.milvus_client.delete_expr(expr, user_id)
+        es_ids = job.index.es_ids(rows)
+        if self.es_client is not None and es_ids:
+            self.es_client.delete(es_ids)
+        self.mysql_client.delete_parent_chunks(doc_ids)
+
+    def _clean_stale(self, file_info, rebuild: bool) -> list:
+        """
+        清理之前中断的入库（崩溃、租约过期被回收、重试次数用完）写入的数据，返回清理后仍有效的父块索引
+        - 默认：FileChunks中记录的是上一次成功入库的版本，不在其中的doc_id都是中断的入库写入的，删除
+        - rebuild：同一文件曾被两个worker同时写入，doc_id可能重复，按file_id删除全部数据并清空索引，重新完整入库
+        """
+        file_id, user_id = file_info[1], file_info[2]
+        rows = [] if rebuild else self.mysql_client.get_chunk_index(file_id)
+        keep_doc_ids = [row[1] for row in rows]
+        expr = f'file_id == "{file_id}"'
+        if keep_doc_ids:
+            expr += f' and doc_id not in {json.dumps(keep_doc_ids)}'
+        self.milvus_client.delete_expr(expr, user_id)
+        if self.es_client is not None:
+            self.es_client.delete_by_file_id_except(file_id, ChunkIndex(file_id, 0, rows).es_ids(rows))
+        self.mysql_client.delete_parent_chunks_except(file_id, keep_doc_ids)
+        if rebuild:
+            self.mysql_client.replace_chunk_index(file_id, [])
+            self.mysql_client.clear_file_rebuild(file_id)
+        insert_logger.info(f"cleaned stale chunks of {file_id}, rebuild: {rebuild}, kept parents: {len(rows)}")
+        return rows
+
+    async def clean_stale(self, file_info, rebuild: bool = False) -> list:
+        return await asyncio.get_running_loop().run_in_executor(self.milvus_client.executor, self._clean_stale,
+                                                                file_info, rebuild)
+
+    async def _discard(self, job: IngestJob):
+        # 只删除本次新写入的父块，文件更新失败时旧版本的数据保持不变
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.milvus_client.executor, self._delete_chunks, job, job.index.added)
+        except Exception as e:
+            insert_logger.error(f'delete chunks of {job.file_id} error: {traceback.format_exc()}')
+
+    @staticmethod
+    def _add_time(job: IngestJob, key: str, seconds: float):
+        # 流式解析的文件有多个批次，各阶段耗时累加
+        job.time_record[key] = round(job.time_record.get(key, 0) + seconds, 2)
+
+    async def _forward(self, queue: asyncio.Queue, item):
+        item.enqueued = time.perf_counter()
+        await queue.put(item)
+
+    async def _emit(self, job: IngestJob, docs: list, full_docs: list):
+        # 内容没有变化的父块沿用已入库的数据，其余父块重新编号后送入下游
+        offset = job.index.next_child
+        docs, full_docs = job.index.apply(docs, full_docs)
+        job.chunks_number = job.index.chunks_number
+        if not full_docs:
+            return
+        batch = ChunkBatch(job, docs, full_docs, offset)
+        job.docs_number += len(docs)
+        job.pending += 1
+        await self._forward(self.embed_queue, batch)
+
+    async def _parse_pdf_stream(self, job: IngestJob, file_args: tuple, chunk_size: int):
+        stream = self.parse_pool.iter_parse_pdf(file_args, chunk_size)
+        try:
+            async for result in stream:
+                job.content_length = result[1]
+                if result[0] == 'done':
+                    break
+                if job.failed:
+                    # 已写入的批次在下游失败了，不再继续解析
+                    break
+                await self._emit(job, result[2], result[3])
+                self.mysql_client.update_file_msg(job.file_id, f'Processing:{random.randint(5, 50)}%')
+        finally:
+            await stream.aclose()
+
+    async def _parse_worker(self):
+        while True:
+            job = await self.parse_queue.get()
+            start = time.perf_counter()
+            _, file_id, user_id, file_name, kb_id, file_location, file_size, file_url, chunk_size = job.file_info[:9]
+            try:
+                # 获取格式为'2021-08-01 00:00:00'的时间戳
+                insert_timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+                self.mysql_client.update_knowlegde_base_latest_insert_time(kb_id, insert_timestamp)
+                kb_name = self.mysql_client.get_knowledge_base_name(kb_id)
+                self.mysql_client.update_file_msg(file_id, f'Processing:{random.randint(1, 5)}%')
+                file_args = (user_id, kb_name, kb_id, file_id, file_location, file_name, file_url)
+                # 文件的新版本：按父块哈希与已入库的版本比对；重试时先清理之前中断的入库写入的数据
+                if job.attempts > 1 or job.needs_rebuild:
+                    rows = await self.clean_stale(job.file_info, job.needs_rebuild)
+                else:
+                    rows = self.mysql_client.get_chunk_index(file_id)
+                job.index = ChunkIndex(file_id, chunk_size, rows)
+                if file_location == 'FAQ':
+                    # FAQ只有一个问题，需要从mysql读取，直接在当前进程处理
+                    file_handler = FileHandler(*file_args, chunk_size, self.mysql_client)
+                    file_handler.split_file_to_docs()
+                    job.content_length = sum([len(doc.page_content) for doc in file_handler.docs])
+                    if 0 < job.content_length <= MAX_CHARS:
+                        await self._emit(job, *FileHandler.split_docs(file_handler.docs, chunk_size))
+                elif file_location.lower().endswith('.pdf'):
+                    # 逐页解析，边解析边送入下游；超长时子进程提前停止解析
+                    await self._parse_pdf_stream(job, file_args, chunk_size)
+                else:
+                    # 解析文件，提取文本并切分；超时或超出内存限制时子进程被终止
+                    job.content_length, docs, full_docs = await self.parse_pool.parse(file_args, chunk_size)
+                    if 0 < job.content_length <= MAX_CHARS:
+                        await self._emit(job, docs, full_docs)
+            except ParseError as e:
+                insert_logger.error(f'parse {file_name} failed: {e}')
+                self._fail('parse', [job], str(e))
+                continue
+            except Exception as e:
+                insert_logger.error(f'split_file_to_docs error: {traceback.format_exc()}')
+                self._fail('parse', [job], "split_file_to_docs error")
+                continue
+            if job.failed:
+                continue
+            if job.content_length > MAX_CHARS:
+                self._fail('parse', [job],
+                           f"{file_name} content_length too large, {job.content_length} >= MaxLength({MAX_CHARS})")
+                continue
+            elif job.content_length == 0:
+                self._fail('parse', [job], f"{file_name} content_length is 0, file content is empty or "
+                                           f"The URL exists anti-crawling or requires login.")
+                continue
+            end = time.perf_counter()
+            job.time_record['parse_time'] = round(end - start, 2)
+            self.stages['parse'].record(1, job.docs_number, end - start, start - job.enqueued)
+            insert_logger.info(f'parse time: {end - start} {job.docs_number}')
+            job.parsed = True
+            self._settle(job)
+
+    async def _embed_worker(self):
+        while True:
+            batch = await self.embed_queue.get()
+            # 队列中已就绪的批次合并进同一次请求，凑满embed_batch_size个chunk
+            batches = [batch]
+            total = len(batch.docs)
+            while total < self.embed_batch_size and not self.embed_queue.empty():
+                batch = self.embed_queue.get_nowait()
+                batches.append(batch)
+                total += len(batch.docs)
+            # 所属文件已经失败的批次直接丢弃
+            for batch in batches:
+                if batch.job.failed:
+                    self._release(batch)
+            batches = [batch for batch in batches if not batch.job.failed]
+            if not batches:
+                continue
+            start = time.perf_counter()
+            try:
+                texts = [doc.page_content for batch in batches for doc in batch.docs]
+                vectors = await asyncio.wait_for(self.embeddings.aembed_documents(texts),
+                                                 timeout=INSERT_TIMEOUT_SECONDS) if texts else []
+                if len(vectors) != len(texts):
+                    raise ValueError(f"embedding number mismatch: {len(vectors)} != {len(texts)}")
+            except Exception as e:
+                insert_logger.error(f'embedding error: {traceback.format_exc()}')
+                self._fail('embed', list(dict.fromkeys(batch.job for batch in batches)), "embedding error")
+                for batch in batches:
+                    self._release(batch)
+                continue
+            end = time.perf_counter()
+            offset = 0
+            for batch in batches:
+                batch.embeddings = vectors[offset:offset + len(batch.docs)]
+                offset += len(batch.docs)
+                self._add_time(batch.job, 'embed_time', end - start)
+            self.stages['embed'].record(len(batches), len(texts), end - start,
+                                        sum(start - batch.enqueued for batch in batches))
+            for batch in batches:
+                self.mysql_client.update_file_msg(batch.job.file_id, f'Processing:{random.randint(50, 75)}%')
+                await self._forward(self.write_queue, batch)
+
+    def _write_vectors(self, batch: ChunkBatch):
+        user_id = batch.job.file_info[2]
+        self.milvus_client.load_collection_(user_id)
+        self.milvus_client.store_docs(batch.docs, batch.embeddings)
+        self.mysql_client.store_parent_chunks(batch.full_docs)
+
+    async def _vector_writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.write_queue.get()
+            job = batch.job
+            if job.failed:
+                self._release(batch)
+                continue
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(loop.run_in_executor(self.milvus_client.executor, self._write_vectors, batch),
+                                       timeout=INSERT_TIMEOUT_SECONDS)
+            except asyncio.TimeoutError:
+                insert_logger.error(f'Timeout: milvus insert took longer than {INSERT_TIMEOUT_SECONDS} seconds')
+                # 超时的批次可能已经部分写入，随文件一起清理
+                job.written += 1
+                job.time_record['insert_timeout'] = True
+                self._fail('vector_write', [job], f"milvus insert timeout: {INSERT_TIMEOUT_SECONDS}s")
+                self._release(batch)
+                continue
+            except Exception as e:
+                insert_logger.error(f'milvus insert error: {traceback.format_exc()}')
+                job.written += 1
+                job.time_record['insert_error'] = True
+                self._fail('vector_write', [job], "milvus insert error")
+                self._release(batch)
+                continue
+            job.written += 1
+            end = time.perf_counter()
+            self._add_time(job, 'milvus_insert_time', end - start)
+            self.stages['vector_write'].record(1, len(batch.docs), end - start, start - batch.enqueued)
+            if self.es_client is not None:
+                await self._forward(self.es_queue, batch)
+            else:
+                self._release(batch)
+
+    async def _es_writer(self):
+        while True:
+            batch = await self.es_queue.get()
+            # 队列中已就绪的批次合并进同一次bulk写入，凑满es_batch_size个chunk
+            batches = [batch]
+            total = len(batch.docs)
+            while total < self.es_batch_size and not self.es_queue.empty():
+                batch = self.es_queue.get_nowait()
+                batches.append(batch)
+                total += len(batch.docs)
+            for batch in batches:
+                if batch.job.failed or not batch.docs:
+                    self._release(batch)
+            batches = [batch for batch in batches if not batch.job.failed and batch.docs]
+            if not batches:
+                continue
+            start = time.perf_counter()
+            jobs = list(dict.fromkeys(batch.job for batch in batches))
+            try:
+                # docs的doc_id是file_id + '_' + i 注意这里的docs_id指的是es数据库中的唯一标识，而不是父块编号
+                docs_ids = [doc.metadata['file_id'] + '_' + str(batch.offset + i)
+                            for batch in batches for i, doc in enumerate(batch.docs)]
+                es_docs = [doc.to_document() for batch in batches for doc in batch.docs]
+                es_res = await asyncio.wait_for(self.es_client.abulk_add(es_docs, docs_ids),
+                                                timeout=INSERT_TIMEOUT_SECONDS)
+                insert_logger.info(f'es bulk insert number: {es_res}, {docs_ids[0]}')
+            except asyncio.TimeoutError:
+                insert_logger.error(f'Timeout: es bulk insert took longer than {INSERT_TIMEOUT_SECONDS} seconds')
+                for job in jobs:
+                    job.time_record['insert_timeout'] = True
+                self._fail('es_write', jobs, f"es bulk insert timeout: {INSERT_TIMEOUT_SECONDS}s")
+                for batch in batches:
+                    self._release(batch)
+                continue
+            except Exception as e:
+                insert_logger.error(f'es bulk insert error: {traceback.format_exc()}')
+                for job in jobs:
+                    job.time_record['insert_error'] = True
+                self._fail('es_write', jobs, "es bulk insert error")
+                for batch in batches:
+                    self._release(batch)
+                continue
+            end = time.perf_counter()
+            for batch in batches:
+                self._add_time(batch.job, 'es_insert_time', end - start)
+            self.stages['es_write'].record(len(batches), len(es_docs), end - start,
+                                           sum(start - batch.enqueued for batch in batches))
+            for batch in batches:
+                self._release(batch)
+
+    async def _refresh_es(self):
+        """
+        使调用前写入的es文档可被检索。持锁refresh时覆盖所有已发出的请求，
+        排在后面的调用如果已被覆盖就直接返回，同时完成的多个文件只refresh一次
+        """
+        self._refresh_requested += 1
+        ticket = self._refresh_requested
+        async with self._refresh_lock:
+            if self._refreshed >= ticket:
+                return
+            target = self._refresh_requested
+            await self.es_client.arefresh()
+            self._refreshed = target
+
+    async def _complete(self, job: IngestJob):
+        _, file_id, user_id, file_name, kb_id = job.file_info[:5]
+        rows = job.index.rows()
+        vanished = job.index.vanished()
+        if vanished:
+            # 新版本中不再出现的父块，删除失败时保留在索引中，下次更新时重试
+            try:
+                await asyncio.get_running_loop().run_in_executor(self.milvus_client.executor, self._delete_chunks,
+                                                                 job, vanished)
+            except Exception as e:
+                insert_logger.error(f'delete vanished chunks of {file_id} error: {traceback.format_exc()}')
+                rows = rows + vanished
+        job.time_record['reused_chunks'] = len(job.index.kept)
+        job.time_record['deleted_chunks'] = len(vanished)
+        try:
+            self.mysql_client.replace_chunk_index(file_id, rows)
+            self.mysql_client.modify_file_chunks_number(file_id, user_id, kb_id, job.chunks_number)
+        except Exception as e:
+            insert_logger.error(f'modify file chunks number error: {traceback.format_exc()}')
+            job.time_record['insert_error'] = True
+            self._fail('vector_write', [job], "mysql update chunks number error")
+            return
+        try:
+            self.mysql_client.update_file_msg(file_id, f'Processing:{random.randint(75, 100)}%')
+            job.time_record['upload_total_time'] = round(time.perf_counter() - job.start, 2)
+            self.mysql_client.update_file_upload_infos(file_id, job.time_record)
+        except Exception as e:
+            insert_logger.error(f'update upload infos error: {traceback.format_exc()}')
+        if self.es_client is not None and job.docs_number:
+            # refresh_interval被放宽，文件标记完成前refresh，保证完成后即可检索
+            try:
+                await self._refresh_es()
+            except Exception as e:
+                insert_logger.error(f'es refresh error: {traceback.format_exc()}')
+        insert_logger.info(f'insert_files_to_milvus: {user_id}, {kb_id}, {file_id}, {file_name}, green, '
+                           f'added: {len(job.index.added)}, reused: {len(job.index.kept)}, deleted: {len(vanished)}')
+        self._finish(job, 'green', json.dumps(job.time_record, ensure_ascii=False))
+
+    async def _report_metrics(self):
+        while True:
+            await asyncio.sleep(INGEST_METRICS_INTERVAL)
+            insert_logger.info(f"ingest pipeline metrics: {json.dumps(self.metrics(), ensure_ascii=False)}")
@@ -0,0 +1,58 @@
+import asyncio
+import time
+from typing import Awaitable, Dict, Optional
+
+from src.configs.configs import CHAT_STAGE_TIMEOUTS, CHAT_LLM_RESERVED_SECONDS
+from src.utils.log_handler import debug_logger
+
+
+class RequestDeadline:
+    """
+    一次问答请求的端到端截止时间。
+
+    前置阶段（query_rewrite、condense、milvus、es、rerank）各自有时间预算，同时要给大模型生成预留时间；
+    某个阶段超出预算时直接降级（跳过该阶段或使用兜底结果），降级决策记录在 time_record 的 degrade_<stage> 中。
+    """
+
+    def __init__(self, timeout: float, time_record: dict, start: Optional[float] = None,
+                 stage_timeouts: Optional[Dict[str, float]] = None,
+                 llm_reserved_seconds: float = CHAT_LLM_RESERVED_SECONDS):
+        self.start = start if start is not None else time.perf_counter()
+        self.expire_at = self.start + timeout
+        self.time_record = time_record
+        self.stage_timeouts = stage_timeouts if stage_timeouts is not None else CHAT_STAGE_TIMEOUTS
+        self.llm_reserved_seconds = llm_reserved_seconds
+        self.degraded = set()
+
+    def remaining(self) -> float:
+        return self.expire_at - time.perf_counter()
+
+    def budget(self, stage: str) -> float:
+        # 阶段可用时间 = min(阶段预算, 总剩余时间 - 大模型预留时间)
+        available = self.remaining() - self.llm_reserved_seconds
+        stage_timeout = self.stage_timeouts.get(stage)
+        return available if stage_timeout is None else min(stage_timeout, available)
+
+    def degrade(self, stage: str, reason: str):
+        self.degraded.add(stage)
+        self.time_record[f'degrade_{stage}'] = 1
+        debug_logger.warning(f"deadline degrade stage {stage}: {reason}, remaining: {self.remaining():.2f}s")
+
+    async def run(self, stage: str, awaitable: Awaitable, fallback=None):
+        """
+        在阶段预算内等待awaitable，超时或预算已耗尽时返回fallback
+        """
+        budget = self.budget(stage)
+        if budget <= 0:
+            # 预算已耗尽，不再启动该阶段
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            elif isinstance(awaitable, asyncio.Future):
+                awaitable.cancel()
+            self.degrade(stage, "no budget left")
+            return fallback
+        try:
+            return await asyncio.wait_for(awaitable, timeout=budget)
+        except asyncio.TimeoutError:
+            self.degrade(stage, f"timeout after {budget:.2f}s")
+            return fallback
@@ -87,6 +87,25 @@ def deduplicate_documents(source_docs):
             deduplicated_docs.append(doc)
     return deduplicated_docs
 
+def reciprocal_rank_fusion(ranked_lists, k=60):
+    """
+    RRF融合多路检索结果：score(doc) = sum(1 / (k + rank))，按page_content去重，
+    融合分数写入metadata['rrf_score']，返回按融合分数降序排列的文档
+    """
+    scores = {}
+    first_docs = {}
+    for docs in ranked_lists:
+        for rank, doc in enumerate(docs, start=1):
+            key = doc.page_content
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            first_docs.setdefault(key, doc)
+    fused_docs = []
+    for key in sorted(scores, key=scores.get, reverse=True):
+        doc = first_docs[key]
+        doc.metadata['rrf_score'] = round(scores[key], 6)
+        fused_docs.append(doc)
+    return fused_docs
+
 def validate_user_id(user_id):
     if len(user_id) > 64:
         return False
@@ -239,6 +258,11 @@ def clear_string(str):
     str = re.sub(r"[^\u4e00-\u9fa5a-zA-Z0-9]", "", str)
     return str
 
+def normalize_question(question: str) -> str:
+    # 统一大小写、空白和句末标点，避免"xx？"和"xx?"被当成两个问题
+    question = re.sub(r'\s+', ' ', question.strip().lower())
+    return question.rstrip('?？。.!！~ ')
+
 embedding_tokenizer = AutoTokenizer.from_pretrained(EMBED_MODEL_PATH)
 rerank_tokenizer = AutoTokenizer.from_pretrained(RERANK_MODEL_PATH)
 llm_tokenizer = AutoTokenizer.from_pretrained(DEFAULT_MODEL_PATH)